@@ -0,0 +1,245 @@
+"""Alignment of the answer clips with the EEG recording, on one shared time grid.
+
+Every `AudioData.start` is converted to a sample offset in the EEG recording
+using the user's `fifStartTime`, so each clip is matched to the EEG that was
+recorded while it was spoken, instead of pairing clips and Q/R segments by
+their position in a list.
+
+`AlignmentEngine.align` then computes, for all clips at once:
+
+- the spectrograms of the clips, resampled to a common rate, each from one
+  FFT over a strided view of the clip's frames;
+- the band power of every EEG channel in windows centred on the same frame
+  times, taken from a strided view of the recording in chunks of frames, so
+  memory stays bounded however many and however long the clips are.
+
+Only the frames of each clip are computed. The result is an `Alignment` of
+arrays padded to the longest clip (NaN beyond each clip's end, or where the
+clip lies outside the recording) that can be used for modelling directly.
+`plot_alignment` is one consumer of it.
+"""
+import numbers
+from collections import namedtuple
+from datetime import datetime
+
+import mne
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+from scipy.signal import get_window
+
+from audio_io import load_audio
+from live_dsp import BANDS
+
+# question_ids: questionId of every clip
+# eeg_offsets: sample of the EEG recording at which every clip starts
+# times: frame times in seconds from the start of each clip, shared by all clips
+# lengths: number of frames of every clip; later frames are NaN
+# freqs, spectrograms: audio frequencies in Hz and power (n_clips, n_freqs, n_frames)
+# ch_names, bands, band_power: EEG band power (n_clips, n_channels, n_bands, n_frames)
+Alignment = namedtuple('Alignment', ['question_ids', 'eeg_offsets', 'times', 'lengths', 'freqs', 'spectrograms',
+                                     'ch_names', 'bands', 'band_power', 'sfreq', 'audio_rate'])
+
+
+def _parse(value):
+    # Epoch seconds as a float, or a datetime that is naive when the value has no time zone
+    if isinstance(value, numbers.Real):
+        # Millisecond timestamps (as sent by JavaScript clients) are larger than any second timestamp
+        return value / 1000 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            return _parse(float(value))
+        except ValueError:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if isinstance(value, datetime):
+        return value
+    raise TypeError(f'Cannot parse a timestamp from {value!r}')
+
+
+def is_naive(value):
+    """Whether a timestamp accepted by `parse_timestamp` has no time zone, i.e. is a wall-clock time."""
+    value = _parse(value)
+    return isinstance(value, datetime) and value.tzinfo is None
+
+
+def parse_timestamp(value, tz=None):
+    """Seconds since the epoch of an ISO 8601 string, a datetime or a number of seconds or milliseconds.
+
+    Times without a time zone are in `tz` (a `datetime.tzinfo`), by default in the local time zone of this
+    machine, like the `start_timestamp` the recorder stores.
+    """
+    value = _parse(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None and tz is not None:
+            value = value.replace(tzinfo=tz)
+        return value.timestamp()
+    return value
+
+
+def eeg_offset(audio_start, fif_start_time, sfreq, tz=None):
+    """EEG sample at which a clip starting at `audio_start` begins, for a recording started at `fif_start_time`.
+
+    When only one of the two timestamps has no time zone, the wall-clock one cannot be placed without
+    knowing where it was recorded, so `tz` is required; otherwise the offset would be off by the UTC offset.
+    """
+    if tz is None and is_naive(audio_start) != is_naive(fif_start_time):
+        raise ValueError(f'Cannot align {audio_start!r} with {fif_start_time!r}: only one of them has a time '
+                         f'zone, pass the time zone of the recording as tz')
+    return int(round((parse_timestamp(audio_start, tz) - parse_timestamp(fif_start_time, tz)) * sfreq))
+
+
+class AlignmentEngine:
+    """Spectrograms and EEG band power of all answer clips on a shared time grid.
+
+    Parameters:
+    - hop: seconds between frames of the grid.
+    - audio_rate: sample rate all clips are resampled to.
+    - audio_window: length of the spectrogram frames in seconds.
+    - eeg_window: length of the EEG band power windows in seconds.
+    - bands: mapping of band name to (low, high) frequency in Hz.
+    - max_freq: highest audio frequency kept in the spectrograms.
+    - tz: time zone of timestamps without one, see `eeg_offset`.
+    """
+
+    def __init__(self, hop=0.05, audio_rate=16000, audio_window=0.032, eeg_window=1.0, bands=None, max_freq=4000.0,
+                 tz=None):
+        self.hop = hop
+        self.audio_rate = audio_rate
+        self.audio_window = audio_window
+        self.eeg_window = eeg_window
+        self.bands = bands or BANDS
+        self.max_freq = max_freq
+        self.tz = tz
+
+    def spectrograms(self, clips):
+        """Power spectrograms of 1-D clips at `audio_rate`, as (freqs, (n_clips, n_freqs, n_frames), lengths)."""
+        nperseg = int(round(self.audio_window * self.audio_rate))
+        step = int(round(self.hop * self.audio_rate))
+        lengths = np.array([int(np.ceil(len(clip) / step)) for clip in clips], dtype=int)
+        window = get_window('hann', nperseg).astype(np.float32)
+        scale = self.audio_rate * (window ** 2).sum()
+        freqs = fft.rfftfreq(nperseg, 1 / self.audio_rate)
+        keep = freqs <= self.max_freq
+
+        power = np.full((len(clips), keep.sum(), max(lengths.max(initial=0), 1)), np.nan, dtype=np.float32)
+        for i, (clip, n_frames) in enumerate(zip(clips, lengths)):
+            if n_frames == 0:
+                continue
+            # Frame k is centred on sample k * step; only the frames of this clip are computed
+            padded = np.zeros((n_frames - 1) * step + nperseg, dtype=np.float32)
+            n = min(len(clip), len(padded) - nperseg // 2)
+            padded[nperseg // 2:nperseg // 2 + n] = clip[:n]
+            frames = sliding_window_view(padded, nperseg)[::step][:n_frames]
+            spectrum = fft.rfft(frames * window, axis=-1)[:, keep]
+            power[i, :, :n_frames] = ((spectrum.real ** 2 + spectrum.imag ** 2) / scale).T
+        return freqs[keep], power, lengths
+
+    def band_power(self, data, sfreq, offsets, lengths, chunk_frames=256):
+        """Band power of `data` (n_channels, n_times) in windows centred on the grid after every offset.
+
+        `lengths` is the number of frames after each offset. Returns (n_offsets, n_channels, n_bands, n_frames);
+        frames after a length and windows not entirely inside the data are NaN. At most `chunk_frames` windows
+        per channel are held at a time, so memory does not grow with the number or length of the clips.
+        """
+        n_channels, n_times = data.shape
+        n_bands = len(self.bands)
+        result = np.full((len(offsets), n_channels, n_bands, max(np.max(lengths, initial=0), 1)), np.nan)
+        width = max(int(round(self.eeg_window * sfreq)), 2)
+        if n_times < width:
+            return result
+
+        window = get_window('hann', width)
+        freqs = fft.rfftfreq(width, 1 / sfreq)
+        # Average the bins of every band with one matrix product
+        masks = np.array([(freqs >= low) & (freqs < high) for low, high in self.bands.values()], dtype=float)
+        counts = masks.sum(axis=1)
+        masks[counts > 0] /= counts[counts > 0, np.newaxis]
+
+        # Windows starting at every sample, as a view of the recording; only the needed ones are copied
+        view = sliding_window_view(data, width, axis=-1)
+        steps = np.round(np.arange(result.shape[-1]) * self.hop * sfreq).astype(int)
+        for i, (offset, n_frames) in enumerate(zip(offsets, lengths)):
+            starts = offset + steps[:n_frames] - width // 2
+            frames = np.flatnonzero((starts >= 0) & (starts + width <= n_times))
+            for first in range(0, len(frames), chunk_frames):
+                chunk = frames[first:first + chunk_frames]
+                windows = view[:, starts[chunk]]  # (n_channels, len(chunk), width)
+                windows -= windows.mean(axis=-1, keepdims=True)
+                windows *= window
+                spectrum = fft.rfft(windows, axis=-1)
+                power = spectrum.real ** 2 + spectrum.imag ** 2
+                result[i][:, :, chunk] = (power @ masks.T).transpose(0, 2, 1)
+        result[:, :, counts == 0] = np.nan
+        return result
+
+    def align(self, raw, user_data, clips=None):
+        """Align the answer clips of `user_data` (a `fetch_data.UserData`) with `raw`. Returns an `Alignment`.
+
+        Parameters:
+        - raw: the user's EEG recording, e.g. preprocessed; its EEG channels are used.
+        - clips: 1-D arrays of the clips at `audio_rate`, in the order of `user_data.audio`; by default they
+          are decoded (and cached) with `audio_io.load_audio` from the downloaded files. Clips passed here
+          must not be cleaned (`AudioData(clean=False)`): silence removal drops samples, and every later
+          frame would be matched with EEG recorded before it was spoken.
+        """
+        if clips is None:
+            # Uncleaned clips: removing silences would shift their samples against the EEG
+            clips = [load_audio(audio_data.audioPath, sample_rate=self.audio_rate).samples
+                     for audio_data in user_data.audio]
+        sfreq = raw.info['sfreq']
+        offsets = np.array([eeg_offset(audio_data.start, user_data.fifStartTime, sfreq, self.tz)
+                            for audio_data in user_data.audio], dtype=int)
+        freqs, spectrograms, lengths = self.spectrograms(clips)
+        n_frames = spectrograms.shape[-1]
+
+        picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+        band_power = self.band_power(raw.get_data(picks=picks), sfreq, offsets, lengths)
+
+        return Alignment(
+            question_ids=[audio_data.questionId for audio_data in user_data.audio],
+            eeg_offsets=offsets,
+            times=np.arange(n_frames) * self.hop,
+            lengths=lengths,
+            freqs=freqs,
+            spectrograms=spectrograms,
+            ch_names=[raw.ch_names[pick] for pick in picks],
+            bands=list(self.bands),
+            band_power=band_power,
+            sfreq=sfreq,
+            audio_rate=self.audio_rate,
+        )
+
+
+def plot_alignment(alignment, band='alpha'):
+    """Plot the spectrogram and the EEG band power of every clip, one pair of axes per clip. Returns the figure."""
+    import matplotlib.pyplot as plt
+
+    n_clips = len(alignment.question_ids)
+    if n_clips == 0:
+        fig, ax = plt.subplots(figsize=(10, 2))
+        ax.set_axis_off()
+        ax.set_title("No answer clips to align")
+        return fig
+    fig, axs = plt.subplots(n_clips * 2, 1, figsize=(10, 6 * n_clips), squeeze=False)
+    band_index = alignment.bands.index(band)
+    for i, question_id in enumerate(alignment.question_ids):
+        n = alignment.lengths[i]
+        times = alignment.times[:n]
+        offset = alignment.eeg_offsets[i] / alignment.sfreq
+
+        ax = axs[i * 2, 0]
+        for j, ch_name in enumerate(alignment.ch_names):
+            ax.plot(times, alignment.band_power[i, j, band_index, :n], label=ch_name)
+        ax.set_title(f"Question {question_id}: EEG {band} power from {offset:.2f} s")
+        ax.legend(loc="upper right")
+
+        ax = axs[i * 2 + 1, 0]
+        with np.errstate(divide='ignore'):
+            ax.pcolormesh(times, alignment.freqs, 10 * np.log10(alignment.spectrograms[i, :, :n]), shading='auto')
+        ax.set_ylabel('Frequency [Hz]')
+        ax.set_xlabel('Time [sec]')
+        ax.set_title(f"Audio Spectrogram for Question {question_id}")
+
+    fig.tight_layout()
+    return fig
@@ -0,0 +1,133 @@
+"""Timestamping of annotations that arrive over HTTP during a recording.
+
+Calling the device's `annotate()` from a Flask request thread stamps the marker
+with the sample that is current when the call finally runs, after the request
+was parsed and the thread got the GIL, and concurrent markers wait for each
+other. Instead, the request handler only reads `time.monotonic()` as the very
+first thing and appends the event to an `AnnotationQueue` (a deque, whose
+append and popleft are atomic, so producers never take a lock). The drain
+thread of the recording pops the events and converts their times to sample
+positions with a `SampleClock`.
+
+Clients can also send the time of the event on their own clock. A
+`ClockOffsetEstimator` per client learns the offset between that clock and the
+server's monotonic clock from the requests it receives, so such events are
+placed at the moment they happened on the client instead of when the request
+arrived.
+"""
+import threading
+import time
+from collections import deque, namedtuple
+
+# time: event time on the server's monotonic clock
+# received_at: monotonic time at which the request arrived
+# client_time: event time on the client's clock, if it was sent
+AnnotationEvent = namedtuple('AnnotationEvent', ['description', 'time', 'received_at', 'client_time'])
+
+
+class ClockOffsetEstimator:
+    """Offset between a client's clock and the server's monotonic clock.
+
+    Every request that carries the client's send time gives one sample of receive time minus send
+    time, which is the clock offset plus the network delay. The smallest sample of the recent ones
+    has the least delay, so it is used as the estimate.
+
+    Parameters:
+    - window: number of recent samples the minimum is taken over; a bounded window follows
+      slow drift of the client's clock.
+    """
+
+    def __init__(self, window=64):
+        self._samples = deque(maxlen=window)
+
+    def update(self, client_time, received_at):
+        self._samples.append(received_at - client_time)
+
+    @property
+    def offset(self):
+        return min(self._samples) if self._samples else None
+
+    def to_monotonic(self, client_time):
+        offset = self.offset
+        return None if offset is None else client_time + offset
+
+
+class AnnotationQueue:
+    """Annotations waiting for the drain thread, with a clock offset estimator per client."""
+
+    def __init__(self, offset_window=64):
+        self.offset_window = offset_window
+        self._events = deque()
+        self._estimators = {}
+        self._estimators_lock = threading.Lock()
+
+    def estimator(self, client_id):
+        with self._estimators_lock:
+            estimator = self._estimators.get(client_id)
+            if estimator is None:
+                estimator = self._estimators[client_id] = ClockOffsetEstimator(self.offset_window)
+            return estimator
+
+    def put(self, description, received_at=None, client_time=None, client_id=None, sent_at=None):
+        """Queue one annotation and return its `AnnotationEvent`.
+
+        Parameters:
+        - received_at: monotonic time the request arrived, defaults to now.
+        - client_time: time of the event on the client's clock, in seconds.
+        - client_id: identifies the client's clock for the offset estimate.
+        - sent_at: client time at which the request was sent, defaults to `client_time`.
+        """
+        if received_at is None:
+            received_at = time.monotonic()
+        event_time = received_at
+        if client_time is not None:
+            estimator = self.estimator(client_id)
+            estimator.update(client_time if sent_at is None else sent_at, received_at)
+            # Never place an event after the request that reported it arrived
+            event_time = min(estimator.to_monotonic(client_time), received_at)
+        event = AnnotationEvent(description, event_time, received_at, client_time)
+        self._events.append(event)
+        return event
+
+    def pop_all(self):
+        """Remove and return all queued events, oldest first."""
+        events = []
+        while True:
+            try:
+                events.append(self._events.popleft())
+            except IndexError:
+                return events
+
+
+class SampleClock:
+    """Maps the server's monotonic clock to sample positions of the recording.
+
+    Anchors are the arrival times of blocks and the number of samples received with them. The time
+    of sample 0 is estimated as the earliest of `time - n_samples / sfreq` over the recent anchors,
+    i.e. from the block that was delayed least on its way from the device. A time then maps to the
+    sample that arrived at that time, which is how the device stamps its own annotations. Only the
+    recent anchors are used, so the estimate follows the drift between the device's and the
+    computer's clocks.
+
+    Parameters:
+    - sfreq: sampling rate of the recording.
+    - window: number of recent anchors the estimate is taken over.
+    - speed: samples arrive `speed` times faster than real time (a simulated device).
+    """
+
+    def __init__(self, sfreq, window=120, speed=1.0):
+        self.sfreq = sfreq
+        self.speed = speed
+        self._starts = deque(maxlen=window)
+
+    def add_anchor(self, monotonic_time, n_samples):
+        if n_samples > 0:
+            self._starts.append(monotonic_time - n_samples / (self.sfreq * self.speed))
+
+    @property
+    def ready(self):
+        return bool(self._starts)
+
+    def to_seconds(self, monotonic_time):
+        """Position of `monotonic_time` in the recording, in seconds from the first sample."""
+        return max(monotonic_time - min(self._starts), 0.0) * self.speed
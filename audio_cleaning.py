@@ -0,0 +1,154 @@
+"""Block-wise cleaning of answer clips: noise reduction, band pass, normalization, silence removal.
+
+`AudioCleaner` walks a decoded clip (see `audio_io`) in blocks of a few seconds
+instead of running every step over full-length copies of it:
+
+- noise reduction runs on overlapping blocks, which are crossfaded over the
+  overlap so the block edges are not audible;
+- the band pass is a Butterworth filter in second-order sections, designed once
+  per sample rate and band (`preprocessing.bandpass_sos`), whose state is
+  carried from block to block (`live_dsp.CausalBandpass`);
+- the cleaned samples go into one preallocated float32 array; the peak is
+  tracked on the way, so normalization is a single in-place division;
+- silence is found from the RMS of short frames relative to the peak, in one
+  vectorized pass, and removed like pydub's `split_on_silence` did: silences of
+  at least `min_silence_len` are cut down to `keep_silence` on either side.
+
+Apart from the input and the output only one block is held at a time, so long
+recordings are cleaned in bounded memory.
+"""
+import hashlib
+import json
+
+import noisereduce as nr
+import numpy as np
+
+from audio_io import Audio
+from live_dsp import CausalBandpass
+
+
+class AudioCleaner:
+    """Cleans mono clips block by block.
+
+    Parameters:
+    - l_freq, h_freq: pass band of the band-pass filter in Hz.
+    - order: order of the Butterworth filter.
+    - block_duration: seconds of audio per noise reduction block.
+    - overlap: seconds by which consecutive blocks overlap.
+    - noise_reduction: run noise reduction at all.
+    - silence_thresh: frames whose RMS is this many dB below the peak are silent (pydub's dBFS after
+      normalization).
+    - min_silence_len: shortest silence, in seconds, that is removed.
+    - keep_silence: seconds of silence kept on either side of the remaining sound.
+    - frame_duration: length of the frames the RMS is computed over, in seconds.
+    """
+
+    def __init__(self, l_freq=80.0, h_freq=250.0, order=5, block_duration=10.0, overlap=1.0, noise_reduction=True,
+                 silence_thresh=-40.0, min_silence_len=0.5, keep_silence=0.1, frame_duration=0.01):
+        if overlap >= block_duration:
+            raise ValueError('overlap must be shorter than block_duration')
+        self.l_freq = l_freq
+        self.h_freq = h_freq
+        self.order = order
+        self.block_duration = block_duration
+        self.overlap = overlap
+        self.noise_reduction = noise_reduction
+        self.silence_thresh = silence_thresh
+        self.min_silence_len = min_silence_len
+        self.keep_silence = keep_silence
+        self.frame_duration = frame_duration
+
+    def params(self):
+        """The settings that change the result."""
+        return dict(vars(self))
+
+    def key(self):
+        """Short hash of `params()`, to key cached clips."""
+        return hashlib.sha256(json.dumps(self.params(), sort_keys=True).encode()).hexdigest()[:16]
+
+    def _reduce_noise(self, block, sample_rate):
+        # noisereduce needs at least one FFT window
+        if not self.noise_reduction or len(block) < 2048:
+            return block.astype(np.float32)
+        return nr.reduce_noise(y=block, sr=sample_rate).astype(np.float32)
+
+    def filter(self, samples, sample_rate):
+        """Noise-reduce and band-pass filter `samples` block by block. Returns (float32 array, peak amplitude)."""
+        n_times = len(samples)
+        block = max(int(self.block_duration * sample_rate), 1)
+        overlap = int(self.overlap * sample_rate)
+        hop = block - overlap
+        bandpass = CausalBandpass(float(sample_rate), 1, self.l_freq, self.h_freq, self.order)
+        fade_in = np.linspace(0, 1, overlap, dtype=np.float32)
+
+        out = np.empty(n_times, dtype=np.float32)
+        peak = 0.0
+        tail = None
+        for start in range(0, max(n_times, 1), hop):
+            reduced = self._reduce_noise(np.asarray(samples[start:start + block], dtype=np.float32), sample_rate)
+            if tail is not None:
+                # Crossfade from the previous block over the overlap
+                k = min(len(tail), len(reduced))
+                reduced[:k] = tail[:k] * (1 - fade_in[:k]) + reduced[:k] * fade_in[:k]
+            last = start + block >= n_times
+            final = reduced if last else reduced[:hop]
+            filtered = bandpass.process(final[np.newaxis, :])[0]
+            out[start:start + len(filtered)] = filtered
+            if len(filtered):
+                peak = max(peak, float(np.abs(filtered).max()))
+            if last:
+                break
+            tail = reduced[hop:]
+        return out, peak
+
+    def silence_mask(self, samples, sample_rate, peak):
+        """Boolean mask of the samples to keep after removing long silences."""
+        frame = max(int(self.frame_duration * sample_rate), 1)
+        n_frames = len(samples) // frame
+        keep = np.ones(len(samples), dtype=bool)
+        if n_frames == 0 or peak == 0:
+            return keep
+        frames = samples[:n_frames * frame].reshape(n_frames, frame)
+        energy = np.einsum('ij,ij->i', frames, frames, dtype=np.float64) / frame
+        silent = 10 * np.log10(energy / peak ** 2 + 1e-20) < self.silence_thresh
+
+        # Runs of silent frames: starts and (exclusive) ends
+        edges = np.diff(np.concatenate([[0], silent.astype(np.int8), [0]]))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        long_runs = ends - starts >= int(round(self.min_silence_len / self.frame_duration))
+        pad = int(round(self.keep_silence / self.frame_duration))
+        starts = starts[long_runs]
+        ends = ends[long_runs]
+        # Silence is only kept next to sound, so runs at the start or end of the clip are padded on their inner side
+        cut_starts = np.where(starts == 0, 0, starts + pad)
+        cut_ends = np.where(ends == n_frames, n_frames, ends - pad)
+        valid = cut_ends > cut_starts
+
+        # Mark the cut frames with +1/-1 at the run edges and integrate
+        marks = np.zeros(n_frames + 1, dtype=np.int32)
+        np.add.at(marks, cut_starts[valid], 1)
+        np.add.at(marks, cut_ends[valid], -1)
+        keep_frames = np.cumsum(marks[:-1]) == 0
+        keep[:n_frames * frame] = np.repeat(keep_frames, frame)
+        # The samples after the last whole frame go with it
+        keep[n_frames * frame:] = keep_frames[-1]
+        return keep
+
+    def clean(self, audio):
+        """Clean a mono `audio_io.Audio` and return the cleaned `Audio`."""
+        samples = audio.samples
+        if samples.ndim == 2:
+            samples = samples.mean(axis=1)
+        if len(samples) == 0:
+            return Audio(np.zeros(0, dtype=np.float32), audio.sample_rate)
+        cleaned, peak = self.filter(samples, audio.sample_rate)
+        if peak > 0:
+            cleaned /= peak
+        keep = self.silence_mask(cleaned, audio.sample_rate, 1.0 if peak > 0 else 0.0)
+        if keep.any() and not keep.all():
+            cleaned = cleaned[keep]
+        return Audio(cleaned, audio.sample_rate)
+
+
+default_cleaner = AudioCleaner()
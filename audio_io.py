@@ -0,0 +1,154 @@
+"""Decoding of the answer clips straight to NumPy arrays.
+
+Clips used to be decoded by pydub, re-encoded to a WAV file in memory and
+parsed again by `scipy.io.wavfile`, and the cleaned audio was rebuilt into an
+`AudioSegment` and re-encoded to MP3. `decode_audio` instead lets ffmpeg write
+float32 PCM (optionally resampled and mixed to mono) to a pipe that is read
+into one array. WAV files are read directly without ffmpeg.
+
+The same array feeds spectrograms, noise reduction and `parselmouth.Sound`
+(`to_sound`). `AudioCache` keeps decoded clips as `.npy` files named after the
+content hash of the source and the decode settings; they are memory mapped
+when loaded, so a clip is decoded once per study and not per analysis run.
+"""
+import glob
+import hashlib
+import io
+import json
+import os
+import subprocess
+import uuid
+from collections import namedtuple
+
+import numpy as np
+from scipy.io import wavfile
+
+# samples: float32 array of shape (n_times,) for mono, (n_times, n_channels) otherwise, in [-1, 1]
+Audio = namedtuple('Audio', ['samples', 'sample_rate'])
+
+FFMPEG = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE = os.getenv('FFPROBE_BINARY', 'ffprobe')
+
+
+def _read_source(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    with open(source, 'rb') as file:
+        return file.read()
+
+
+def _probe(data):
+    # Sample rate and channel count of the first audio stream
+    result = subprocess.run([FFPROBE, '-v', 'error', '-select_streams', 'a:0', '-show_entries',
+                             'stream=sample_rate,channels', '-of', 'json', '-i', 'pipe:0'],
+                            input=data, capture_output=True, check=True)
+    stream = json.loads(result.stdout)['streams'][0]
+    return int(stream['sample_rate']), int(stream['channels'])
+
+
+def _decode_wav(data, sample_rate, mono):
+    rate, samples = wavfile.read(io.BytesIO(data))
+    if samples.dtype.kind == 'i':
+        samples = samples.astype(np.float32) / -np.iinfo(samples.dtype).min
+    elif samples.dtype.kind == 'u':
+        # 8-bit WAV is unsigned
+        samples = (samples.astype(np.float32) - 128) / 128
+    else:
+        samples = samples.astype(np.float32, copy=False)
+    if mono and samples.ndim == 2:
+        samples = samples.mean(axis=1)
+    if sample_rate and sample_rate != rate:
+        from scipy.signal import resample_poly
+
+        divisor = np.gcd(int(sample_rate), int(rate))
+        samples = resample_poly(samples, sample_rate // divisor, rate // divisor, axis=0).astype(np.float32)
+        rate = sample_rate
+    return Audio(samples, rate)
+
+
+def decode_audio(source, sample_rate=None, mono=True):
+    """Decode an audio file (path or bytes) to float32 PCM. Returns an `Audio`.
+
+    Parameters:
+    - sample_rate: resample to this rate; None keeps the rate of the file.
+    - mono: mix all channels to one.
+    """
+    data = _read_source(source)
+    if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+        return _decode_wav(data, sample_rate, mono)
+
+    if sample_rate is None or not mono:
+        rate, channels = _probe(data)
+        sample_rate = sample_rate or rate
+    channels = 1 if mono else channels
+    result = subprocess.run([FFMPEG, '-v', 'error', '-i', 'pipe:0', '-f', 'f32le', '-acodec', 'pcm_f32le',
+                             '-ac', str(channels), '-ar', str(sample_rate), 'pipe:1'],
+                            input=data, capture_output=True, check=True)
+    samples = np.frombuffer(result.stdout, dtype='<f4')
+    if channels > 1:
+        samples = samples.reshape(-1, channels)
+    return Audio(samples, sample_rate)
+
+
+def encode_audio(audio, format='mp3', bitrate='128k'):
+    """Encode an `Audio` to the bytes of a file in `format`, in a single ffmpeg call."""
+    samples = np.ascontiguousarray(audio.samples, dtype='<f4')
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    result = subprocess.run([FFMPEG, '-v', 'error', '-f', 'f32le', '-ar', str(audio.sample_rate), '-ac', str(channels),
+                             '-i', 'pipe:0', '-b:a', bitrate, '-f', format, 'pipe:1'],
+                            input=samples.tobytes(), capture_output=True, check=True)
+    return result.stdout
+
+
+def to_sound(audio):
+    """The `parselmouth.Sound` of an `Audio`, without decoding the file again."""
+    import parselmouth
+
+    samples = np.asarray(audio.samples, dtype=np.float64)
+    return parselmouth.Sound(samples.T if samples.ndim == 2 else samples, sampling_frequency=audio.sample_rate)
+
+
+class AudioCache:
+    """Decoded clips on disk, keyed by the content hash of the source and the decode settings.
+
+    Parameters:
+    - directory: where the `.npy` files are kept.
+    - mmap: memory map cached clips instead of reading them into memory.
+    """
+
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        self.mmap = mmap
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, source, sample_rate=None, mono=True, digest=None):
+        """Return the `Audio` of `source` (path or bytes), decoding it only if it is not cached.
+
+        `digest` is the SHA-256 of the source, if known (e.g. from `blob_cache`); otherwise it is computed.
+        """
+        if digest is None:
+            digest = hashlib.sha256(_read_source(source)).hexdigest()
+        key = f'{digest}-{sample_rate or "orig"}-{"mono" if mono else "all"}'
+        return self.get_or_create(key, lambda: decode_audio(source, sample_rate=sample_rate, mono=mono))
+
+    def get_or_create(self, key, make):
+        """Return the cached `Audio` stored under `key`, or store and return `make()`."""
+        # The file name ends in the sample rate, which is only known after decoding when it is not resampled
+        for path in glob.glob(os.path.join(self.directory, glob.escape(key) + '.*.npy')):
+            rate = int(path.rsplit('.', 2)[1])
+            return Audio(np.load(path, mmap_mode='r' if self.mmap else None), rate)
+
+        audio = make()
+        tmp_path = os.path.join(self.directory, f'{uuid.uuid4().hex}.tmp.npy')
+        np.save(tmp_path, audio.samples)
+        os.replace(tmp_path, os.path.join(self.directory, f'{key}.{audio.sample_rate}.npy'))
+        return audio
+
+
+# Decoded clips of the analysis scripts, next to the download cache
+audio_cache = AudioCache(os.getenv('AUDIO_CACHE_DIR', os.path.join('blob_cache', 'decoded')))
+
+
+def load_audio(source, sample_rate=None, mono=True, digest=None):
+    """Decode `source` with the shared `audio_cache`, see `AudioCache.load`."""
+    return audio_cache.load(source, sample_rate=sample_rate, mono=mono, digest=digest)
@@ -0,0 +1,144 @@
+"""Acoustic analysis of all answer clips of a study, in parallel.
+
+Every clip (one per participant and question) is decoded, trimmed with
+`trim_silence` and analysed with `extract_acoustic_features` in a pool of worker
+processes, because the Praat calls hold the CPU and the GIL. The results are
+written as one table with a row per userId and questionId: Parquet when the
+output ends in `.parquet` (needs pyarrow), CSV otherwise. Results are kept in a
+`feature_store.FeatureStore`, so a rerun only analyses new or changed clips.
+
+Clips are either the `*_<questionId>.mp3` files of a directory (the names
+`fetch_data.save_files` and `data_sync` use) or the audio of the users of the
+analysis API. Users are analysed while the remaining files are still being
+downloaded.
+
+Example:
+    python batch_acoustics.py recordings/ --output acoustics.csv --workers 16
+"""
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from audio_io import load_audio, to_sound
+from feature_store import ACOUSTIC_DECODING, FEATURE_STORE_PATH, FeatureStore, acoustic_features_params
+from utilities import AcousticFeatures
+
+# Worker processes, by default one per core
+ACOUSTIC_WORKERS = int(os.getenv('ACOUSTIC_WORKERS', '0')) or os.cpu_count()
+
+COLUMNS = ['userId', 'questionId', 'duration', 'trimmed_duration'] + list(AcousticFeatures._fields) + ['error']
+
+
+def analyze_clip(user_id, question_id, path, threshold=40, min_silence_duration=0.5):
+    """Decode, trim and analyse one clip. Returns a row of the results table; errors are recorded in it."""
+    from utilities import extract_acoustic_features, trim_silence
+
+    row = dict.fromkeys(COLUMNS)
+    row.update(userId=user_id, questionId=question_id)
+    try:
+        # Decoded once per clip, later runs read the cached samples
+        sound = to_sound(load_audio(path, **ACOUSTIC_DECODING))
+        row['duration'] = sound.duration
+        sound = trim_silence(sound, threshold, min_silence_duration, verbose=False)
+        row['trimmed_duration'] = sound.duration
+        row.update(extract_acoustic_features(sound)._asdict())
+    except Exception as e:
+        # One broken clip must not stop the analysis of the others
+        row['error'] = f'{type(e).__name__}: {e}'
+    return row
+
+
+def clips_in_directory(directory):
+    """Yield `(userId, questionId, path)` of the `<userId>_<questionId>.mp3` files in `directory`."""
+    for path in sorted(glob.glob(os.path.join(directory, '*_*.mp3'))):
+        user_id, question_id = os.path.basename(path)[:-len('.mp3')].rsplit('_', 1)
+        yield user_id, question_id, path
+
+
+def clips_of_users(users):
+    """Yield `(userId, questionId, path)` of the audio of `fetch_data.UserData` objects, downloading it if needed."""
+    for user_data in users:
+        for audio_data in user_data.audio:
+            yield user_data.userId, audio_data.questionId, audio_data.audioPath
+
+
+def analyze_clips(clips, max_workers=ACOUSTIC_WORKERS, threshold=40, min_silence_duration=0.5, store=None):
+    """Analyse `(userId, questionId, path)` clips in `max_workers` processes. Returns the rows sorted by user and question.
+
+    Clips are submitted as they are produced, so a generator that downloads them keeps the workers busy.
+    With a `feature_store.FeatureStore`, clips whose features are stored for the same file and settings
+    are not analysed again, and new results are added to it.
+    """
+    params = acoustic_features_params(threshold, min_silence_duration)
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for user_id, question_id, path in clips:
+            recording = store.digest(path) if store is not None else None
+            if store is not None:
+                stored = store.get('acoustic', recording, params, question_ids=[question_id])
+                if stored:
+                    rows.append(dict(stored[str(question_id)], userId=user_id, questionId=question_id))
+                    continue
+            future = executor.submit(analyze_clip, user_id, question_id, path, threshold, min_silence_duration)
+            futures[future] = recording
+        if rows:
+            print(f'{len(rows)} clips were already analysed')
+        for i, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            if store is not None and row['error'] is None:
+                store.put('acoustic', futures[future], row['questionId'], params, row, user_id=row['userId'])
+            rows.append(row)
+            if i % 100 == 0:
+                print(f'Analysed {i} of {len(futures)} clips')
+    return sorted(rows, key=lambda row: (row['userId'], str(row['questionId'])))
+
+
+def write_table(rows, path):
+    """Write the result rows as Parquet (for a `.parquet` path) or CSV."""
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError('Writing Parquet needs pyarrow, install it or write a .csv file')
+        table = pa.table({column: [row[column] for row in rows] for column in COLUMNS})
+        pq.write_table(table, path)
+        return
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', nargs='?',
+                        help='directory with <userId>_<questionId>.mp3 files; without it the analysis API is used')
+    parser.add_argument('--output', default='acoustic_features.csv', help='.csv or .parquet file')
+    parser.add_argument('--workers', type=int, default=ACOUSTIC_WORKERS, help='number of worker processes')
+    parser.add_argument('--threshold', type=float, default=40, help='silence threshold in dB')
+    parser.add_argument('--min-silence-duration', type=float, default=0.5, help='shortest silence trimmed, in seconds')
+    parser.add_argument('--store', default=FEATURE_STORE_PATH,
+                        help='feature store of earlier results; an empty string analyses every clip again')
+    args = parser.parse_args(argv)
+
+    if args.directory:
+        clips = clips_in_directory(args.directory)
+    else:
+        # Imported here because fetch_data needs the API settings
+        from fetch_data import get_access_token, iter_user_data
+        clips = clips_of_users(iter_user_data(get_access_token()))
+
+    rows = analyze_clips(clips, max_workers=args.workers, threshold=args.threshold,
+                         min_silence_duration=args.min_silence_duration,
+                         store=FeatureStore(args.store) if args.store else None)
+    write_table(rows, args.output)
+    failed = sum(row['error'] is not None for row in rows)
+    print(f'Wrote {len(rows)} clips to {args.output}' + (f', {failed} failed' if failed else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""End-to-end benchmark of recording, stopping, uploading and analysing a session.
+
+A simulated headset (see `simulated_eeg.py`) records a synthetic session of the
+given length, channel count and annotation density through the same session,
+drain and post-stop job code the Flask server uses. Storage is a `LocalBucket`
+in a temporary directory and the Spring server is a local HTTP stub, so no
+credentials or hardware are needed.
+
+Measured: /stop latency, the post-stop job and its stages, upload throughput,
+`preprocess_raw_data`, Q/R segmentation, acoustic feature extraction and the
+peak RSS after every step, plus the counters of every span (see `metrics.py`). The results are printed, and written to `--output`,
+as JSON so runs on different commits can be compared.
+
+Example:
+    python benchmark.py --duration 600 --channels 8 --speed 100 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from eeg_stream import EEGDiskStore
+from jobs import DONE, FAILED, JobQueue
+from metrics import registry
+from preprocessing import preprocess_raw_data
+from recording_pipeline import process_recording
+from segmentation import QRSegmenter
+from sessions import SessionManager
+from simulated_eeg import SimulatedEEG, SimulatedEEGManager
+from uploads import LocalBucket, StorageUploader
+
+
+class SpringStub(BaseHTTPRequestHandler):
+    """Accepts the POST of the recording URLs like the Spring server."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def timed(results, name, func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    results[name] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+    return value
+
+
+def record(args, work_dir):
+    """Record a simulated session with Q/R annotations. Returns the job payload, /stop latency and number of pairs."""
+    cap = {i: f'Ch{i + 1}' for i in range(args.channels)}
+    sessions = SessionManager(
+        device_factory=lambda: (SimulatedEEG(speed=args.speed, chunk_size=args.chunk_size, seed=args.seed),
+                                SimulatedEEGManager()),
+        recording_dir=os.path.join(work_dir, 'recordings'), drain_interval=args.drain_interval)
+    session = sessions.create('simulated', cap, session_id='benchmark')
+    session.start('benchmark-user', 'benchmark-token')
+
+    # Q at the start of every interval, R after 60 % of it, in simulated seconds
+    started = time.monotonic()
+    n_pairs = int(args.duration // args.annotation_interval)
+    events = []
+    for i in range(n_pairs):
+        onset = i * args.annotation_interval
+        events.append((onset, f'Q{i + 1}'))
+        events.append((onset + 0.6 * args.annotation_interval, f'R{i + 1}'))
+    for onset, description in events:
+        delay = started + onset / args.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        session.annotate(description)
+    delay = started + args.duration / args.speed - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+    start = time.perf_counter()
+    payload = session.stop()
+    return payload, time.perf_counter() - start, n_pairs
+
+
+def run_job(payload, work_dir, uploader, spring_url):
+    queue = JobQueue(os.path.join(work_dir, 'jobs.sqlite3'),
+                     {'recording': lambda job: process_recording(job, uploader, spring_url)},
+                     max_workers=1, max_attempts=1)
+    job_id = queue.submit('recording', payload)
+    while True:
+        job = queue.get(job_id)
+        if job['status'] in (DONE, FAILED):
+            break
+        time.sleep(0.05)
+    queue.shutdown()
+    return job
+
+
+def synthetic_voice(duration, sampling_frequency=44100, f0=140.0, seed=0):
+    """A voiced sound with vibrato, harmonics and a little noise, for the acoustic features."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sampling_frequency)) / sampling_frequency
+    phase = 2 * np.pi * np.cumsum(f0 * (1 + 0.02 * np.sin(2 * np.pi * 5 * t))) / sampling_frequency
+    signal = sum(np.sin(k * phase) / k for k in range(1, 8))
+    signal += 0.01 * rng.standard_normal(len(t))
+    return 0.3 * signal / np.abs(signal).max()
+
+
+def acoustic_features(n_clips, clip_duration):
+    try:
+        import parselmouth
+        from utilities import extract_acoustic_features
+    except ImportError as e:
+        return {'skipped': str(e)}
+    sounds = [parselmouth.Sound(synthetic_voice(clip_duration, seed=i), sampling_frequency=44100)
+              for i in range(n_clips)]
+    start = time.perf_counter()
+    for sound in sounds:
+        extract_acoustic_features(sound)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'clips': n_clips, 'seconds_per_clip': seconds / max(n_clips, 1),
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--duration', type=float, default=60, help='recording length in seconds (60 to 7200)')
+    parser.add_argument('--channels', type=int, default=8, help='number of EEG channels')
+    parser.add_argument('--annotation-interval', type=float, default=10,
+                        help='seconds between two questions; each gets a Q and an R annotation')
+    parser.add_argument('--speed', type=float, default=60, help='how many times faster than real time to record')
+    parser.add_argument('--chunk-size', type=int, default=50, help='samples per simulated device block')
+    parser.add_argument('--drain-interval', type=float, default=0.5, help='seconds between drains')
+    parser.add_argument('--audio-clips', type=int, default=None,
+                        help='voice clips for the acoustic features (default: one per question, at most 20)')
+    parser.add_argument('--audio-duration', type=float, default=3.0, help='length of each voice clip in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+
+    work_dir = tempfile.mkdtemp(prefix='eeg-benchmark-')
+    spring = ThreadingHTTPServer(('127.0.0.1', 0), SpringStub)
+    threading.Thread(target=spring.serve_forever, daemon=True).start()
+    uploader = StorageUploader(LocalBucket(os.path.join(work_dir, 'bucket')))
+    results = {}
+    try:
+        payload, stop_latency, n_pairs = record(args, work_dir)
+        results['stop'] = {'seconds': stop_latency, 'peak_rss_mb': peak_rss_mb()}
+
+        # The analysis steps run on a copy of the recording, the job removes the store when it is done
+        store = EEGDiskStore.open(payload['store_path'])
+        raw = store.to_raw()
+        results['recording'] = {'samples': store.n_samples, 'channels': store.n_channels,
+                                'annotations': len(store.annotations['onset'])}
+        raw = timed(results, 'load', raw.load_data)
+        timed(results, 'preprocess_raw_data', preprocess_raw_data, raw)
+        segments = timed(results, 'segmentation', QRSegmenter().segment_raw, raw)
+        results['segmentation']['segments'] = len(segments)
+        del raw, segments
+
+        job = timed(results, 'post_stop_job', run_job, payload, work_dir, uploader,
+                    f'http://127.0.0.1:{spring.server_port}')
+        results['post_stop_job'].update(status=job['status'], error=job['error'],
+                                        stages={name: stage['duration'] for name, stage in job['stages'].items()})
+        uploads = [result for result in uploader.timings if result.size]
+        results['uploads'] = [{'name': result.name, 'bytes': result.size, 'seconds': result.duration,
+                               'mb_per_s': result.size / 1024 ** 2 / result.duration if result.duration else None}
+                              for result in uploads]
+
+        n_clips = args.audio_clips if args.audio_clips is not None else min(n_pairs, 20)
+        results['acoustic_features'] = acoustic_features(n_clips, args.audio_duration)
+    finally:
+        spring.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'results': results,
+        # Every instrumented stage, see metrics.py
+        'spans': registry.snapshot(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
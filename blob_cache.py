@@ -0,0 +1,194 @@
+"""Content-addressed on-disk cache for downloaded files.
+
+Every downloaded file is stored once under the SHA-256 of its content, and a
+small SQLite index maps each URL to its content hash, ETag, size and last
+access time. A URL that is already cached is served from disk without any
+request (or with a conditional request when `revalidate` is set), identical
+files behind different URLs share one copy, and the least recently used files
+are evicted once the cache grows beyond `max_bytes`. Pinned files (see
+`get_digest`) are never evicted, e.g. the prefetched files of users a caller has
+not read yet; the cache can exceed `max_bytes` while they are pinned.
+
+`link` puts a cached file at another path as a hard link, so e.g. a synced copy
+of the data set takes no space beyond the cache.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+
+from metrics import span
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    etag TEXT,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+)
+"""
+
+
+class BlobCache:
+    """Download cache keyed by URL and content hash.
+
+    Parameters:
+    - directory: where the files and the index are stored.
+    - session: `requests.Session` used for downloads.
+    - max_bytes: size limit of the cached files; least recently used files are evicted beyond it.
+    - revalidate: check cached URLs with the server (If-None-Match on the stored ETag) before use.
+      Storage URLs of recordings never change their content, so this is off by default.
+    """
+
+    def __init__(self, directory, session, max_bytes=2 * 1024 ** 3, revalidate=False, chunk_size=1024 * 1024):
+        self.directory = directory
+        self.session = session
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        # Pin counts by digest
+        self._pins = Counter()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), timeout=30)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def get_path(self, url, pin=False):
+        """Return the path of the cached file for `url`, downloading it if needed. See `get_digest` for `pin`."""
+        return self._object_path(self.get_digest(url, pin=pin))
+
+    def get_digest(self, url, pin=False):
+        """Return the SHA-256 hex digest of the content of `url`, downloading it if needed.
+
+        With `pin`, the file is not evicted until `unpin` is called with the digest.
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT digest, etag FROM entries WHERE url = ?', (url,)).fetchone()
+        if row is not None:
+            digest, etag = row
+            if not self.revalidate or not etag:
+                if self._touch(url, digest, pin):
+                    return digest
+            elif os.path.exists(self._object_path(digest)):
+                return self._download(url, etag=etag, cached_digest=digest, pin=pin)
+        return self._download(url, pin=pin)
+
+    def unpin(self, digest):
+        """Release one `pin` of a file, so it can be evicted again."""
+        with self._lock:
+            self._pins[digest] -= 1
+            if self._pins[digest] <= 0:
+                del self._pins[digest]
+
+    def link(self, url, path):
+        """Put the content of `url` at `path` and return its SHA-256 hex digest, downloading it if needed.
+
+        `path` is a hard link to the cached file, or a copy when the two are on different file systems.
+        A linked file shares its data with the cache, so it must be replaced rather than edited in place.
+        """
+        digest = self.get_digest(url, pin=True)
+        try:
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            try:
+                os.link(self._object_path(digest), tmp_path)
+            except OSError:
+                # Another file system, or one without hard links
+                shutil.copyfile(self._object_path(digest), tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            self.unpin(digest)
+        return digest
+
+    def remove(self, url):
+        """Remove `url` and its file from the cache, e.g. when the file was damaged, so it is downloaded again.
+
+        Other URLs with the same content are downloaded again on their next use.
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT digest FROM entries WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return
+            conn.execute('DELETE FROM entries WHERE url = ?', (url,))
+            path = self._object_path(row[0])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get(self, url):
+        """Return the content of `url` as bytes."""
+        with open(self.get_path(url), 'rb') as file:
+            return file.read()
+
+    def _touch(self, url, digest, pin=False):
+        # Returns False when the file was evicted in the meantime
+        with self._lock:
+            if not os.path.exists(self._object_path(digest)):
+                return False
+            if pin:
+                self._pins[digest] += 1
+            with self._connect() as conn:
+                conn.execute('UPDATE entries SET last_access = ? WHERE url = ?', (time.time(), url))
+        return True
+
+    def _download(self, url, etag=None, cached_digest=None, pin=False):
+        headers = {'If-None-Match': etag} if etag else {}
+        tmp_path = os.path.join(self.directory, f'{uuid.uuid4().hex}.part')
+        sha256 = hashlib.sha256()
+        size = 0
+        with span('fetch') as fetch_span, self.session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                if self._touch(url, cached_digest, pin):
+                    return cached_digest
+                return self._download(url, pin=pin)
+            response.raise_for_status()
+            etag = response.headers.get('ETag')
+            with open(tmp_path, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    sha256.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+            fetch_span.add_bytes(size)
+
+        digest = sha256.hexdigest()
+        path = self._object_path(digest)
+        with self._lock:
+            if os.path.exists(path):
+                # Same content is already cached under another URL
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO entries (url, digest, etag, size, last_access) '
+                             'VALUES (?, ?, ?, ?, ?)', (url, digest, etag, size, time.time()))
+            if pin:
+                self._pins[digest] += 1
+            self._evict(keep=digest)
+        return digest
+
+    def _evict(self, keep):
+        # Called with the lock held. Sizes are counted once per distinct file.
+        with self._connect() as conn:
+            rows = conn.execute('SELECT digest, MAX(size), MAX(last_access) AS accessed FROM entries '
+                                'GROUP BY digest ORDER BY accessed').fetchall()
+            total = sum(row[1] for row in rows)
+            for digest, size, _ in rows:
+                if total <= self.max_bytes:
+                    break
+                if digest == keep or self._pins[digest] > 0:
+                    continue
+                conn.execute('DELETE FROM entries WHERE digest = ?', (digest,))
+                path = self._object_path(digest)
+                if os.path.exists(path):
+                    os.remove(path)
+                total -= size
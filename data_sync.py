@@ -0,0 +1,156 @@
+"""Incremental sync of the analysis data set to a local directory.
+
+A JSON manifest next to the synced files remembers, per user, the FIF and audio
+URLs, `fifStartTime` and the SHA-256, size and modification time of every file
+written, and the ETag of every page of the API. A sync requests the pages with
+If-None-Match, so pages that did not change are not sent again, and only
+downloads files whose URL or start time changed, or that are missing or damaged
+locally; a nightly run costs time in proportion to the new sessions rather than
+the whole history.
+
+Synced files are hard links to the download cache (`BlobCache.link`), so every
+file is stored once. Replace a synced file rather than editing it in place.
+
+A local file is hashed and compared with the manifest when its size or
+modification time differs from what was recorded (e.g. a truncated or edited
+copy); `verify=True` hashes every file and requests every page in full.
+"""
+import copy
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fetch_data import DOWNLOAD_WORKERS, UnchangedPage, blob_cache, iter_user_pages
+
+MANIFEST_NAME = 'sync_manifest.json'
+
+
+def load_manifest(path):
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {'users': {}}
+
+
+def save_manifest(manifest, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def user_files(user_data):
+    """Return the (file name, url) pairs of a user, using the same names as `fetch_data.save_files`."""
+    files = [(f"{user_data.userId}.fif", user_data.fifUrl)]
+    for audio_data in user_data.audio:
+        files.append((f"{user_data.userId}_{audio_data.questionId}.mp3", audio_data.audioUrl))
+    return files
+
+
+def _file_record(url, path, digest):
+    stat = os.stat(path)
+    return {'url': url, 'sha256': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _file_digest(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_intact(path, known_file, verify=False):
+    """Whether the local file at `path` still has the SHA-256 recorded in its manifest entry.
+
+    Files whose size and modification time match the entry are not hashed, unless `verify` is set.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if not verify and stat.st_size == known_file.get('size') and stat.st_mtime == known_file.get('mtime'):
+        return True
+    return _file_digest(path) == known_file.get('sha256')
+
+
+def _sync_file(url, path, damaged=False):
+    if damaged:
+        # A linked copy shares its data with the cache, which is then damaged as well
+        blob_cache.remove(url)
+    digest = blob_cache.link(url, path)
+    return _file_record(url, path, digest)
+
+
+def sync_user_data(token, directory=".", manifest_path=None, max_workers=DOWNLOAD_WORKERS, verify=False):
+    """Bring `directory` up to date with the analysis API. Returns counts of what was done.
+
+    The manifest is saved after every page that changed, so an interrupted sync continues where it stopped.
+    With `verify`, every page is requested in full and every local file is hashed and compared with the
+    manifest, see `is_intact`.
+    """
+    manifest_path = manifest_path or os.path.join(directory, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    pages = None if verify else manifest.setdefault('pages', {})
+    saved_pages = copy.deepcopy(pages)
+    summary = {'users': 0, 'new_users': 0, 'downloaded': 0, 'unchanged': 0, 'damaged': 0, 'unchanged_pages': 0}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def sync_file(futures, entry, name, url, known_file, changed):
+            # Returns whether the manifest entry of the file changed
+            path = os.path.join(directory, name)
+            damaged = False
+            if not changed and os.path.exists(path):
+                if is_intact(path, known_file, verify):
+                    # Record the current size and modification time, so the file is not hashed again
+                    entry['files'][name] = _file_record(url, path, known_file['sha256'])
+                    summary['unchanged'] += 1
+                    return entry['files'][name] != known_file
+                print(f"{path} does not match the manifest, downloading it again")
+                summary['damaged'] += 1
+                damaged = True
+            futures.append((entry, name, executor.submit(_sync_file, url, path, damaged)))
+            return True
+
+        for page in iter_user_pages(token, pages=pages):
+            futures = []
+            if isinstance(page, UnchangedPage):
+                # Same users and URLs as last time; only the local files are checked
+                summary['unchanged_pages'] += 1
+                changed = False
+                for user_id in page.user_ids:
+                    summary['users'] += 1
+                    entry = manifest['users'][user_id]
+                    for name, known_file in list(entry['files'].items()):
+                        changed |= sync_file(futures, entry, name, known_file['url'], known_file, False)
+            else:
+                changed = True
+                for user_data in page:
+                    summary['users'] += 1
+                    known = manifest['users'].get(user_data.userId)
+                    if known is None:
+                        summary['new_users'] += 1
+                        known = {'files': {}}
+                    start_time_changed = known.get('fifStartTime') != user_data.fifStartTime
+                    entry = {'fifStartTime': user_data.fifStartTime, 'files': dict(known['files'])}
+                    manifest['users'][user_data.userId] = entry
+
+                    for name, url in user_files(user_data):
+                        known_file = known['files'].get(name)
+                        sync_file(futures, entry, name, url, known_file,
+                                  known_file is None or known_file['url'] != url
+                                  or (start_time_changed and name.endswith('.fif')))
+
+            for entry, name, future in futures:
+                entry['files'][name] = future.result()
+                summary['downloaded'] += 1
+            if changed:
+                save_manifest(manifest, manifest_path)
+                saved_pages = copy.deepcopy(pages)
+
+    if pages != saved_pages:
+        # An empty last page, or pages that no longer exist, are only seen after the last yielded one
+        save_manifest(manifest, manifest_path)
+    return summary
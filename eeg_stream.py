@@ -0,0 +1,272 @@
+"""Incremental on-disk storage for EEG recordings.
+
+While a session is running, `EEGDrain` periodically moves new sample blocks out
+of the brainaccess acquisition buffer and appends them to an `EEGDiskStore`: a
+float32 sample file (sample-major, so appending is a plain file write), the
+`mne.Info` of the device and a small JSON sidecar with the sample count,
+annotations and any extra session metadata.
+
+Stopping a session only has to drain the last few blocks and write the sidecar,
+so memory stays flat and stop latency does not depend on session length. The
+finished recording is opened as a lazy `mne.io.BaseRaw` that reads straight from
+the sample file, e.g. for `raw.save()`.
+"""
+import json
+import os
+import threading
+import time
+
+import mne
+import numpy as np
+
+from annotation_queue import SampleClock
+from metrics import span
+
+SAMPLE_DTYPE = np.dtype('<f4')
+
+
+class EEGDiskStore:
+    def __init__(self, path, info, n_samples=0, annotations=None, extra=None):
+        self.path = path
+        self.info = info
+        self.n_samples = n_samples
+        self.annotations = annotations if annotations is not None else {'onset': [], 'description': []}
+        self.extra = extra if extra is not None else {}
+        self._file = None
+
+    @property
+    def data_path(self):
+        return self.path + '.dat'
+
+    @property
+    def info_path(self):
+        return self.path + '-info.fif'
+
+    @property
+    def meta_path(self):
+        return self.path + '.json'
+
+    @property
+    def n_channels(self):
+        return len(self.info.ch_names)
+
+    @property
+    def sfreq(self):
+        return self.info['sfreq']
+
+    @classmethod
+    def create(cls, path, info):
+        """Start a new, empty store at `path` (without extension) for channels described by `info`."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        store = cls(path, info)
+        mne.io.write_info(store.info_path, info)
+        store._file = open(store.data_path, 'wb')
+        store._write_meta()
+        return store
+
+    @classmethod
+    def open(cls, path):
+        """Open a store previously written with `create`."""
+        with open(path + '.json') as meta_file:
+            meta = json.load(meta_file)
+        info = mne.io.read_info(path + '-info.fif', verbose=False)
+        return cls(path, info, n_samples=meta['n_samples'], annotations=meta['annotations'],
+                   extra=meta['extra'])
+
+    def append(self, block):
+        """Append a (n_channels, n_samples) block of samples."""
+        if block.shape[0] != self.n_channels:
+            raise ValueError(f'Expected {self.n_channels} channels, got {block.shape[0]}')
+        self._file.write(np.ascontiguousarray(block.T, dtype=SAMPLE_DTYPE))
+        self.n_samples += block.shape[1]
+
+    def add_annotation(self, onset, description):
+        self.annotations['onset'].append(float(onset))
+        self.annotations['description'].append(description)
+
+    def flush(self):
+        self._file.flush()
+        self._write_meta()
+
+    def finalize(self):
+        """Flush the last samples and close the sample file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {'n_samples': self.n_samples, 'annotations': self.annotations, 'extra': self.extra}
+        # Write next to the final file and swap, so a crash never leaves a half-written sidecar
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, self.meta_path)
+
+    def get_data(self):
+        """Return all samples as a read-only (n_channels, n_samples) view of the sample file."""
+        if self.n_samples == 0:
+            return np.empty((self.n_channels, 0), dtype=SAMPLE_DTYPE)
+        samples = np.memmap(self.data_path, dtype=SAMPLE_DTYPE, mode='r',
+                            shape=(self.n_samples, self.n_channels))
+        return samples.T
+
+    def to_raw(self):
+        """Return the recording as a lazily loaded mne Raw object."""
+        return MemmapRaw(self)
+
+    def remove(self):
+        self.finalize()
+        for file_path in (self.data_path, self.info_path, self.meta_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+class MemmapRaw(mne.io.BaseRaw):
+    """mne Raw object that reads its samples from an `EEGDiskStore` on demand."""
+
+    def __init__(self, store):
+        if store.n_samples == 0:
+            raise ValueError(f'No samples recorded in {store.data_path}')
+        super().__init__(store.info.copy(), preload=False, last_samps=[store.n_samples - 1],
+                         filenames=[store.data_path], raw_extras=[{'n_channels': store.n_channels}],
+                         orig_format='single', verbose=False)
+        onset = store.annotations['onset']
+        self.set_annotations(mne.Annotations(onset, np.zeros(len(onset)), store.annotations['description']))
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        n_channels = self._raw_extras[fi]['n_channels']
+        samples = np.memmap(self._filenames[fi], dtype=SAMPLE_DTYPE, mode='r').reshape(-1, n_channels)
+        block = samples[start:stop].T[idx]
+        if mult is not None:
+            data[:] = mult @ block
+        else:
+            data[:] = block * cals
+
+
+class ArrivalTrackingList(list):
+    """The block list of an `acquisition.EEG` buffer that also records when the latest block arrived.
+
+    `last_arrival` is the monotonic time of the latest `append` and the total number of samples
+    appended up to and including that block, counted from `n_before` samples that arrived earlier.
+    """
+
+    def __init__(self, blocks=(), n_before=0):
+        super().__init__(blocks)
+        self.n_appended = n_before + sum(block.shape[1] for block in self)
+        self.last_arrival = None
+
+    def append(self, block):
+        super().append(block)
+        self.n_appended += block.shape[1]
+        self.last_arrival = (time.monotonic(), self.n_appended)
+
+
+class EEGDrain(threading.Thread):
+    """Background thread that moves samples from an `acquisition.EEG` buffer into an `EEGDiskStore`.
+
+    Parameters:
+    - eeg: a started brainaccess `acquisition.EEG` in accumulate mode.
+    - store: the `EEGDiskStore` to append to.
+    - interval: seconds between drains.
+    - release: drop drained blocks from the acquisition buffer so its memory stays flat.
+      Note that `eeg.get_mne()` then only returns samples that have not been drained yet.
+    - consumers: callables that are passed every drained (n_channels, n_times) block after it was
+      stored, e.g. a `live_dsp.LiveDSP`.
+    - annotation_queue: optional `annotation_queue.AnnotationQueue`; its events are stored as
+      annotations at the sample positions given by `clock`.
+    - annotation_consumers: callables that are passed `(onset, description)` of every stored event.
+    """
+
+    def __init__(self, eeg, store, interval=0.5, release=True, consumers=(), annotation_queue=None,
+                 annotation_consumers=()):
+        super().__init__(daemon=True)
+        self.eeg = eeg
+        self.store = store
+        self.interval = interval
+        self.release = release
+        self.consumers = list(consumers)
+        self.annotation_queue = annotation_queue
+        self.annotation_consumers = list(annotation_consumers)
+        # A simulated device can produce samples faster than real time
+        self.clock = SampleClock(store.sfreq, speed=getattr(eeg, 'speed', 0) or 1.0)
+        self._pending_annotations = []
+        self._cursor = 0
+        with eeg.lock:
+            self._track_arrivals()
+        self.channels_indexes = list(getattr(eeg, 'channels_indexes', {}).values())
+        self._stop_event = threading.Event()
+
+    def _track_arrivals(self):
+        # Arrival times of the blocks anchor annotation times to samples. Called with eeg.lock held, on every
+        # drain, because brainaccess may replace the block list, e.g. when the acquisition starts.
+        blocks = self.eeg.data.data
+        if not isinstance(blocks, ArrivalTrackingList):
+            blocks = self.eeg.data.data = ArrivalTrackingList(blocks, n_before=self.store.n_samples)
+            self._cursor = 0
+        return blocks
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.drain()
+
+    def drain(self):
+        """Append all blocks that arrived since the last drain. Returns the number of new samples."""
+        with self.eeg.lock:
+            blocks = self._track_arrivals()
+            end = len(blocks)
+            new_blocks = blocks[self._cursor:end]
+            if self.release:
+                del blocks[:end]
+                self._cursor = 0
+            else:
+                self._cursor = end
+            last_arrival = getattr(blocks, 'last_arrival', None)
+        if last_arrival is not None:
+            self.clock.add_anchor(*last_arrival)
+        self.store_annotations()
+        if not new_blocks:
+            return 0
+
+        with span('drain') as drain_span:
+            block = np.concatenate(new_blocks, axis=1)
+            if self.channels_indexes:
+                block = block[self.channels_indexes]
+            self.store.append(block)
+            self.store.flush()
+            drain_span.add_bytes(block.shape[0] * block.shape[1] * SAMPLE_DTYPE.itemsize)
+        for consumer in self.consumers:
+            try:
+                consumer(block)
+            except Exception as e:
+                # Live processing must never stop the recording
+                print(f'EEG consumer {consumer!r} failed: {e}')
+        return block.shape[1]
+
+    def store_annotations(self):
+        """Store the queued annotations. Events are kept until the clock has seen the first samples."""
+        if self.annotation_queue is None:
+            return
+        self._pending_annotations.extend(self.annotation_queue.pop_all())
+        if not self.clock.ready:
+            return
+        for event in self._pending_annotations:
+            onset = self.clock.to_seconds(event.time)
+            self.store.add_annotation(onset, event.description)
+            for consumer in self.annotation_consumers:
+                try:
+                    consumer(onset, event.description)
+                except Exception as e:
+                    print(f'Annotation consumer {consumer!r} failed: {e}')
+        self._pending_annotations = []
+
+    def stop(self):
+        """Stop the thread and drain whatever is still buffered."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.drain()
+        if self._pending_annotations:
+            print(f'Dropped {len(self._pending_annotations)} annotations of a recording without samples')
@@ -0,0 +1,250 @@
+"""Persistent store of computed features, so analysis runs only compute what is new.
+
+Features are kept in a SQLite file, one row per feature kind, recording,
+question and parameter set:
+
+- the recording is the SHA-256 of the input file (the FIF recording or the
+  audio clip), so a changed or re-uploaded file is computed again while the same
+  file under another name or URL is not;
+- the parameter set is a hash of every setting the result depends on, e.g. the
+  preprocessing filter band and order, the segmentation and the bands, plus a
+  version that is raised when the computation itself changes. Changing any of
+  them gives new keys, so stale results are never returned.
+
+The digest of a file is remembered by path, size and modification time, so
+unchanged files are not hashed again either.
+
+`eeg_band_features` and `acoustic_features` compute and memoize the features
+of one recording, `band_features_of_users` those of a whole study;
+`FeatureStore.query` returns stored features across users. The analysis scripts
+and notebooks share the store at FEATURE_STORE_PATH.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import mne
+from scipy.signal import welch
+
+from live_dsp import BANDS
+from preprocessing import default_preprocessor
+from segmentation import QRSegmenter
+
+# The store of the analysis scripts, notebooks and batch_acoustics
+FEATURE_STORE_PATH = os.getenv('FEATURE_STORE_PATH', 'features.sqlite3')
+
+# Raise when the computation of a kind of feature changes, so stored results are recomputed
+BAND_FEATURES_VERSION = 1
+# 2: clips are decoded with audio_io (ffmpeg, float32 mono) instead of by parselmouth
+ACOUSTIC_FEATURES_VERSION = 2
+
+# How `batch_acoustics.analyze_clip` decodes clips, see `audio_io.decode_audio`; part of the acoustic parameters
+ACOUSTIC_DECODING = {'sample_rate': None, 'mono': True}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS features (
+    kind TEXT NOT NULL,
+    recording TEXT NOT NULL,
+    question_id TEXT NOT NULL,
+    params TEXT NOT NULL,
+    user_id TEXT,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (kind, recording, question_id, params)
+);
+CREATE INDEX IF NOT EXISTS features_by_user ON features (kind, params, user_id);
+CREATE TABLE IF NOT EXISTS file_digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    digest TEXT NOT NULL
+);
+"""
+
+
+def params_key(params):
+    """Short hash of a JSON-serializable parameter set; equal settings give equal keys."""
+    encoded = json.dumps(params, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class FeatureStore:
+    """Memoized features by (kind, recording digest, question ID, parameter set).
+
+    Parameters:
+    - path: the SQLite file.
+    """
+
+    def __init__(self, path='features.sqlite3'):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def digest(self, path):
+        """SHA-256 of the file at `path`, only read again when its size or modification time changed."""
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        with self._connect() as conn:
+            row = conn.execute('SELECT size, mtime, digest FROM file_digests WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+        digest = file_digest(path)
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO file_digests (path, size, mtime, digest) VALUES (?, ?, ?, ?)',
+                         (path, stat.st_size, stat.st_mtime, digest))
+        return digest
+
+    def get(self, kind, recording, params, question_ids=None):
+        """Stored values of a recording as {question ID: value}, optionally only for `question_ids`."""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT question_id, value FROM features WHERE kind = ? AND recording = ? '
+                                'AND params = ?', (kind, recording, params)).fetchall()
+        values = {question_id: json.loads(value) for question_id, value in rows}
+        if question_ids is not None:
+            wanted = {str(question_id) for question_id in question_ids}
+            values = {question_id: value for question_id, value in values.items() if question_id in wanted}
+        return values
+
+    def put_many(self, kind, recording, params, values, user_id=None):
+        """Store {question ID: value} of one recording; values must be JSON serializable."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO features (kind, recording, question_id, params, user_id, value, '
+                             'created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [(kind, recording, str(question_id), params, user_id, json.dumps(value), now)
+                              for question_id, value in values.items()])
+
+    def put(self, kind, recording, question_id, params, value, user_id=None):
+        self.put_many(kind, recording, params, {question_id: value}, user_id=user_id)
+
+    def query(self, kind, params=None, user_ids=None):
+        """Stored features of many recordings as a list of dicts with user_id, question_id, recording and value.
+
+        Parameters:
+        - params: only this parameter set (a key from `params_key`); by default all of them.
+        - user_ids: only these users.
+        """
+        sql = 'SELECT user_id, question_id, recording, params, value FROM features WHERE kind = ?'
+        args = [kind]
+        if params is not None:
+            sql += ' AND params = ?'
+            args.append(params)
+        if user_ids is not None:
+            user_ids = list(user_ids)
+            sql += f' AND user_id IN ({",".join("?" * len(user_ids))})'
+            args.extend(user_ids)
+        with self._connect() as conn:
+            rows = conn.execute(sql + ' ORDER BY user_id, question_id', args).fetchall()
+        return [{'user_id': user_id, 'question_id': question_id, 'recording': recording, 'params': key,
+                 'value': json.loads(value)} for user_id, question_id, recording, key, value in rows]
+
+
+def segment_band_power(data, sfreq, bands=BANDS):
+    """Mean power spectral density (Welch, 2 s windows) of every row of `data` in each band.
+
+    Returns {band: list with one value per row}.
+    """
+    nperseg = min(data.shape[-1], int(2 * sfreq))
+    freqs, psd = welch(data, fs=sfreq, nperseg=nperseg, axis=-1)
+    power = {}
+    for band, (low, high) in bands.items():
+        in_band = (freqs >= low) & (freqs < high)
+        power[band] = psd[:, in_band].mean(axis=-1).tolist() if in_band.any() else [None] * len(data)
+    return power
+
+
+def band_features_params(preprocessor=default_preprocessor, segmenter=None, bands=BANDS):
+    segmenter = segmenter or QRSegmenter()
+    return params_key({'preprocessing': preprocessor.params(), 'segmentation': segmenter.params(),
+                       'bands': bands, 'version': BAND_FEATURES_VERSION})
+
+
+def eeg_band_features(store, fif_path, user_id=None, preprocessor=default_preprocessor, segmenter=None, bands=BANDS,
+                      raw=None):
+    """Band power of every question segment of a FIF recording, as {question ID: {'channels', 'bands'}}.
+
+    Segments too short for a spectrum have the value None. Only the annotations are read when all
+    segments are in the store; otherwise the recording is preprocessed and segmented once and the
+    missing segments are computed and stored. A caller that already has the recording preprocessed
+    by `preprocessor` can pass it as `raw`, so it is not read again.
+    """
+    segmenter = segmenter or QRSegmenter()
+    recording = store.digest(fif_path)
+    params = band_features_params(preprocessor, segmenter, bands)
+    preprocessed = raw is not None
+    if not preprocessed:
+        raw = mne.io.read_raw_fif(fif_path, preload=False, verbose=False)
+    labels = [str(label) for label, _, _ in segmenter.find_pairs(raw.annotations)]
+    features = store.get('eeg_bands', recording, params, question_ids=labels)
+    if all(label in features for label in labels):
+        return features
+
+    if not preprocessed:
+        preprocessor.apply(raw)
+    new_features = {}
+    for segment in segmenter.segment_raw(raw):
+        label = str(segment.label)
+        if label in features:
+            continue
+        # Stored as None too, so the recording is not preprocessed again for a segment that has no value
+        new_features[label] = None
+        if segment.data.shape[-1] > 1:
+            new_features[label] = {'channels': raw.ch_names,
+                                   'bands': segment_band_power(segment.data, raw.info['sfreq'], bands)}
+    store.put_many('eeg_bands', recording, params, new_features, user_id=user_id)
+    features.update(new_features)
+    return features
+
+
+def band_features_of_users(store, users, preprocessor=default_preprocessor, segmenter=None, bands=BANDS):
+    """Band features of the recordings of `fetch_data.UserData` objects, as {userId: {question ID: value}}.
+
+    Recordings whose features are all stored are only read for their annotations, so rerunning a
+    report over a whole study only computes the sessions that are new.
+    """
+    return {user_data.userId: eeg_band_features(store, user_data.fifPath, user_data.userId, preprocessor,
+                                                segmenter, bands)
+            for user_data in users}
+
+
+def acoustic_features_params(threshold=40, min_silence_duration=0.5):
+    return params_key({'threshold': threshold, 'min_silence_duration': min_silence_duration,
+                       'decoding': ACOUSTIC_DECODING, 'version': ACOUSTIC_FEATURES_VERSION})
+
+
+def acoustic_features(store, path, question_id, user_id=None, threshold=40, min_silence_duration=0.5):
+    """Acoustic features of one answer clip as a dict, see `batch_acoustics.analyze_clip`; memoized in `store`."""
+    from batch_acoustics import analyze_clip
+
+    recording = store.digest(path)
+    params = acoustic_features_params(threshold, min_silence_duration)
+    stored = store.get('acoustic', recording, params, question_ids=[question_id])
+    if str(question_id) in stored:
+        return stored[str(question_id)]
+    row = analyze_clip(user_id, question_id, path, threshold, min_silence_duration)
+    if row['error'] is None:
+        store.put('acoustic', recording, question_id, params, row, user_id=user_id)
+    return row
+
+
+# The store shared by the analysis scripts and notebooks
+feature_store = FeatureStore(FEATURE_STORE_PATH)
+
@@ -1,69 +1,89 @@
-import io
 import os
-from urllib.parse import urlencode
+import shutil
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import noisereduce as nr
-import numpy as np
 import requests
 from dotenv import load_dotenv
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
-from scipy.signal import butter, lfilter
+from requests.adapters import HTTPAdapter
+
+from audio_cleaning import default_cleaner
+from audio_io import audio_cache, decode_audio, encode_audio, load_audio
+from blob_cache import BlobCache
+from token_provider import TokenProvider
 
 # Load environment variables
 load_dotenv()
 
+# Number of files downloaded at the same time
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '8'))
 
-def butter_bandpass(lowcut, highcut, fs, order=5):
-    nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
-    b, a = butter(order, [low, high], btype='band')
-    return b, a
-
+# One session for all requests, so connections to the API and storage are reused
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS))
+session.mount('http://', HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS))
 
-def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
-    b, a = butter_bandpass(lowcut, highcut, fs, order=order)
-    y = lfilter(b, a, data)
-    return y
+# Clean every answer clip (noise reduction, band pass, silence removal) when it is accessed through
+# AudioData.audio or .audioBlob; CLEAN_AUDIO=false turns it off. AudioData.audioPath is always the
+# downloaded clip. Cleaning removes pauses, so the samples of a cleaned clip no longer follow its start
+# time: code that places the clip in time, like alignment.AlignmentEngine.align, reads audioPath or
+# passes clean=False.
+CLEAN_AUDIO = os.getenv('CLEAN_AUDIO', 'true').lower() != 'false'
 
+# Users requested per page from the analysis API, 0 requests all of them at once
+ANALYSIS_PAGE_SIZE = int(os.getenv('ANALYSIS_PAGE_SIZE', '100'))
 
-def clean_audio_blob(audio_blob):
-    # Convert audio blob to AudioSegment
-    audio_segment = AudioSegment.from_mp3(io.BytesIO(audio_blob))
+# Access token for the analysis API, shared by every caller in this process
+token_provider = TokenProvider.from_env(session)
 
-    # Noise Reduction
-    audio_data = np.array(audio_segment.get_array_of_samples())
-    cleaned_audio = nr.reduce_noise(y=audio_data, sr=audio_segment.frame_rate)
+# Downloaded files are kept here, so analysis runs never download the same file twice
+blob_cache = BlobCache(os.getenv('BLOB_CACHE_DIR', 'blob_cache'), session,
+                       max_bytes=int(os.getenv('BLOB_CACHE_MAX_MB', '4096')) * 1024 * 1024,
+                       revalidate=os.getenv('BLOB_CACHE_REVALIDATE', 'false').lower() == 'true')
 
-    # Filtering
-    cleaned_audio = butter_bandpass_filter(cleaned_audio, 80, 250, audio_segment.frame_rate)
 
-    # Normalization
-    cleaned_audio = cleaned_audio / np.max(np.abs(cleaned_audio), axis=0)
+def clean_audio(audio, cleaner=default_cleaner):
+    """Noise reduction, filtering (80-250 Hz), normalization and silence removal of a decoded clip, block by block.
 
-    # Silence Removal
-    audio_segment = AudioSegment(cleaned_audio.tobytes(), frame_rate=audio_segment.frame_rate,
-                                 sample_width=audio_segment.sample_width, channels=audio_segment.channels)
-    chunks = split_on_silence(audio_segment, min_silence_len=500, silence_thresh=-40)
-    cleaned_audio_segment = sum(chunks)
+    Returns an `Audio`, see `audio_cleaning.AudioCleaner`.
+    """
+    return cleaner.clean(audio)
 
-    # Convert back to blob
-    audio_buffer = io.BytesIO()
-    cleaned_audio_segment.export(audio_buffer, format="mp3")
 
-    return audio_buffer.getvalue()
+def clean_audio_blob(audio_blob):
+    # Decode once, clean the array and encode it back to MP3
+    return encode_audio(clean_audio(decode_audio(audio_blob)), format="mp3")
 
 
 class AudioData:
-    def __init__(self, questionId, audioUrl, start):
+    def __init__(self, questionId, audioUrl, start, clean=None):
         self.questionId = questionId
         self.audioUrl = audioUrl
         self.start = start
-        # For filtering audio blob use below 2 lines
-        # raw_audio_blob = requests.get(audioUrl).content
-        # self.audioBlob = clean_audio_blob(raw_audio_blob)
-        self.audioBlob = requests.get(audioUrl).content
+        # Return the cleaned clip from audio and audioBlob; use clean=False to keep the clip's timing
+        self.clean = CLEAN_AUDIO if clean is None else clean
+
+    @property
+    def audioPath(self):
+        # Downloaded on first access
+        return blob_cache.get_path(self.audioUrl)
+
+    @property
+    def audioBlob(self):
+        if self.clean:
+            return encode_audio(self.audio, format="mp3")
+        return blob_cache.get(self.audioUrl)
+
+    @property
+    def audio(self):
+        # Decoded samples, cached; cached downloads are named after their SHA-256
+        path = self.audioPath
+        digest = os.path.basename(path)
+        if not self.clean:
+            return load_audio(path, digest=digest)
+        # The cleaned clip is cached too, keyed by the cleaning settings
+        key = f'{digest}-clean-{default_cleaner.key()}'
+        return audio_cache.get_or_create(key, lambda: clean_audio(load_audio(path, digest=digest)))
 
     def __str__(self):
         return f"AudioData(questionId={self.questionId}, audioUrl={self.audioUrl}, start={self.start})"
@@ -82,7 +102,19 @@ class UserData:
         self.audio = [AudioData(**a) for a in audio]
         self.fifUrl = fifUrl
         self.fifStartTime = fifStartTime
-        self.fifFileBlob = requests.get(fifUrl).content
+
+    @property
+    def urls(self):
+        return [self.fifUrl] + [audio_data.audioUrl for audio_data in self.audio]
+
+    @property
+    def fifPath(self):
+        # Downloaded on first access
+        return blob_cache.get_path(self.fifUrl)
+
+    @property
+    def fifFileBlob(self):
+        return blob_cache.get(self.fifUrl)
 
     def __str__(self):
         audio_str = ', '.join(str(a) for a in self.audio)
@@ -97,48 +129,177 @@ class UserData:
         }
 
 
+# A page of users the analysis API reported as unchanged, see iter_user_pages
+UnchangedPage = namedtuple('UnchangedPage', ['number', 'user_ids'])
+
+
 def get_access_token():
-    token_url = f"{os.getenv('KEYCLOAK_URL')}/realms/{os.getenv('REALM')}/protocol/openid-connect/token"
-    data = {
-        'client_id': os.getenv('CLIENT_ID'),
-        'client_secret': os.getenv('CLIENT_SECRET'),
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(token_url, headers={'Content-Type': 'application/x-www-form-urlencoded'},
-                             data=urlencode(data))
-    return response.json().get('access_token')
+    # Cached until shortly before it expires, so this only reaches Keycloak when a refresh is due
+    return token_provider.get_token()
 
 
-def get_user_data(token):
+def iter_user_pages(token, page_size=ANALYSIS_PAGE_SIZE, pages=None):
+    """Yield the users of the analysis data set page by page, without downloading any of their files.
+
+    Pages are requested with Spring's `page`/`size` parameters. A server that does not page just
+    returns every user in the first response, which is then the only page. `page_size=0` requests
+    everything at once.
+
+    `pages` is a dict, e.g. kept in a manifest, that remembers the ETag and the user IDs of every page
+    and is updated in place. Pages are then requested with If-None-Match, and a page the server reports
+    as unchanged (304) is yielded as an `UnchangedPage` with the user IDs it had, instead of the users.
+    """
     url = f"{os.getenv('SPRING_URL')}/api/users/analysisData"
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get(url, headers=headers)
-    return [UserData(**user_data) for user_data in response.json()]
+    page = 0
+    first_user_id = None
+    while True:
+        params = {'page': page, 'size': page_size} if page_size else None
+        known = (pages or {}).get(str(page))
+        if known is not None and known['size'] != page_size:
+            known = None
+        headers = {'If-None-Match': known['etag']} if known else {}
+
+        response = session.get(url, headers={'Authorization': f'Bearer {token}', **headers}, params=params)
+        if response.status_code == 401 and token_provider.invalidate(token):
+            # The cached token was revoked or expired early, get a new one and try once more
+            token = get_access_token()
+            response = session.get(url, headers={'Authorization': f'Bearer {token}', **headers}, params=params)
+
+        if known is not None and response.status_code == 304:
+            user_ids, last_page = known['users'], known['last']
+            if not user_ids or (page > 0 and user_ids[0] == first_user_id):
+                break
+            first_user_id = first_user_id or user_ids[0]
+            yield UnchangedPage(page, user_ids)
+        else:
+            response.raise_for_status()
+            body = response.json()
+
+            # Either a Spring Page object or a plain list
+            items = body['content'] if isinstance(body, dict) else body
+            if isinstance(body, dict):
+                last_page = body.get('last', True)
+            else:
+                last_page = not page_size or len(items) < page_size
+            if pages is not None:
+                etag = response.headers.get('ETag')
+                if etag:
+                    pages[str(page)] = {'etag': etag, 'size': page_size, 'last': last_page,
+                                        'users': [item['userId'] for item in items]}
+                else:
+                    pages.pop(str(page), None)
+            if not items:
+                break
+            if page > 0 and items[0]['userId'] == first_user_id:
+                # The server ignored the paging parameters and sent everything again
+                break
+            first_user_id = first_user_id or items[0]['userId']
+            yield [UserData(**user_data) for user_data in items]
+
+        if last_page:
+            break
+        page += 1
+
+    if pages is not None:
+        # Pages after the last one are gone, e.g. when users were deleted
+        for number in [number for number in pages if int(number) > page]:
+            del pages[number]
+
+
+def get_user_list(token):
+    """Return the users of the analysis data set without downloading any of their files."""
+    return [user_data for page in iter_user_pages(token) for user_data in page]
+
+
+def iter_user_data(token, max_workers=DOWNLOAD_WORKERS):
+    """Download every user's files into the cache and yield each user as soon as all of theirs are on disk.
+
+    Pages of users are requested from the analysis API while earlier pages download, and the next page is
+    only requested once fewer than a few files per worker are still queued. At most `max_workers` files are
+    downloaded at the same time, each streamed to disk in chunks. Files that are already cached are not
+    downloaded again. Users are yielded in the order their downloads finish. A user's files are pinned in
+    the cache until the caller asks for the next user, so downloads for later users cannot evict them
+    before they are read. When the caller stops early, queued downloads are cancelled.
+    """
+    max_queued = 4 * max_workers
+    pages = iter_user_pages(token)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    owners = {}
+    remaining = {}
+    user_futures = {}
+    pinned = set()
+
+    def finished(done):
+        # Users all of whose files are on disk once the downloads in done are counted
+        users = []
+        for future in done:
+            future.result()
+            user_data = owners.pop(future)
+            remaining[user_data.userId] -= 1
+            if remaining[user_data.userId] == 0:
+                users.append(user_data)
+        return users
+
+    try:
+        exhausted = False
+        while True:
+            if not exhausted and len(owners) <= max_queued:
+                page = next(pages, None)
+                if page is None:
+                    exhausted = True
+                else:
+                    for user_data in page:
+                        remaining[user_data.userId] = len(user_data.urls)
+                        for url in user_data.urls:
+                            future = executor.submit(blob_cache.get_digest, url, True)
+                            owners[future] = user_data
+                            user_futures.setdefault(user_data.userId, []).append(future)
+                            pinned.add(future)
+            if exhausted and not owners:
+                return
+            # Only block while there is no page to request; otherwise hand out the users that are ready
+            block = exhausted or len(owners) > max_queued
+            done, _ = wait(owners, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for user_data in finished(done):
+                yield user_data
+                for user_future in user_futures.pop(user_data.userId):
+                    blob_cache.unpin(user_future.result())
+                    pinned.discard(user_future)
+    finally:
+        pages.close()
+        # Drop the queued downloads and wait for the running ones, e.g. when the caller stopped early
+        executor.shutdown(cancel_futures=True)
+        # Files of users that were not yielded or not finished
+        for future in pinned:
+            if not future.cancelled() and future.exception() is None:
+                blob_cache.unpin(future.result())
+
+
+def get_user_data(token):
+    return list(iter_user_data(token))
 
 
-def save_files(user_data: UserData):
+def save_files(user_data: UserData, directory="."):
     # Save FIF file
-    with open(f"{user_data.userId}.fif", "wb") as fif_file:
-        fif_file.write(user_data.fifFileBlob)
+    shutil.copyfile(user_data.fifPath, os.path.join(directory, f"{user_data.userId}.fif"))
 
     # Save audio files
     for audio_data in user_data.audio:
-        with open(f"{user_data.userId}_{audio_data.questionId}.mp3", "wb") as audio_file:
-            audio_file.write(audio_data.audioBlob)
+        shutil.copyfile(audio_data.audioPath, os.path.join(directory, f"{user_data.userId}_{audio_data.questionId}.mp3"))
 
 
 def main():
+    # Imported here because data_sync builds on this module
+    from data_sync import sync_user_data
+
     load_dotenv()
     token = get_access_token()
-    user_data_list = get_user_data(token)
-
-    # Save files for each user data
-    for user_data in user_data_list:
-        save_files(user_data)
 
-    # user_data_dicts = [user_data.to_dict() for user_data in user_data_list]
-    # pretty_json = json.dumps(user_data_dicts, indent=4)
-    # print(pretty_json)
+    # Only download users and files that are new or changed since the last run
+    summary = sync_user_data(token, directory=".")
+    print(f"Synced {summary['users']} users ({summary['unchanged_pages']} pages unchanged): "
+          f"{summary['downloaded']} files downloaded, {summary['unchanged']} unchanged, "
+          f"{summary['damaged']} damaged copies replaced")
     print("Fetched all data from the API. Done")
 
 
@@ -147,15 +308,19 @@ def fetch_user_data():
     return get_user_data(token)
 
 
+def fetch_first_user():
+    # Only the first user's files are downloaded, and only when they are accessed
+    token = get_access_token()
+    return next(iter_user_pages(token))[0]
+
+
 def fetch_first_user_fif_blob():
-    user_data_list = fetch_user_data()
-    first_user_data = user_data_list[0]
+    first_user_data = fetch_first_user()
     return first_user_data.fifFileBlob
 
 
 def fetch_first_user_audio():
-    user_data_list = fetch_user_data()
-    first_user_data = user_data_list[0]
+    first_user_data = fetch_first_user()
     return [audio_data.audioBlob for audio_data in first_user_data.audio]
 
 
@@ -0,0 +1,225 @@
+"""Persistent background job queue.
+
+Jobs are stored in a local SQLite database and run on a bounded thread pool. A
+job handler is split into named stages with `Job.run_stage`; the result and
+timing of every finished stage is persisted, so when a job is retried (after an
+error or after the process restarted) the stages that already completed are
+skipped and only the pending work is redone.
+
+A job that has failed for good is passed to the failure handler of its kind,
+e.g. to clean up the files it would have removed on success.
+
+Payload fields named in `secret_fields`, such as access tokens, are only kept
+while a job can still run: they are removed from the stored payload when the
+job is done or has failed for good.
+"""
+import json
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import span
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stages TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class Job:
+    def __init__(self, queue, job_id, kind, payload, stages):
+        self.queue = queue
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.stages = stages
+        # Stages may run in parallel threads
+        self._lock = threading.Lock()
+
+    def run_stage(self, name, func):
+        """Run `func` as stage `name` and return its result.
+
+        If the stage already completed in an earlier attempt, its stored result is returned without
+        calling `func` again. Results must be JSON serializable.
+        """
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is not None and stage['status'] == DONE:
+                return stage['result']
+            stage = {'status': RUNNING, 'started_at': time.time(), 'duration': None, 'result': None}
+            self.stages[name] = stage
+        self._save()
+        start = time.perf_counter()
+        try:
+            with span('job_stage', kind=self.kind, job_stage=name):
+                result = func()
+        except Exception:
+            self._update(stage, status=FAILED, duration=time.perf_counter() - start)
+            raise
+        self._update(stage, status=DONE, duration=time.perf_counter() - start, result=result)
+        return result
+
+    def _update(self, stage, **values):
+        with self._lock:
+            stage.update(values)
+        self._save()
+
+    def _save(self):
+        with self._lock:
+            stages = json.dumps(self.stages)
+        self.queue._save_stages(self.id, stages)
+
+
+class JobQueue:
+    """SQLite backed job queue.
+
+    Parameters:
+    - db_path: path of the SQLite database file.
+    - handlers: dict mapping a job kind to a function that takes a `Job`.
+    - max_workers: number of jobs that run at the same time.
+    - max_attempts: how often a failing job is tried before it is marked as failed.
+    - retry_delay: seconds before the first retry, doubled for every further attempt.
+    - secret_fields: payload fields removed from the database when a job is done or has failed.
+    - failure_handlers: dict mapping a job kind to a function that takes the `Job` and the exception of
+      its last attempt, called once the job has failed for good.
+    """
+
+    def __init__(self, db_path, handlers, max_workers=2, max_attempts=5, retry_delay=5.0, secret_fields=(),
+                 failure_handlers=None):
+        self.db_path = db_path
+        self.handlers = handlers
+        self.failure_handlers = failure_handlers or {}
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.secret_fields = tuple(secret_fields)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        with self._lock, self._connect() as conn:
+            conn.execute(_SCHEMA)
+            # Jobs that finished before the fields were secret, or before the process stopped
+            rows = conn.execute('SELECT id FROM jobs WHERE status IN (?, ?)', (DONE, FAILED)).fetchall()
+            for (job_id,) in rows:
+                self._remove_secrets(conn, job_id)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def submit(self, kind, payload):
+        """Store a new job and schedule it. Returns the job ID."""
+        if kind not in self.handlers:
+            raise ValueError(f'No handler registered for job kind {kind!r}')
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT INTO jobs (id, kind, payload, status, stages, created_at, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (job_id, kind, json.dumps(payload), PENDING, '{}', now, now))
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def resume(self):
+        """Reschedule jobs that were pending or running when the process stopped. Returns their IDs."""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute('SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at',
+                                (PENDING, RUNNING)).fetchall()
+            conn.execute('UPDATE jobs SET status = ? WHERE status = ?', (PENDING, RUNNING))
+        job_ids = [row[0] for row in rows]
+        for job_id in job_ids:
+            self._executor.submit(self._run, job_id)
+        return job_ids
+
+    def get(self, job_id):
+        """Return the status of a job as a dict, or None if there is no such job."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT id, kind, status, stages, attempts, error, created_at, updated_at '
+                               'FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        stages = json.loads(row[3])
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'stages': {name: {'status': stage['status'], 'started_at': stage['started_at'],
+                              'duration': stage['duration']}
+                       for name, stage in stages.items()},
+            'attempts': row[4],
+            'error': row[5],
+            'created_at': row[6],
+            'updated_at': row[7],
+        }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _save_stages(self, job_id, stages):
+        with self._lock, self._connect() as conn:
+            conn.execute('UPDATE jobs SET stages = ?, updated_at = ? WHERE id = ?',
+                         (stages, time.time(), job_id))
+
+    def _set_status(self, job_id, status, error=None):
+        with self._lock, self._connect() as conn:
+            conn.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?',
+                         (status, error, time.time(), job_id))
+            if status in (DONE, FAILED):
+                self._remove_secrets(conn, job_id)
+
+    def _remove_secrets(self, conn, job_id):
+        # Called with the lock held
+        if not self.secret_fields:
+            return
+        row = conn.execute('SELECT payload FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        payload = json.loads(row[0])
+        if isinstance(payload, dict) and any(field in payload for field in self.secret_fields):
+            for field in self.secret_fields:
+                payload.pop(field, None)
+            conn.execute('UPDATE jobs SET payload = ? WHERE id = ?', (json.dumps(payload), job_id))
+
+    def _run(self, job_id):
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT kind, payload, stages, attempts FROM jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+            attempts = row[3] + 1
+            conn.execute('UPDATE jobs SET status = ?, attempts = ?, updated_at = ? WHERE id = ?',
+                         (RUNNING, attempts, time.time(), job_id))
+        job = Job(self, job_id, row[0], json.loads(row[1]), json.loads(row[2]))
+
+        try:
+            self.handlers[job.kind](job)
+        except Exception as e:
+            traceback.print_exc()
+            if attempts < self.max_attempts:
+                self._set_status(job_id, PENDING, error=str(e))
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                print(f'Job {job_id} failed (attempt {attempts}), retrying in {delay:.1f} s')
+                timer = threading.Timer(delay, self._executor.submit, args=(self._run, job_id))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._set_status(job_id, FAILED, error=str(e))
+                print(f'Job {job_id} failed after {attempts} attempts: {e}')
+                on_failure = self.failure_handlers.get(job.kind)
+                if on_failure is not None:
+                    try:
+                        on_failure(job, e)
+                    except Exception:
+                        traceback.print_exc()
+            return
+        self._set_status(job_id, DONE)
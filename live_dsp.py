@@ -0,0 +1,145 @@
+"""Signal processing on the EEG stream while a session is recording.
+
+`LiveDSP` is fed every block the `EEGDrain` moves to disk. It removes the
+running mean of each channel, applies a causal Butterworth band pass whose
+state is carried from one block to the next (so the output is the same as
+filtering the whole recording at once) and, every `update_interval` seconds,
+computes the power of the classic EEG bands over the last `window` seconds of
+every channel. The result is kept as a small snapshot that the Flask server
+returns to operators who watch the signal quality during the session.
+"""
+import threading
+import time
+
+import mne
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi
+
+from preprocessing import bandpass_sos
+
+BANDS = {
+    'delta': (1.0, 4.0),
+    'theta': (4.0, 8.0),
+    'alpha': (8.0, 13.0),
+    'beta': (13.0, 30.0),
+}
+
+
+class CausalBandpass:
+    """Band-pass filter for a stream of (n_channels, n_times) blocks, keeping its state between blocks."""
+
+    def __init__(self, sfreq, n_channels, l_freq=0.5, h_freq=30.0, order=4):
+        self.sos = bandpass_sos(float(sfreq), l_freq, h_freq, order)
+        self.n_channels = n_channels
+        self._zi = None
+
+    def process(self, block):
+        if self._zi is None:
+            # Start in the steady state for the first sample, so the stream does not begin with a step
+            self._zi = sosfilt_zi(self.sos)[:, np.newaxis, :] * block[:, 0][np.newaxis, :, np.newaxis]
+        filtered, self._zi = sosfilt(self.sos, block, axis=-1, zi=self._zi)
+        return filtered
+
+
+class RunningMean:
+    """Subtracts from every sample the mean of its channel over all samples up to and including it."""
+
+    def __init__(self, n_channels):
+        self._sum = np.zeros((n_channels, 1))
+        self._count = 0
+
+    def process(self, block):
+        n_times = block.shape[1]
+        cumulative = self._sum + np.cumsum(block, axis=1)
+        counts = self._count + np.arange(1, n_times + 1)
+        self._sum = cumulative[:, -1:]
+        self._count += n_times
+        return block - cumulative / counts
+
+
+class LiveDSP:
+    """Running de-meaning, causal filtering and sliding-window band power of the EEG channels.
+
+    Parameters:
+    - info: mne Info of the blocks passed to `process`; only its EEG channels are processed.
+    - l_freq, h_freq: edges of the pass band in Hz.
+    - window: length in seconds of the window the band power is computed over.
+    - update_interval: seconds of data between two band power updates.
+    - bands: mapping of band name to (low, high) frequency in Hz.
+    - listeners: callables that are passed every filtered block of the EEG channels.
+    """
+
+    def __init__(self, info, l_freq=0.5, h_freq=30.0, window=2.0, update_interval=0.5, bands=None, listeners=()):
+        self.sfreq = info['sfreq']
+        self.listeners = list(listeners)
+        self.picks = mne.pick_types(info, eeg=True, exclude=[])
+        self.ch_names = [info['ch_names'][pick] for pick in self.picks]
+        self.bands = bands or BANDS
+        n_channels = len(self.picks)
+        self.mean = RunningMean(n_channels)
+        self.bandpass = CausalBandpass(self.sfreq, n_channels, l_freq, h_freq)
+
+        self.window_samples = max(int(round(window * self.sfreq)), 2)
+        self.update_samples = max(int(round(update_interval * self.sfreq)), 1)
+        # Filtered samples of the last window, oldest first
+        self._window = np.zeros((n_channels, self.window_samples))
+        self._filled = 0
+        self._n_samples = 0
+        self._since_update = 0
+
+        # A Hann window and the FFT bins of every band, computed once
+        self._taper = np.hanning(self.window_samples)
+        freqs = np.fft.rfftfreq(self.window_samples, 1.0 / self.sfreq)
+        self._band_masks = {name: (freqs >= low) & (freqs < high) for name, (low, high) in self.bands.items()}
+        # Scale so the band power is the mean power of the signal in the band
+        self._scale = 2.0 / (self.sfreq * np.sum(self._taper ** 2))
+        self._df = freqs[1] - freqs[0]
+
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def __call__(self, block):
+        self.process(block)
+
+    def process(self, block):
+        """Process the next block of samples (all channels of `info`, in order)."""
+        if block.shape[1] == 0 or len(self.picks) == 0:
+            return
+        filtered = self.bandpass.process(self.mean.process(block[self.picks]))
+        self._push(filtered)
+        for listener in self.listeners:
+            listener(filtered)
+        self._n_samples += filtered.shape[1]
+        self._since_update += filtered.shape[1]
+        if self._since_update >= self.update_samples and self._filled >= self.window_samples:
+            self._since_update = 0
+            self._update()
+
+    def _push(self, filtered):
+        n_new = filtered.shape[1]
+        if n_new >= self.window_samples:
+            self._window[:] = filtered[:, -self.window_samples:]
+        else:
+            self._window[:, :-n_new] = self._window[:, n_new:]
+            self._window[:, -n_new:] = filtered
+        self._filled = min(self._filled + n_new, self.window_samples)
+
+    def _update(self):
+        spectrum = np.fft.rfft(self._window * self._taper, axis=1)
+        psd = self._scale * np.abs(spectrum) ** 2
+        band_power = {name: (psd[:, mask].sum(axis=1) * self._df).tolist()
+                      for name, mask in self._band_masks.items()}
+        snapshot = {
+            'time': self._n_samples / self.sfreq,
+            'updated_at': time.time(),
+            'channels': self.ch_names,
+            'band_power': band_power,
+            'rms': np.sqrt(np.mean(self._window ** 2, axis=1)).tolist(),
+        }
+        with self._lock:
+            self._snapshot = snapshot
+
+    def snapshot(self):
+        """Return the latest band power and RMS per channel, or None before the first full window."""
+        with self._lock:
+            return self._snapshot
@@ -0,0 +1,151 @@
+"""Server-Sent Events stream of the live EEG signal and annotations.
+
+`FrameBroadcaster` is a fixed-size ring of encoded SSE messages shared by every
+viewer. A message is encoded once when it is published, and each subscriber
+only keeps a cursor (the sequence number of the next message it wants), so
+serving many viewers costs no extra copies. Publishing never waits for a viewer:
+a viewer that falls behind by more than the ring's capacity skips the messages
+that were overwritten and is told how many it missed. Closing the broadcaster
+(when its session is replaced or removed) sends every viewer a final `end`
+message and ends its stream.
+
+`EEGFramePublisher` turns filtered blocks from `live_dsp.LiveDSP` into
+downsampled frames, packed as int16 with a scale per channel (or as float32)
+and base64 encoded.
+"""
+import base64
+import json
+import threading
+
+import numpy as np
+
+
+def format_event(event, data):
+    """Encode one SSE message; `data` is serialized as JSON."""
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+
+class FrameBroadcaster:
+    """Fan-out ring buffer of SSE messages.
+
+    Parameters:
+    - capacity: number of messages kept for viewers that are behind.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._messages = [None] * capacity
+        self._seq = 0
+        self._header = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def publish(self, event, data):
+        """Add a message for all viewers. Returns its sequence number."""
+        message = format_event(event, data)
+        with self._condition:
+            seq = self._seq
+            self._messages[seq % self.capacity] = message
+            self._seq += 1
+            self._condition.notify_all()
+        return seq
+
+    def set_header(self, event, data):
+        """Set the message every new viewer receives first, e.g. the channel names of the session."""
+        message = format_event(event, data)
+        with self._condition:
+            self._header = message
+        self.publish(event, data)
+
+    def close(self):
+        """End the streams of all viewers, after the messages they have not received yet."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def subscribe(self, heartbeat=15.0):
+        """Generator of the messages published from now on, for a streaming response.
+
+        Sends a comment every `heartbeat` seconds without messages, so proxies keep the connection open.
+        Once the broadcaster is closed, an `end` message is sent and the generator returns.
+        """
+        with self._condition:
+            cursor = self._seq
+            header = self._header
+            closed = self._closed
+        if closed:
+            yield format_event('end', {})
+            return
+        if header is not None:
+            yield header
+
+        while True:
+            with self._condition:
+                if cursor == self._seq and not self._closed:
+                    self._condition.wait(heartbeat)
+                oldest = max(self._seq - self.capacity, 0)
+                dropped = max(oldest - cursor, 0)
+                cursor += dropped
+                # Only references to the shared messages are taken under the lock
+                messages = [self._messages[seq % self.capacity] for seq in range(cursor, self._seq)]
+                cursor = self._seq
+                closed = self._closed
+
+            if dropped:
+                yield format_event('dropped', {'count': dropped})
+            if messages:
+                for message in messages:
+                    yield message
+            elif not dropped and not closed:
+                yield b': heartbeat\n\n'
+            if closed:
+                yield format_event('end', {})
+                return
+
+
+class EEGFramePublisher:
+    """Publishes filtered EEG blocks as downsampled, packed frames.
+
+    Parameters:
+    - broadcaster: the `FrameBroadcaster` to publish to.
+    - sfreq: sampling rate of the blocks.
+    - ch_names: names of the channels (rows) of the blocks.
+    - target_rate: highest sampling rate of the frames. Samples are only picked, not averaged,
+      so the blocks must already be low-pass filtered below half this rate.
+    - dtype: 'int16' (with a scale per channel) or 'float32'.
+    """
+
+    def __init__(self, broadcaster, sfreq, ch_names, target_rate=125.0, dtype='int16'):
+        if dtype not in ('int16', 'float32'):
+            raise ValueError(f"dtype must be 'int16' or 'float32', not {dtype!r}")
+        self.broadcaster = broadcaster
+        self.step = max(int(sfreq // target_rate), 1)
+        self.sfreq = sfreq / self.step
+        self.dtype = dtype
+        # Index of the next input sample, so the decimation phase carries over between blocks
+        self._n_in = 0
+        self._n_out = 0
+        broadcaster.set_header('start', {'sfreq': self.sfreq, 'channels': list(ch_names), 'dtype': dtype})
+
+    def __call__(self, block):
+        self.publish(block)
+
+    def publish(self, block):
+        first = (-self._n_in) % self.step
+        self._n_in += block.shape[1]
+        frame = block[:, first::self.step]
+        if frame.shape[1] == 0:
+            return
+
+        data = {'start': self._n_out, 'shape': list(frame.shape), 'dtype': self.dtype}
+        if self.dtype == 'int16':
+            peak = np.abs(frame).max(axis=1)
+            scale = np.where(peak > 0, peak / 32767, 1.0)
+            packed = np.round(frame / scale[:, np.newaxis]).astype('<i2')
+            data['scale'] = scale.tolist()
+        else:
+            packed = frame.astype('<f4')
+        # Channel-major, so a viewer can read the rows of the frame straight from the buffer
+        data['data'] = base64.b64encode(np.ascontiguousarray(packed).tobytes()).decode('ascii')
+        self._n_out += frame.shape[1]
+        self.broadcaster.publish('eeg', data)
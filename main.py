@@ -10,12 +10,13 @@ import matplotlib
 from sys import platform
 import time
 
-from brainaccess.utils import acquisition
-from brainaccess.core.eeg_manager import EEGManager
+from simulated_eeg import get_backend
 
 matplotlib.use("TKAgg", force=True)
 
-eeg = acquisition.EEG()
+# The BrainAccess headset, or the simulated one with EEG_BACKEND=simulated
+EEG, EEGManager = get_backend()
+eeg = EEG()
 
 with EEGManager() as mgr:
     # Set correct Bluetooth port for windows or linux
@@ -0,0 +1,250 @@
+"""Timing and metrics of the processing stages.
+
+A span measures one run of a stage: its wall time, the bytes it moved and how
+much the peak memory of the process grew while it ran. Spans are used as a
+context manager or a decorator:
+
+    with span('upload', blob=name) as s:
+        ...
+        s.add_bytes(size)
+
+    @span('preprocess')
+    def preprocess(raw): ...
+
+Every finished span is added to the per-stage counters of a `MetricsRegistry`
+(count, errors, total seconds, a histogram of durations, bytes and the largest
+memory growth), which `render_prometheus` exports in the Prometheus text format
+for the `/metrics` route of the Flask server. Batch scripts can also write every
+span as one JSON line with `log_json` or the METRICS_JSON_LOG variable.
+
+A span costs two `perf_counter` and two `getrusage` calls and one short lock,
+a few microseconds, so it is left on in production. Memory is the peak RSS of
+the whole process, so the growth of concurrent spans overlaps.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Windows, memory is not measured
+    resource = None
+
+# Upper bounds of the duration histogram, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Label names the exporter sets itself
+RESERVED_LABELS = ('stage', 'le')
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def peak_rss_bytes():
+    """Peak resident memory of the process so far, None where it cannot be measured."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+class StageStats:
+    """Counters of one stage and label set."""
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.max_rss_growth = 0
+        self.bucket_counts = [0] * len(buckets)
+
+    def add(self, seconds, n_bytes, rss_growth, error, buckets):
+        self.count += 1
+        self.errors += error
+        self.seconds += seconds
+        self.bytes += n_bytes
+        self.max_rss_growth = max(self.max_rss_growth, rss_growth or 0)
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def to_dict(self):
+        return {'count': self.count, 'errors': self.errors, 'seconds': self.seconds, 'bytes': self.bytes,
+                'max_rss_growth_bytes': self.max_rss_growth}
+
+
+class Span:
+    """One timed run of a stage, see `MetricsRegistry.span`."""
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.bytes = 0
+        self.seconds = None
+        self.rss_growth = None
+        self._start = None
+        self._rss = None
+
+    def add_bytes(self, n_bytes):
+        """Count `n_bytes` moved by this span (read, written, uploaded or downloaded)."""
+        self.bytes += n_bytes or 0
+
+    def __enter__(self):
+        self._rss = peak_rss_bytes()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        if self._rss is not None:
+            self.rss_growth = peak_rss_bytes() - self._rss
+        self.registry.record(self, exc_type)
+        return False
+
+    def __call__(self, func):
+        # As a decorator every call gets its own span, so it is safe from several threads
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(self.registry, self.name, self.labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+class MetricsRegistry:
+    """Per-stage counters of finished spans.
+
+    Parameters:
+    - prefix: prefix of the exported metric names.
+    - buckets: upper bounds of the duration histogram in seconds.
+    - enabled: record spans; a disabled registry only times them.
+    """
+
+    def __init__(self, prefix='eeg', buckets=DEFAULT_BUCKETS, enabled=True):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.enabled = enabled
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._json_log = None
+        self._json_log_lock = threading.Lock()
+
+    def span(self, name, **labels):
+        """A span of stage `name`, usable as context manager or decorator. `labels` are exported with it.
+
+        The names in `RESERVED_LABELS` are set by the exporter and cannot be used as labels.
+        """
+        _check_labels(labels)
+        return Span(self, name, labels)
+
+    def record(self, span, exc_type=None):
+        if not self.enabled:
+            return
+        key = (span.name, tuple(sorted((k, str(v)) for k, v in span.labels.items())))
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = StageStats(self.buckets)
+            stats.add(span.seconds, span.bytes, span.rss_growth, exc_type is not None, self.buckets)
+        if self._json_log is not None:
+            self._write_json(span, exc_type)
+
+    def log_json(self, stream):
+        """Also write every finished span as a JSON line to `stream` (a path or a text file); None stops it."""
+        if isinstance(stream, (str, os.PathLike)):
+            stream = open(stream, 'a', buffering=1)
+        self._json_log = stream
+
+    def _write_json(self, span, exc_type):
+        line = json.dumps({
+            'time': time.time(),
+            'span': span.name,
+            'labels': span.labels,
+            'seconds': span.seconds,
+            'bytes': span.bytes,
+            'rss_growth_bytes': span.rss_growth,
+            'error': exc_type.__name__ if exc_type is not None else None,
+            'thread': threading.current_thread().name,
+        }, default=str)
+        with self._json_log_lock:
+            self._json_log.write(line + '\n')
+
+    def snapshot(self):
+        """The counters of every stage, as a list of dicts with the stage name and labels."""
+        with self._lock:
+            return [dict(stage=name, labels=dict(labels), **stats.to_dict())
+                    for (name, labels), stats in sorted(self._stats.items())]
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def render_prometheus(self):
+        """All counters in the Prometheus text exposition format."""
+        with self._lock:
+            items = [(name, labels, stats.to_dict(), list(stats.bucket_counts))
+                     for (name, labels), stats in sorted(self._stats.items())]
+        p = self.prefix
+        lines = [
+            f'# HELP {p}_stage_seconds Duration of the processing stages.',
+            f'# TYPE {p}_stage_seconds histogram',
+        ]
+        for name, labels, stats, bucket_counts in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, bucket_counts):
+                cumulative += n
+                lines.append(f'{p}_stage_seconds_bucket{_labels(name, labels, le=bound)} {cumulative}')
+            lines.append(f'{p}_stage_seconds_bucket{_labels(name, labels, le="+Inf")} {stats["count"]}')
+            lines.append(f'{p}_stage_seconds_sum{_labels(name, labels)} {stats["seconds"]}')
+            lines.append(f'{p}_stage_seconds_count{_labels(name, labels)} {stats["count"]}')
+        for metric, key, kind, help_text in (
+                ('stage_errors_total', 'errors', 'counter', 'Stage runs that raised an exception.'),
+                ('stage_bytes_total', 'bytes', 'counter', 'Bytes moved by the processing stages.'),
+                ('stage_max_rss_growth_bytes', 'max_rss_growth_bytes', 'gauge',
+                 'Largest growth of the peak resident memory during one run of a stage.')):
+            lines.append(f'# HELP {p}_{metric} {help_text}')
+            lines.append(f'# TYPE {p}_{metric} {kind}')
+            for name, labels, stats, _ in items:
+                lines.append(f'{p}_{metric}{_labels(name, labels)} {stats[key]}')
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines.append(f'# HELP {p}_peak_rss_bytes Peak resident memory of the process.')
+            lines.append(f'# TYPE {p}_peak_rss_bytes gauge')
+            lines.append(f'{p}_peak_rss_bytes {peak}')
+        return '\n'.join(lines) + '\n'
+
+
+def _check_labels(labels):
+    reserved = [key for key in labels if key in RESERVED_LABELS]
+    if reserved:
+        # A repeated label name makes Prometheus reject the whole exposition
+        raise ValueError(f'Reserved metric label names: {", ".join(reserved)}')
+
+
+def _labels(name, labels, le=None):
+    _check_labels(dict(labels))
+    pairs = [('stage', name)] + list(labels)
+    if le is not None:
+        pairs.append(('le', le))
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+# The registry of the process, used by the modules of this repository
+registry = MetricsRegistry(enabled=os.getenv('METRICS_ENABLED', 'true').lower() == 'true')
+if os.getenv('METRICS_JSON_LOG'):
+    registry.log_json(os.getenv('METRICS_JSON_LOG'))
+
+
+def span(name, **labels):
+    """A span of stage `name` in the process registry, see `MetricsRegistry.span`."""
+    return registry.span(name, **labels)
+
+
+def render_prometheus():
+    return registry.render_prometheus()
@@ -1,22 +1,14 @@
 import mne
 import matplotlib.pyplot as plt
-import numpy as np
+
+from preprocessing import preprocess_raw_data
 
 # Load the data
 file_path = '7558f0eb-0970-4c8d-84db-85616feb82c3.fif'
 raw = mne.io.read_raw_fif(file_path, preload=True)
 
-raw.drop_channels(['Accel_x', 'Accel_y', 'Accel_z', 'Digital', 'Sample'])
-
-# Define a function to remove the mean (baseline)
-def remove_mean(x):
-    return x - np.mean(x)
-
-# Apply the function
-raw.apply_function(remove_mean, picks='eeg')
-
-# Filter the data
-raw.filter(0.5, 30)
+# Drop the unwanted channels, remove the mean (baseline) and filter the data
+preprocess_raw_data(raw)
 
 # Get the participant's name
 participant_name = None
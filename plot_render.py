@@ -0,0 +1,184 @@
+"""Headless rendering of the session overview PNG.
+
+`raw.plot()` builds the interactive mne browser and draws every sample, and the
+event markers were added one `axvline` per axis and event, so the overview of a
+long recording was the slowest step after /stop. `OverviewRenderer` draws the
+same picture directly on an Agg canvas:
+
+- every channel is reduced to the minimum and maximum of each pixel column
+  (`minmax_decimate`), which looks the same as drawing all samples; a
+  recording can be passed in pieces (`render_blocks`), so it never has to be
+  in memory at once;
+- all traces are one `LineCollection` and all event markers another;
+- figures are kept as templates per channel count and only their data is
+  replaced, so axes, ticks and fonts are not set up again for every session.
+
+Rendering time then depends on the image size and the number of events, not on
+the length of the recording. No pyplot state is used, so it runs in any thread.
+"""
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+
+def minmax_decimate(data, n_bins):
+    """Reduce `data` (n_channels, n_times) to the minimum and maximum of `n_bins` equal bins.
+
+    Returns `(positions, values)`: the sample position of every point and the (n_channels, 2 * n_bins)
+    envelope, alternating minimum and maximum. Data with at most `2 * n_bins` samples is returned as is.
+    """
+    return minmax_decimate_blocks([(0, data)], data.shape[-1], n_bins)
+
+
+def minmax_decimate_blocks(blocks, n_times, n_bins):
+    """`minmax_decimate` of data that arrives as consecutive `(start, block)` pieces, in order.
+
+    Every block holds the same channels from sample `start` on, and the pieces cover `n_times` samples.
+    Only one piece is needed at a time, so a recording can be decimated without loading all of it.
+    """
+    if n_times <= 2 * n_bins:
+        return np.arange(n_times, dtype=float), np.concatenate([block for _, block in blocks], axis=-1)
+    edges = np.linspace(0, n_times, n_bins + 1).astype(int)
+    values = None
+    for start, block in blocks:
+        stop = start + block.shape[-1]
+        if stop == start:
+            continue
+        if values is None:
+            values = np.empty(block.shape[:-1] + (2 * n_bins,), dtype=block.dtype)
+        # The bins this piece reaches into, and where each of them starts in it
+        first = np.searchsorted(edges, start, side='right') - 1
+        last = np.searchsorted(edges, stop, side='left')
+        starts = np.maximum(edges[first:last], start) - start
+        minima = np.minimum.reduceat(block, starts, axis=-1)
+        maxima = np.maximum.reduceat(block, starts, axis=-1)
+        if edges[first] < start:
+            # The first bin began in the previous piece
+            minima[..., 0] = np.minimum(minima[..., 0], values[..., 2 * first])
+            maxima[..., 0] = np.maximum(maxima[..., 0], values[..., 2 * first + 1])
+        values[..., 2 * first:2 * last:2] = minima
+        values[..., 2 * first + 1:2 * last:2] = maxima
+    # Both points of a bin are drawn at its centre, as one vertical stroke
+    positions = np.repeat((edges[:-1] + edges[1:] - 1) / 2, 2)
+    return positions, values
+
+
+class _Template:
+    """A figure with empty trace and marker collections for a number of channels."""
+
+    def __init__(self, n_channels, width, row_height, dpi):
+        margin_top, margin_bottom = 0.9, 0.6  # inches, room for the title and the time axis
+        height = n_channels * row_height / dpi + margin_top + margin_bottom
+        self.figure = Figure(figsize=(width / dpi, height), dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_axes([0.08, margin_bottom / height, 0.9, 1 - (margin_top + margin_bottom) / height])
+        self.ax.set_ylim(n_channels - 0.5, -0.5)  # first channel on top, like mne
+        self.ax.set_yticks(np.arange(n_channels))
+        self.ax.set_xlabel('Time (s)')
+        self.traces = LineCollection([], colors='k', linewidths=0.5)
+        self.markers = LineCollection([], colors='r', linestyles='--', linewidths=0.8)
+        self.ax.add_collection(self.traces)
+        self.ax.add_collection(self.markers)
+        self.title = self.figure.suptitle('', size='xx-large', weight='bold')
+        self.labels = []
+        self.n_channels = n_channels
+        # Width of the plot area in pixels, one bin per pixel column
+        self.n_bins = max(int(self.ax.get_position().width * width), 1)
+        self.lock = threading.Lock()
+
+
+class OverviewRenderer:
+    """Renders recordings as a PNG with one row per channel and the events as dashed lines.
+
+    Parameters:
+    - width: image width in pixels.
+    - row_height: height of one channel row in pixels.
+    - dpi: resolution of the figure.
+    - max_templates: number of figure templates (one per channel count) kept.
+    """
+
+    def __init__(self, width=1600, row_height=60, dpi=100, max_templates=4):
+        self.width = width
+        self.row_height = row_height
+        self.dpi = dpi
+        self.max_templates = max_templates
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _template(self, n_channels):
+        with self._lock:
+            template = self._templates.pop(n_channels, None)
+            if template is None:
+                template = _Template(n_channels, self.width, self.row_height, self.dpi)
+            self._templates[n_channels] = template
+            while len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+            return template
+
+    def render(self, data, sfreq, ch_names, event_times=(), event_labels=(), title=''):
+        """Render `data` (n_channels, n_times) and return the PNG in a `BytesIO`.
+
+        Parameters:
+        - sfreq: sampling rate of `data`.
+        - ch_names: names of the rows of `data`.
+        - event_times: event times in seconds from the first sample.
+        - event_labels: text drawn at the top of every event marker.
+        - title: title of the figure.
+        """
+        return self.render_blocks([(0, data)], data.shape[-1], sfreq, ch_names, event_times, event_labels, title)
+
+    def render_blocks(self, blocks, n_times, sfreq, ch_names, event_times=(), event_labels=(), title=''):
+        """`render` of a recording of `n_times` samples that arrives in pieces, see `minmax_decimate_blocks`."""
+        n_channels = len(ch_names)
+        template = self._template(n_channels)
+        # Decimated before the template is locked, so reading the pieces does not hold up other renders
+        positions, values = minmax_decimate_blocks(blocks, n_times, template.n_bins)
+        with template.lock:
+            times = positions / sfreq
+
+            # Every channel gets one row; the 99th percentile of its amplitude fills half the row
+            values = values - np.median(values, axis=-1, keepdims=True)
+            scale = np.percentile(np.abs(values), 99, axis=-1, keepdims=True)
+            scale[scale == 0] = 1
+            rows = np.arange(n_channels)[:, np.newaxis] - values / (2 * scale)
+            segments = np.empty((n_channels, len(times), 2))
+            segments[:, :, 0] = times
+            segments[:, :, 1] = rows
+            template.traces.set_segments(segments)
+
+            event_times = np.asarray(event_times, dtype=float)
+            markers = np.empty((len(event_times), 2, 2))
+            markers[:, :, 0] = event_times[:, np.newaxis]
+            markers[:, 0, 1] = -0.5
+            markers[:, 1, 1] = n_channels - 0.5
+            template.markers.set_segments(markers)
+            for label in template.labels:
+                label.remove()
+            template.labels = [template.ax.text(t, -0.5, label, color='r', va='bottom')
+                               for t, label in zip(event_times, event_labels)]
+
+            template.ax.set_xlim(0, max(n_times - 1, 1) / sfreq)
+            template.ax.set_yticklabels(ch_names)
+            template.title.set_text(title)
+
+            png = BytesIO()
+            template.figure.savefig(png, format='png')
+        return png
+
+
+default_renderer = OverviewRenderer()
+
+
+def render_overview(data, sfreq, ch_names, event_times=(), event_labels=(), title=''):
+    """Render with the shared `default_renderer`, see `OverviewRenderer.render`."""
+    return default_renderer.render(data, sfreq, ch_names, event_times, event_labels, title)
+
+
+def render_overview_blocks(blocks, n_times, sfreq, ch_names, event_times=(), event_labels=(), title=''):
+    """Render pieces with the shared `default_renderer`, see `OverviewRenderer.render_blocks`."""
+    return default_renderer.render_blocks(blocks, n_times, sfreq, ch_names, event_times, event_labels, title)
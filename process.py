@@ -1,23 +1,17 @@
-import io
-
 import matplotlib.pyplot as plt
 import mne
-import numpy as np
-from pydub import AudioSegment
-from scipy.io import wavfile
-from scipy.signal import spectrogram
 
-from fetch_data import fetch_first_user_fif_blob, fetch_first_user_audio
+from alignment import AlignmentEngine, plot_alignment
+from feature_store import eeg_band_features, feature_store
+from fetch_data import fetch_first_user
+from segmentation import QRSegmenter, segment_times
 from utilities import preprocess_raw_data, add_plot_title
 
-# Fetch the FIF blob of the first user
-fif_blob = fetch_first_user_fif_blob()
-
-# Create a BytesIO object from the blob
-fif_buffer = io.BytesIO(fif_blob)
+# Only the first user's files are downloaded, and they come from the local cache after the first run
+first_user = fetch_first_user()
 
-# Read the FIF data from the buffer
-raw = mne.io.read_raw_fif(fif_buffer, preload=True)
+# Read the FIF data straight from the cached file
+raw = mne.io.read_raw_fif(first_user.fifPath, preload=True)
 
 # Preprocess the raw data
 raw = preprocess_raw_data(raw)
@@ -28,36 +22,34 @@ plt.show()
 # We save the scaling generated by auto-scaling the plot, and use it further for cropped data
 scaling_after_auto = fig2.mne.scalings
 
-# Extract the annotations
-annotations = raw.annotations
-
-# Find the Q and R annotations and their timestamps
-q_r_pairs = []
-for i, description in enumerate(annotations.description):
-    if description.startswith('Q'):
-        q_time = annotations.onset[i]  # Get the onset time of the Q annotation
-        r_description = 'R' + description[1:]
-        r_times = annotations.onset[annotations.description == r_description]
-        if len(r_times) > 0:
-            r_time = r_times[0]  # Get the onset time of the corresponding R annotation
-            q_r_pairs.append((q_time, r_time))  # Store the onset times as a pair
-            print(f"Found a pair: {description} & {r_description}")
+# Pair the Q and R annotations in one pass; every segment is a view into raw's data, nothing is copied
+segmenter = QRSegmenter()
+segments = segmenter.segment_raw(raw)
+sfreq = raw.info['sfreq']
+
+for segment in segments:
+    print(f"Found a pair: Q{segment.label} & R{segment.label}")
+
+# Band power of every question, kept in the feature store: a rerun on the same recording reads it from there.
+# The recording is already preprocessed with the default settings, so it is not read again.
+band_features = eeg_band_features(feature_store, first_user.fifPath, first_user.userId, raw=raw)
+for label, value in band_features.items():
+    if value is not None:
+        # Mean over the channels of every band
+        means = {band: sum(power) / len(power) for band, power in value['bands'].items() if None not in power}
+        print(f"Q{label} band power: " + ", ".join(f"{band} {mean:.3g}" for band, mean in means.items()))
 
 # Print the number of pairs found
 print(
-    f"Found {len(q_r_pairs)} pairs. Dividing the plot into {len(q_r_pairs)} parts and displaying each plot separately.")
-
-raw_segment_array = []
+    f"Found {len(segments)} pairs. Dividing the plot into {len(segments)} parts and displaying each plot separately.")
 
 # Plot the segments between Q and R annotations
-for i, (q_time, r_time) in enumerate(q_r_pairs):
+for i, segment in enumerate(segments):
+    q_time, r_time = segment.tmin, segment.tmax
     print(f"Plotting segment {i}: {q_time} to {r_time}")
-    # Crop the data to the desired segment using the onset times of the Q and R annotations
-    raw_segment = raw.copy().crop(tmin=q_time, tmax=r_time).load_data()
-    raw_segment_array.append(raw_segment)
-
-    events, event_id = mne.events_from_annotations(raw_segment)
-    fig = raw_segment.plot(scalings=scaling_after_auto, verbose=False, title=f"Segment {i}: {q_time} to {r_time}")
+    # Show the window of the segment instead of plotting a cropped copy of the recording
+    fig = raw.plot(start=segment.start / sfreq, duration=(segment.stop - segment.start) / sfreq,
+                   scalings=scaling_after_auto, verbose=False, title=f"Segment {i}: {q_time} to {r_time}")
     add_plot_title(f"Graph for Question {i + 1}", fig)
 
     plt.show()
@@ -78,66 +70,23 @@ for i, (q_time, r_time) in enumerate(q_r_pairs):
 # # Keep all the plots open
 # plt.show(block=True)
 
-audio_blobs = fetch_first_user_audio()
-raw_segment_array = []
-data_array = []
-
-# Extract data from each segment
-for i, (q_time, r_time) in enumerate(q_r_pairs):
-    raw_segment = raw.copy().crop(tmin=q_time, tmax=r_time).load_data()
-    raw_segment_array.append(raw_segment)
-
-    # Extract data and times for the segment
-    data, times = raw_segment[:, :]
-    data_array.append((data, times))
-
 # Plot the segments using Matplotlib
-fig, axs = plt.subplots(len(q_r_pairs), 1, figsize=(10, 4 * len(q_r_pairs)))
-for i, (data, times) in enumerate(data_array):
-    for j, channel_data in enumerate(data):
+fig, axs = plt.subplots(len(segments), 1, figsize=(10, 4 * len(segments)))
+for i, segment in enumerate(segments):
+    times = segment_times(segment, sfreq)
+    for j, channel_data in enumerate(segment.data):
         axs[i].plot(times, channel_data, label=raw.ch_names[j])
-    axs[i].set_title(f"Segment {i}: {q_r_pairs[i][0]} to {q_r_pairs[i][1]}")
+    axs[i].set_title(f"Segment {i}: {segment.tmin} to {segment.tmax}")
     axs[i].legend(loc="upper right")
 
 plt.tight_layout()
 plt.show()
 
-# Fetch the audio blobs
-audio_blobs = fetch_first_user_audio()
+# Align every answer clip with the EEG recorded while it was spoken, using the clips' start times,
+# and compute all spectrograms and EEG band power on one time grid
+alignment = AlignmentEngine().align(raw, first_user)
+print(f"Aligned {len(alignment.question_ids)} clips: spectrograms {alignment.spectrograms.shape}, "
+      f"band power {alignment.band_power.shape}")
 
-# Extract data from each segment and plot EEG data along with the audio spectrogram
-fig, axs = plt.subplots(len(q_r_pairs) * 2, 1,
-                        figsize=(10, 8 * len(q_r_pairs)))  # Adjusted to accommodate the spectrograms
-
-for i, (q_time, r_time) in enumerate(q_r_pairs):
-    raw_segment = raw.copy().crop(tmin=q_time, tmax=r_time).load_data()
-
-    # Extract data and times for the EEG segment
-    data, times = raw_segment[:, :]
-
-    # Plot EEG data
-    for j, channel_data in enumerate(data):
-        axs[i * 2].plot(times, channel_data, label=raw.ch_names[j])
-    axs[i * 2].set_title(f"Segment {i}: {q_r_pairs[i][0]} to {q_r_pairs[i][1]}")
-    axs[i * 2].legend(loc="upper right")
-
-    # Convert audio blob to WAV format using pydub
-    audio_segment = AudioSegment.from_mp3(io.BytesIO(audio_blobs[i]))
-    audio_buffer = io.BytesIO()
-    audio_segment.export(audio_buffer, format="wav")
-    audio_buffer.seek(0)  # Reset buffer position
-
-    # Now read the WAV data
-    audio_rate, audio_data = wavfile.read(audio_buffer)
-
-    # Compute the spectrogram
-    frequencies, times, Sxx = spectrogram(audio_data, fs=audio_rate)
-
-    # Plot the spectrogram
-    axs[i * 2 + 1].pcolormesh(times, frequencies, 10 * np.log10(Sxx), shading='gouraud')
-    axs[i * 2 + 1].set_ylabel('Frequency [Hz]')
-    axs[i * 2 + 1].set_xlabel('Time [sec]')
-    axs[i * 2 + 1].set_title(f"Audio Spectrogram for Segment {i}")
-
-plt.tight_layout()
+plot_alignment(alignment)
 plt.show()
@@ -9,14 +9,16 @@ import matplotlib.pyplot as plt
 import matplotlib
 from sys import platform
 import time
-import numpy as np
 
-from brainaccess.utils import acquisition
-from brainaccess.core.eeg_manager import EEGManager
+from simulated_eeg import get_backend
+
+from preprocessing import preprocess_raw_data
 
 matplotlib.use("TKAgg", force=True)
 
-eeg = acquisition.EEG()
+# The BrainAccess headset, or the simulated one with EEG_BACKEND=simulated
+EEG, EEGManager = get_backend()
+eeg = EEG()
 
 # Define your own channel mapping
 channel_mapping = {
@@ -57,15 +59,6 @@ eeg.data.save(f'{time.strftime("%Y%m%d_%H%M")}-raw.fif')
 eeg.close()
 # Show recorded data
 
-# Other filters
-eeg.data.mne_raw.drop_channels(['Accel_x', 'Accel_y', 'Accel_z', 'Digital', 'Sample'])
-
-# Define a function to remove the mean (baseline)
-def remove_mean(x):
-    return x - np.mean(x)
-
-# Apply the function
-eeg.data.mne_raw.apply_function(remove_mean, picks='eeg')
-
-eeg.data.mne_raw.filter(0.5, 30).plot(scalings='auto', verbose=False)
+# Drop the unwanted channels, remove the mean (baseline) and filter the data
+preprocess_raw_data(eeg.data.mne_raw).plot(scalings='auto', verbose=False)
 plt.show()
@@ -1,26 +1,18 @@
-from flask import Flask, request
+from flask import Flask, Response, request
 import threading
-import matplotlib.pyplot as plt
-import matplotlib
 from sys import platform
 import time
-import mne
 import os
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, storage
-from datetime import datetime
 from flask_cors import CORS
-import requests
-from io import BytesIO
-import numpy as np
-import time
-
-from brainaccess.utils import acquisition
-from brainaccess.core.eeg_manager import EEGManager
 
-# Global variable to store JWT token
-jwt_token = None
+from jobs import JobQueue
+from metrics import render_prometheus
+from sessions import STOPPED, SessionError, SessionManager, parse_channel_mapping
+from uploads import StorageUploader
+from recording_pipeline import process_recording as process_recording_job, recording_failed
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS globally
@@ -32,6 +24,17 @@ load_dotenv()
 com_port = os.getenv('COM_PORT_WINDOWS')
 com_port_linux = os.getenv('COM_PORT_LINUX')
 
+# Recordings are streamed to this directory while the session is running
+recording_dir = os.getenv('RECORDING_DIR', 'recordings')
+drain_interval = float(os.getenv('DRAIN_INTERVAL_SEC', '0.5'))
+# Band power of the live signal is updated every LIVE_UPDATE_MS over the last LIVE_WINDOW_SEC
+live_update_interval = float(os.getenv('LIVE_UPDATE_MS', '500')) / 1000
+live_window = float(os.getenv('LIVE_WINDOW_SEC', '2'))
+# Frames sent to /stream viewers: highest sampling rate, sample format and how many are kept for slow viewers
+stream_rate = float(os.getenv('STREAM_RATE_HZ', '125'))
+stream_dtype = os.getenv('STREAM_DTYPE', 'int16')
+stream_buffer = int(os.getenv('STREAM_BUFFER_FRAMES', '256'))
+
 # Path to the credentials.json file
 cred_path = 'credentials.json'
 
@@ -41,152 +44,206 @@ firebase_admin.initialize_app(cred, {
     'storageBucket': os.getenv('FIREBASE_STORAGE_BUCKET')
 })
 
-matplotlib.use("TKAgg", force=True)
-
-# Move the eeg object to the global scope so it can be accessed by the Flask route
-eeg = acquisition.EEG()
-mgr = EEGManager()
-
 channel_mapping_str = os.getenv('CHANNEL_MAPPING')
-channel_mapping = {int(k): v for k, v in (x.split(':') for x in channel_mapping_str.split(','))}
-
-
-def upload_to_firebase(file_bytes, file_name, content_type):
-    # Create a storage reference
-    bucket = storage.bucket()
-    blob = bucket.blob(file_name)
-
-    # Upload the file from in-memory bytes
-    blob.upload_from_file(file_bytes, content_type=content_type)
-
-    # Make the blob publicly readable
-    blob.make_public()
-
-    # The public URL can be used to directly access the uploaded file via HTTP
-    return blob.public_url + "?timestamp=" + str(time.time())
+channel_mapping = parse_channel_mapping(channel_mapping_str)
 
-
-@app.route('/annotate', methods=['POST'])
-def annotate():
-    annotation = request.json.get('annotation')
-    if annotation:
-        eeg.annotate(annotation)
-        return {'status': 'success'}, 200
-    else:
+# Set correct Bluetooth port for windows or linux
+if platform == "linux" or platform == "linux2":
+    default_port = com_port_linux
+else:
+    default_port = com_port
+
+# Every headset is recorded in its own session; the routes without a session id use this one
+DEFAULT_SESSION = 'default'
+sessions = SessionManager(recording_dir=recording_dir, drain_interval=drain_interval, live_window=live_window,
+                          live_update_interval=live_update_interval, stream_rate=stream_rate,
+                          stream_dtype=stream_dtype, stream_buffer=stream_buffer)
+
+
+# One uploader (and storage client) shared by all jobs
+uploader = StorageUploader(storage.bucket(), max_workers=int(os.getenv('UPLOAD_WORKERS', '4')))
+
+
+def process_recording(job):
+    process_recording_job(job, uploader, os.getenv('SPRING_URL'))
+
+
+# Post-stop work is queued here; the SQLite file keeps pending jobs across restarts, and the participant's
+# token only until the job has finished. Recordings of jobs that failed for good are removed or reported.
+job_queue = JobQueue(os.getenv('JOB_DB_PATH', 'jobs.sqlite3'), {'recording': process_recording},
+                     max_workers=int(os.getenv('JOB_WORKERS', '2')), secret_fields=('jwt_token',),
+                     failure_handlers={'recording': recording_failed})
+
+
+def unknown_session(session_id):
+    return {'status': 'failure', 'error': f'Unknown session id {session_id}'}, 404
+
+
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    return {'sessions': [session.status() for session in sessions.list()]}, 200
+
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    body = request.json or {}
+    port = body.get('port')
+    if not port:
+        return {'status': 'failure', 'error': 'No port provided'}, 400
+    mapping = parse_channel_mapping(body['channel_mapping']) if body.get('channel_mapping') else channel_mapping
+    try:
+        session = sessions.create(port, mapping, session_id=body.get('session_id'))
+    except SessionError as e:
+        return {'status': 'failure', 'error': str(e)}, 409
+    except Exception as e:
+        return {'status': 'failure', 'error': f'Could not connect to the headset: {e}'}, 503
+    return session.status(), 201
+
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+def session_status(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        return unknown_session(session_id)
+    return session.status(), 200
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    try:
+        payload = sessions.remove(session_id)
+    except KeyError:
+        return unknown_session(session_id)
+    response = {'status': 'success'}
+    if payload is not None:
+        # The session was still recording, keep what was recorded
+        response['job_id'] = job_queue.submit('recording', payload)
+    return response, 200
+
+
+@app.route('/sessions/<session_id>/annotate', methods=['POST'])
+def annotate(session_id=DEFAULT_SESSION):
+    # Taken before the request body is parsed, so parsing time does not shift the marker
+    received_at = time.monotonic()
+    session = sessions.get(session_id)
+    if session is None:
+        return unknown_session(session_id)
+    body = request.json or {}
+    # Either one annotation or a batch of them in 'annotations'. Each can carry its time on the
+    # client's clock ('client_time', seconds); 'sent_at' is the client time the request was sent.
+    items = body.get('annotations')
+    if items is None:
+        items = [body] if body.get('annotation') else []
+    items = [item if isinstance(item, dict) else {'annotation': item} for item in items]
+    if not items or not all(item.get('annotation') for item in items):
         return {'status': 'failure', 'error': 'No annotation provided'}, 400
 
+    client_id = body.get('client_id') or request.remote_addr
+    for item in items:
+        session.annotate(item['annotation'], received_at=received_at, client_time=item.get('client_time'),
+                         client_id=client_id, sent_at=body.get('sent_at'))
+    return {'status': 'success', 'count': len(items),
+            'clock_offset': session.annotation_queue.estimator(client_id).offset}, 200
+
 
-@app.route('/start', methods=['POST'])
-def start():
-    global user_id, start_timestamp, jwt_token  # Declare jwt_token as a global variable
+@app.route('/sessions/<session_id>/start', methods=['POST'])
+def start(session_id=DEFAULT_SESSION):
     user_id = request.json.get('user_id')
     jwt_token = request.json.get('jwt_token')  # Get JWT token from the request
-    if user_id:
-        # Start acquiring data
-        eeg.start_acquisition()
-        start_timestamp = datetime.now().isoformat()  # Save the current timestamp
-        return {'status': 'success'}, 200
-    else:
+    if not user_id:
         return {'status': 'failure', 'error': 'No user id provided'}, 400
 
-
-@app.route('/stop', methods=['POST'])
-def stop():
-    # get all eeg data and stop acquisition
-    eeg.get_mne()
-    eeg.stop_acquisition()
-    mgr.disconnect()
-
-    # Add the start timestamp as a custom annotation
-    eeg.data.mne_raw.info['temp'] = {'start_timestamp': start_timestamp}
-
-    # Save EEG data to MNE fif format
-    file_name = f'{user_id}-raw.fif'
-    eeg.data.mne_raw.save(file_name, overwrite=True)
-
-    # Read the saved file into a BytesIO object
-    with open(file_name, 'rb') as file:
-        fif_bytes = BytesIO(file.read())
-
-    # Upload the FIF file to Firebase and print the public URL
-    fif_url = upload_to_firebase(fif_bytes, f'fif/{user_id}-raw.fif', 'application/octet-stream')
-    print(f'FIF file uploaded to: {fif_url}')
-
-    # Show recorded data and save plot to memory
-    plot_bytes = show_recorded_data()
-    plot_bytes.seek(0)
-
-    # Upload the plot image to Firebase and print the public URL
-    image_url = upload_to_firebase(plot_bytes, f'images/{user_id}-plot.png', 'image/png')
-    print(f'Image uploaded to: {image_url}')
-
-    # Send the URLs to the Spring server
-    spring_url = os.getenv('SPRING_URL')
-    headers = {'Authorization': f'Bearer {jwt_token}'}  # Include JWT token in the header
-    response = requests.post(f'{spring_url}/users/{user_id}/fifUrl',
-                             json={"fifUrl": fif_url, "imageUrl": image_url, "startTime": start_timestamp},
-                             headers=headers)  # Include start_timestamp
-    if response.status_code != 200:
-        print(f'Error sending URLs to Spring server: {response.text}')
-
-    # Close brainaccess library
-    eeg.close()
-
-    # Optionally, delete the temporary FIF file
-    os.remove(file_name)
-
-    return {'status': 'success'}, 200
-
-
-def show_recorded_data():
-    # Pre-process the EEG data
-    eeg.data.mne_raw.drop_channels(['Accel_x', 'Accel_y', 'Accel_z', 'Digital', 'Sample'])  # Remove unwanted channels
-
-    # Define a function to remove the mean (baseline)
-
-    def remove_mean(x):
-        return x - np.mean(x)
-
-    # Apply the function
-    eeg.data.mne_raw.apply_function(remove_mean, picks='eeg')
-    eeg.data.mne_raw.filter(0.5, 30)
-    total_duration = eeg.data.mne_raw.times[-1]  # Get the total duration of the data
-    events, event_id = mne.events_from_annotations(eeg.data.mne_raw)
-    fig = eeg.data.mne_raw.plot(scalings='auto', verbose=False, events=events, show=False, duration=total_duration)
-    fig.subplots_adjust(top=0.9)  # make room for title
-    fig.suptitle(f'Participant: {user_id}', size='xx-large', weight='bold')
-
-    # Get the axes from the figure
-    axes = fig.get_axes()
-
-    # Print all events and add vertical lines
-    for event in events:
-        for description, id in event_id.items():
-            if id == event[2]:
-                print(f'Timestamp: {event[0]}, Annotation: {description}')
-                # Add a vertical line at the timestamp of the event
-                # Note: event[0] is in samples, so we convert it to seconds by dividing by the sampling rate
-                for ax in axes:
-                    ax.axvline(event[0] / eeg.data.mne_raw.info['sfreq'], color='r', linestyle='--')
-                    # Add a text label at the top of the plot
-                    ax.text(event[0] / eeg.data.mne_raw.info['sfreq'], ax.get_ylim()[1], description, color='r')
-
-    plot_bytes = BytesIO()
-    plt.savefig(plot_bytes, format='png')
-    plt.close(fig)  # Close the plot
-
-    return plot_bytes
+    session = sessions.get(session_id)
+    if session_id == DEFAULT_SESSION and (session is None or session.state == STOPPED):
+        try:
+            # The default headset is reconnected for every new participant
+            session = sessions.create(default_port, channel_mapping, session_id=DEFAULT_SESSION)
+        except SessionError as e:
+            # e.g. the default port is used by a session created through /sessions
+            return {'status': 'failure', 'error': str(e)}, 409
+        except Exception as e:
+            return {'status': 'failure', 'error': f'Could not connect to the headset: {e}'}, 503
+    if session is None:
+        return unknown_session(session_id)
+    try:
+        # Start acquiring data and draining it to disk
+        session.start(user_id, jwt_token)
+    except SessionError as e:
+        return {'status': 'failure', 'error': str(e)}, 409
+    return {'status': 'success', 'session_id': session_id}, 200
+
+
+@app.route('/sessions/<session_id>/stop', methods=['POST'])
+def stop(session_id=DEFAULT_SESSION):
+    session = sessions.get(session_id)
+    if session is None:
+        return unknown_session(session_id)
+    try:
+        payload = session.stop()
+    except SessionError as e:
+        return {'status': 'failure', 'error': str(e)}, 409
+
+    # Saving, uploading, plotting and notifying the Spring server run in the background
+    job_id = job_queue.submit('recording', payload)
+
+    return {'status': 'success', 'job_id': job_id}, 200
+
+
+@app.route('/sessions/<session_id>/live', methods=['GET'])
+def live_status(session_id=DEFAULT_SESSION):
+    session = sessions.get(session_id)
+    if session is None:
+        return unknown_session(session_id)
+    snapshot = session.live_snapshot()
+    if snapshot is None:
+        return {'status': 'failure', 'error': 'No live data yet'}, 404
+    return snapshot, 200
+
+
+@app.route('/sessions/<session_id>/stream', methods=['GET'])
+def stream(session_id=DEFAULT_SESSION):
+    session = sessions.get(session_id)
+    if session is None:
+        return unknown_session(session_id)
+    # Every viewer reads the shared frames at its own pace, a slow one never holds up acquisition
+    return Response(session.broadcaster.subscribe(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# The routes of the single-headset server act on the default session
+app.add_url_rule('/annotate', 'default_annotate', annotate, methods=['POST'])
+app.add_url_rule('/start', 'default_start', start, methods=['POST'])
+app.add_url_rule('/stop', 'default_stop', stop, methods=['POST'])
+app.add_url_rule('/live', 'default_live', live_status, methods=['GET'])
+app.add_url_rule('/stream', 'default_stream', stream, methods=['GET'])
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Stage timings, bytes and memory growth in the Prometheus text format
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return {'status': 'failure', 'error': 'Unknown job id'}, 404
+    return job, 200
 
 
 def start_flask_app():
     app.run(host='0.0.0.0', port=5000)
 
 
-# Set correct Bluetooth port for windows or linux
-if platform == "linux" or platform == "linux2":
-    eeg.setup(mgr, port=com_port_linux, cap=channel_mapping)
-else:
-    eeg.setup(mgr, port=com_port, cap=channel_mapping)
+# Connect the default headset
+if default_port:
+    sessions.create(default_port, channel_mapping, session_id=DEFAULT_SESSION)
+
+# Retry post-stop jobs that were interrupted by a restart
+resumed_jobs = job_queue.resume()
+if resumed_jobs:
+    print(f"Resumed {len(resumed_jobs)} pending jobs")
 
 # Start the Flask app in a separate thread
 flask_thread = threading.Thread(target=start_flask_app)
@@ -0,0 +1,153 @@
+"""Work done after a recording has stopped.
+
+`process_recording` is run by the job queue in `record_flask.py`: it streams the
+FIF file from the recording store to storage, renders and uploads the overview
+plot and reports both URLs to the Spring server. Every step is a job stage, so a
+retried job only redoes the steps that did not finish. `recording_failed`
+handles jobs that will not be retried.
+
+The plot is rendered from the recording store one block at a time: every block
+is read from the sample file, preprocessed and reduced to the pixel columns it
+covers, so memory does not grow with the length of the recording.
+"""
+import os
+import time
+from concurrent.futures import wait
+
+import mne
+import numpy as np
+import requests
+
+from eeg_stream import EEGDiskStore
+from jobs import DONE
+from metrics import span
+from plot_render import render_overview_blocks
+from preprocessing import default_preprocessor
+
+
+def public_url(result):
+    # The timestamp makes clients fetch the new file instead of a cached older upload
+    return result.url + "?timestamp=" + str(time.time())
+
+
+def preprocessed_blocks(store, picks, eeg_rows, preprocessor=default_preprocessor, block_seconds=60.0,
+                        pad_seconds=10.0):
+    """Yield `(start, block)` pieces of the channels `picks` of `store`, preprocessed, one at a time.
+
+    Every piece is read with `pad_seconds` of samples on both sides, its rows `eeg_rows` are filtered with
+    `Preprocessor.apply_array` and the padding is dropped again, so the edges of the filter fall outside it.
+    """
+    data = store.get_data()
+    n_times = data.shape[-1]
+    size = max(int(block_seconds * store.sfreq), 1)
+    pad = int(pad_seconds * store.sfreq)
+    for start in range(0, n_times, size):
+        stop = min(start + size, n_times)
+        first, last = max(start - pad, 0), min(stop + pad, n_times)
+        # A copy: the sample file is read-only and is uploaded at the same time
+        block = np.array(data[picks, first:last], dtype=preprocessor.dtype)
+        if len(eeg_rows):
+            preprocessor.apply_array(block, store.sfreq, picks=eeg_rows)
+        yield start, block[:, start - first:stop - first]
+
+
+@span('plot')
+def show_recorded_data(store, user_id, preprocessor=default_preprocessor):
+    # The annotations of the recording; no samples are read here
+    raw = store.to_raw()
+    events, event_id = mne.events_from_annotations(raw, verbose=False)
+    descriptions = {id: description for description, id in event_id.items()}
+    labels = [descriptions[event[2]] for event in events]
+    for event, description in zip(events, labels):
+        print(f'Timestamp: {event[0]}, Annotation: {description}')
+
+    # The channels left after preprocessing, of which the EEG ones are filtered
+    picks = [i for i, ch_name in enumerate(raw.ch_names) if ch_name not in preprocessor.drop_channels]
+    eeg_rows = np.flatnonzero(np.isin(picks, mne.pick_types(raw.info, eeg=True, exclude=[])))
+
+    # The whole recording on one Agg image, decimated to its pixel width; event samples are converted to seconds
+    sfreq = store.sfreq
+    return render_overview_blocks(preprocessed_blocks(store, picks, eeg_rows, preprocessor), store.n_samples, sfreq,
+                                  [raw.ch_names[i] for i in picks],
+                                  event_times=(events[:, 0] - raw.first_samp) / sfreq, event_labels=labels,
+                                  title=f'Participant: {user_id}')
+
+
+def process_recording(job, uploader, spring_url):
+    """Job handler for a finished recording.
+
+    The job payload holds `user_id`, `jwt_token`, `start_timestamp` and `store_path`, the path of
+    the finalized `EEGDiskStore`. The queue should list `jwt_token` in its `secret_fields`, so the token
+    is not kept in the job database after the job has finished.
+    """
+    payload = job.payload
+    user_id = payload['user_id']
+    start_timestamp = payload['start_timestamp']
+    store_path = payload['store_path']
+    file_name = f'{store_path}-raw.fif'
+
+    def upload_fif():
+        raw = EEGDiskStore.open(store_path).to_raw()
+        # Add the start timestamp as a custom annotation
+        raw.info['temp'] = {'start_timestamp': start_timestamp}
+
+        # Write the FIF file and upload it to Firebase while it is being written
+        result = uploader.upload_raw_fif(f'fif/{user_id}-raw.fif', raw, file_name)
+        fif_url = public_url(result)
+        print(f'FIF file uploaded to: {fif_url} ({result.size} bytes in {result.duration:.2f} s)')
+        return fif_url
+
+    def upload_plot():
+        # Show recorded data and save plot to memory
+        plot_bytes = show_recorded_data(EEGDiskStore.open(store_path), user_id)
+        plot_bytes.seek(0)
+
+        # Upload the plot image to Firebase and print the public URL
+        result = uploader.upload(f'images/{user_id}-plot.png', plot_bytes, 'image/png')
+        image_url = public_url(result)
+        print(f'Image uploaded to: {image_url} ({result.duration:.2f} s)')
+        return image_url
+
+    def notify_spring():
+        # Send the URLs to the Spring server
+        headers = {'Authorization': f'Bearer {payload["jwt_token"]}'}  # Include JWT token in the header
+        with span('spring_callback'):
+            response = requests.post(f'{spring_url}/users/{user_id}/fifUrl',
+                                     json={"fifUrl": fif_url, "imageUrl": image_url, "startTime": start_timestamp},
+                                     headers=headers)  # Include start_timestamp
+        if response.status_code != 200:
+            raise RuntimeError(f'Error sending URLs to Spring server: {response.text}')
+        return response.status_code
+
+    def cleanup():
+        # Delete the recording store
+        EEGDiskStore.open(store_path).remove()
+
+    # The FIF upload runs on the upload pool while the plot is rendered and uploaded
+    fif_future = uploader.submit(job.run_stage, 'upload_fif', upload_fif)
+    try:
+        image_url = job.run_stage('upload_plot', upload_plot)
+    finally:
+        # Never leave the FIF upload running when the job ends; an error of the plot is raised first
+        wait([fif_future])
+    fif_url = fif_future.result()
+    job.run_stage('notify_spring', notify_spring)
+    job.run_stage('cleanup', cleanup)
+
+
+def recording_failed(job, error):
+    """Failure handler for `process_recording` jobs that have failed for good.
+
+    The recording store is removed if the FIF file made it to storage. Otherwise it is the only copy of
+    the recording, so it is kept and its path is reported.
+    """
+    store_path = job.payload['store_path']
+    if not os.path.exists(store_path + '.json'):
+        return
+    stage = job.stages.get('upload_fif')
+    if stage is not None and stage['status'] == DONE:
+        EEGDiskStore.open(store_path).remove()
+        print(f'Removed the recording store {store_path} of failed job {job.id}, the FIF file was uploaded')
+    else:
+        print(f'Job {job.id} failed before the FIF file was uploaded ({error}), '
+              f'the recording of user {job.payload["user_id"]} is kept in {store_path}')
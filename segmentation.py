@@ -0,0 +1,99 @@
+"""Question/response segmentation of annotated EEG recordings.
+
+During a session every question is marked with an annotation `Q<n>` and the
+participant's response with `R<n>`. `QRSegmenter` pairs them in one vectorized
+pass over the annotations and returns each question's segment as a view into a
+single preloaded data array, so no part of the recording is copied.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# label: the part of the description after the prefix, e.g. '3' for Q3/R3
+# start, stop: sample indices of the segment in the data array, stop exclusive
+# tmin, tmax: onsets of the question and response annotations in seconds
+# data: (n_channels, stop - start) view into the data array
+Segment = namedtuple('Segment', ['index', 'label', 'tmin', 'tmax', 'start', 'stop', 'data'])
+
+
+class QRSegmenter:
+    """Pairs question and response annotations and cuts the recording between them.
+
+    Parameters:
+    - question_prefix: prefix of question annotations.
+    - response_prefix: prefix of response annotations.
+    - match: 'first' pairs each question with the earliest response with the same label (what the
+      analysis scripts always did), 'next' with the earliest one at or after the question.
+    """
+
+    def __init__(self, question_prefix='Q', response_prefix='R', match='first'):
+        if match not in ('first', 'next'):
+            raise ValueError(f"match must be 'first' or 'next', not {match!r}")
+        self.question_prefix = question_prefix
+        self.response_prefix = response_prefix
+        self.match = match
+
+    def params(self):
+        """The settings that change the result, e.g. to key cached features."""
+        return {'question_prefix': self.question_prefix, 'response_prefix': self.response_prefix,
+                'match': self.match}
+
+    def find_pairs(self, annotations):
+        """Return (label, question onset, response onset) for every question that has a response."""
+        descriptions = np.array(list(annotations.description), dtype=str)
+        onsets = np.asarray(annotations.onset, dtype=float)
+        q_idx = np.flatnonzero(np.char.startswith(descriptions, self.question_prefix))
+        r_idx = np.flatnonzero(np.char.startswith(descriptions, self.response_prefix))
+        if len(q_idx) == 0 or len(r_idx) == 0:
+            return []
+
+        # Map the labels of both kinds to shared integer keys
+        q_labels = np.char.replace(descriptions[q_idx], self.question_prefix, '', count=1)
+        r_labels = np.char.replace(descriptions[r_idx], self.response_prefix, '', count=1)
+        labels, keys = np.unique(np.concatenate([q_labels, r_labels]), return_inverse=True)
+        q_keys, r_keys = keys[:len(q_idx)], keys[len(q_idx):]
+        q_onsets, r_onsets = onsets[q_idx], onsets[r_idx]
+
+        # Sort responses by (label, onset) and search all questions at once. Offsetting every
+        # label by more than the recording length turns this into one sorted 1-D array.
+        span = max(onsets.max() - onsets.min(), 0.0) + 1.0
+        order = np.lexsort((r_onsets, r_keys))
+        r_sorted = r_keys[order] * span + (r_onsets[order] - onsets.min())
+        if self.match == 'first':
+            q_search = q_keys * span - 0.5
+        else:
+            q_search = q_keys * span + (q_onsets - onsets.min())
+        pos = np.searchsorted(r_sorted, q_search, side='left')
+        found = pos < len(order)
+        found[found] = r_keys[order[pos[found]]] == q_keys[found]
+
+        r_found = r_onsets[order[pos[found]]]
+        return [(label, q_onset, r_onset)
+                for label, q_onset, r_onset in zip(labels[q_keys[found]], q_onsets[found], r_found)]
+
+    def segment(self, data, sfreq, pairs, first_time=0.0):
+        """Cut `data` (n_channels, n_times) into one view per (label, tmin, tmax) pair.
+
+        `first_time` is the time of the first sample on the annotation time axis. Like `raw.crop`,
+        both the question and the response sample are included.
+        """
+        n_times = data.shape[1]
+        segments = []
+        for index, (label, tmin, tmax) in enumerate(pairs):
+            start = min(max(int(round((tmin - first_time) * sfreq)), 0), n_times)
+            stop = min(max(int(round((tmax - first_time) * sfreq)) + 1, start), n_times)
+            segments.append(Segment(index, label, tmin, tmax, start, stop, data[:, start:stop]))
+        return segments
+
+    def segment_raw(self, raw):
+        """Segment a Raw object. Loads the data if needed; the segments are views into `raw`'s own data."""
+        raw.load_data()
+        pairs = self.find_pairs(raw.annotations)
+        # Annotation onsets count from the measurement start when orig_time is set
+        first_time = raw.first_time if raw.annotations.orig_time is not None else 0.0
+        return self.segment(raw._data, raw.info['sfreq'], pairs, first_time=first_time)
+
+
+def segment_times(segment, sfreq):
+    """Times of a segment's samples in seconds from the segment start, like `raw.crop(...).times`."""
+    return np.arange(segment.stop - segment.start) / sfreq
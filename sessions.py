@@ -0,0 +1,229 @@
+"""Recording sessions of the EEG server, one per headset.
+
+A `RecordingSession` owns everything one headset needs: its `EEGManager` and
+`acquisition.EEG` on its own port and channel mapping, the on-disk store, the
+drain thread, live signal processing, the annotation queue and the stream of
+live frames. The acquisition callbacks and the drain run in the session's own
+threads and every session has its own lock, so several headsets can record in
+parallel on one machine without waiting for each other.
+
+`SessionManager` keeps the sessions by session ID for the Flask routes.
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from annotation_queue import AnnotationQueue
+from eeg_stream import EEGDiskStore, EEGDrain
+from live_dsp import LiveDSP
+from live_stream import EEGFramePublisher, FrameBroadcaster
+from simulated_eeg import get_backend
+
+# Session states
+CONNECTED = 'CONNECTED'
+RECORDING = 'RECORDING'
+STOPPED = 'STOPPED'
+
+
+class SessionError(Exception):
+    pass
+
+
+def parse_channel_mapping(value):
+    """Parse a channel mapping like '0:Fp1,1:Fp2' (the CHANNEL_MAPPING format) or a dict into {int: name}."""
+    if isinstance(value, dict):
+        return {int(k): v for k, v in value.items()}
+    return {int(k): v for k, v in (x.split(':') for x in value.split(','))}
+
+
+def default_device():
+    """Create the acquisition object and manager of the headset backend chosen by EEG_BACKEND."""
+    EEG, EEGManager = get_backend()
+    return EEG(), EEGManager()
+
+
+class RecordingSession:
+    """One headset and the recording of one participant at a time.
+
+    Parameters:
+    - session_id: ID of the session in the routes.
+    - port: serial or Bluetooth port of the headset.
+    - channel_mapping: {channel index: electrode name} of the headset's cap.
+    - device_factory: callable returning `(eeg, mgr)`, by default `default_device`.
+    - recording_dir: directory the recordings are streamed to.
+    - drain_interval: seconds between drains of the acquisition buffer.
+    - live_window, live_update_interval: band power window and update interval in seconds.
+    - stream_rate, stream_dtype, stream_buffer: settings of the live frame stream.
+    """
+
+    def __init__(self, session_id, port, channel_mapping, device_factory=default_device, recording_dir='recordings',
+                 drain_interval=0.5, live_window=2.0, live_update_interval=0.5, stream_rate=125.0,
+                 stream_dtype='int16', stream_buffer=256):
+        self.session_id = session_id
+        self.port = port
+        self.channel_mapping = channel_mapping
+        self.device_factory = device_factory
+        self.recording_dir = recording_dir
+        self.drain_interval = drain_interval
+        self.live_window = live_window
+        self.live_update_interval = live_update_interval
+        self.stream_rate = stream_rate
+        self.stream_dtype = stream_dtype
+
+        self.broadcaster = FrameBroadcaster(capacity=stream_buffer)
+        self.annotation_queue = AnnotationQueue()
+        self.state = None
+        self.user_id = None
+        self.jwt_token = None
+        self.start_timestamp = None
+        self.eeg = None
+        self.mgr = None
+        self.store = None
+        self.drain = None
+        self.live = None
+        # Serializes start/stop of this session only
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Connect to the headset. Blocks until it is connected."""
+        with self._lock:
+            self.eeg, self.mgr = self.device_factory()
+            self.eeg.setup(self.mgr, port=self.port, cap=self.channel_mapping)
+            self.state = CONNECTED
+
+    def start(self, user_id, jwt_token=None):
+        """Start recording `user_id`, streaming the samples to disk."""
+        with self._lock:
+            if self.state != CONNECTED:
+                raise SessionError(f'Session {self.session_id} is {self.state}, not {CONNECTED}')
+            self.user_id = user_id
+            self.jwt_token = jwt_token
+            self.store = EEGDiskStore.create(
+                os.path.join(self.recording_dir, f'{user_id}-{int(time.time())}'), self.eeg.info)
+            self.live = LiveDSP(self.eeg.info, window=self.live_window, update_interval=self.live_update_interval)
+            self.live.listeners.append(EEGFramePublisher(self.broadcaster, self.live.sfreq, self.live.ch_names,
+                                                         target_rate=self.stream_rate, dtype=self.stream_dtype))
+            self.annotation_queue.pop_all()  # drop markers sent before the recording
+            self.drain = EEGDrain(self.eeg, self.store, interval=self.drain_interval, consumers=[self.live],
+                                  annotation_queue=self.annotation_queue,
+                                  annotation_consumers=[self._publish_annotation])
+            self.eeg.start_acquisition()
+            self.drain.start()
+            self.start_timestamp = datetime.now().isoformat()  # Save the current timestamp
+            self.state = RECORDING
+
+    def stop(self):
+        """Stop the recording and disconnect the headset. Returns the payload of the post-stop job."""
+        with self._lock:
+            if self.state != RECORDING:
+                raise SessionError(f'Session {self.session_id} is {self.state}, not {RECORDING}')
+            # stop acquisition and flush the samples and annotations that were not drained yet
+            self.eeg.stop_acquisition()
+            self.drain.stop()
+            self.broadcaster.publish('stop', {'user_id': self.user_id})
+            self.mgr.disconnect()
+
+            self.store.extra['start_timestamp'] = self.start_timestamp
+            self.store.finalize()
+
+            # Close brainaccess library
+            self.eeg.close()
+            self.state = STOPPED
+            return {
+                'session_id': self.session_id,
+                'user_id': self.user_id,
+                'jwt_token': self.jwt_token,
+                'start_timestamp': self.start_timestamp,
+                'store_path': self.store.path,
+            }
+
+    def close(self):
+        """Stop a running recording, release the headset and end the live streams of the viewers.
+
+        Returns the payload of the post-stop job if it was recording.
+        """
+        try:
+            if self.state == RECORDING:
+                return self.stop()
+            with self._lock:
+                if self.state == CONNECTED:
+                    self.mgr.disconnect()
+                    self.eeg.close()
+                self.state = STOPPED
+        finally:
+            self.broadcaster.close()
+
+    def annotate(self, description, **kwargs):
+        """Queue an annotation, see `AnnotationQueue.put`."""
+        return self.annotation_queue.put(description, **kwargs)
+
+    def live_snapshot(self):
+        return self.live.snapshot() if self.live is not None else None
+
+    def _publish_annotation(self, onset, description):
+        self.broadcaster.publish('annotation', {'annotation': description, 'time': onset})
+
+    def status(self):
+        return {
+            'session_id': self.session_id,
+            'state': self.state,
+            'port': self.port,
+            'user_id': self.user_id,
+            'start_timestamp': self.start_timestamp,
+            'samples': self.store.n_samples if self.store is not None else 0,
+        }
+
+
+class SessionManager:
+    """Recording sessions by session ID.
+
+    Parameters:
+    - session_options: keyword arguments passed to every `RecordingSession`.
+    """
+
+    def __init__(self, **session_options):
+        self.session_options = session_options
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, port, channel_mapping, session_id=None):
+        """Create a session and connect its headset. Returns the session."""
+        session_id = session_id or uuid.uuid4().hex
+        session = RecordingSession(session_id, port, channel_mapping, **self.session_options)
+        with self._lock:
+            replaced = self._sessions.get(session_id)
+            if replaced is not None and replaced.state != STOPPED:
+                raise SessionError(f'Session {session_id} already exists')
+            for other in self._sessions.values():
+                if other.port == port and other.state != STOPPED:
+                    raise SessionError(f'Port {port} is used by session {other.session_id}')
+            self._sessions[session_id] = session
+        if replaced is not None:
+            # Viewers of the stopped session are ended, so they can reconnect to the new one
+            replaced.close()
+        try:
+            # Connecting takes seconds; other sessions are not held up meanwhile
+            session.connect()
+        except Exception:
+            with self._lock:
+                self._sessions.pop(session_id, None)
+            raise
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def remove(self, session_id):
+        """Close a session and forget it. Returns the payload of the post-stop job if it was recording."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise KeyError(session_id)
+        return session.close()
@@ -0,0 +1,236 @@
+"""Simulated BrainAccess headset for testing and benchmarking without hardware.
+
+`SimulatedEEG` and `SimulatedEEGManager` implement the part of
+`brainaccess.utils.acquisition.EEG` and `brainaccess.core.eeg_manager.EEGManager`
+the recorder uses: `setup`, `start_acquisition`, `annotate`, `get_annotations`,
+`get_mne`, `stop_acquisition`, `close`, `disconnect`, and the `lock`, `info`,
+`channels_indexes` and `data` (`data.data` block list, `zeros_at_start`)
+attributes that `eeg_stream.EEGDrain` reads.
+
+Blocks are appended to `data.data` from a background thread, like the device's
+chunk callback does, with the sample counter in the first row and the channels
+in device order. The signal is either generated (alpha rhythm plus noise) or
+replayed in a loop from a FIF file, in real time or `speed` times faster.
+
+Set `EEG_BACKEND=simulated` to make the recorder scripts use it, see `get_backend`.
+"""
+import os
+import threading
+import time
+
+import mne
+import numpy as np
+
+DEFAULT_CAP = {0: "F3", 1: "F4", 2: "C3", 3: "C4", 4: "P3", 5: "P4", 6: "O1", 7: "O2"}
+ACCEL_CHANNELS = ['Accel_x', 'Accel_y', 'Accel_z']
+
+
+def get_backend(name=None):
+    """Return the `(EEG, EEGManager)` classes of the backend named by `name` or the EEG_BACKEND variable.
+
+    'brainaccess' (the default) is the real headset, 'simulated' the classes of this module.
+    """
+    name = name or os.getenv('EEG_BACKEND', 'brainaccess')
+    if name == 'simulated':
+        return SimulatedEEG, SimulatedEEGManager
+    if name != 'brainaccess':
+        raise ValueError(f"Unknown EEG backend {name!r}, use 'brainaccess' or 'simulated'")
+    from brainaccess.core.eeg_manager import EEGManager
+    from brainaccess.utils import acquisition
+
+    return acquisition.EEG, EEGManager
+
+
+class SimulatedEEGManager:
+    """Stands in for `EEGManager`: connection state and the annotations stamped with the current sample."""
+
+    def __init__(self):
+        self.connected = False
+        self.port = None
+        # Number of the latest sample, set by SimulatedEEG
+        self.sample_number = 0
+        self._annotations = []
+        self._timestamps = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect()
+
+    def connect(self, port):
+        self.port = port
+        self.connected = True
+        return 0
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+        self.clear_annotations()
+
+    def annotate(self, annotation):
+        with self._lock:
+            self._annotations.append(annotation)
+            self._timestamps.append(self.sample_number)
+
+    def get_annotations(self):
+        with self._lock:
+            return {'annotations': list(self._annotations), 'timestamps': list(self._timestamps)}
+
+    def clear_annotations(self):
+        with self._lock:
+            self._annotations = []
+            self._timestamps = []
+
+
+class SimulatedEEGData:
+    """The accumulated blocks and their conversion to mne, like brainaccess' `EEGData`."""
+
+    def __init__(self, info, lock, zeros_at_start=0):
+        self.eeg_info = info
+        self.lock = lock
+        self.zeros_at_start = zeros_at_start
+        self.data = [np.zeros((len(info.ch_names), zeros_at_start))]
+        self.annotations = {}
+        self.mne_raw = None
+
+    def convert_to_mne(self, tim=None, samples=None, annotations=True, channels_indexes=None):
+        with self.lock:
+            blocks = list(self.data)
+        data = np.concatenate(blocks, axis=1)
+        if data.shape[1] == 0:
+            print("No data to convert to MNE structure")
+            return
+        onset = []
+        description = []
+        if annotations and self.annotations:
+            # The first row holds the sample counter, as on the device
+            timestamp_correction = data[0][0]
+            for annotation, timestamp in zip(self.annotations['annotations'], self.annotations['timestamps']):
+                description.append(annotation)
+                onset.append((timestamp + self.zeros_at_start - timestamp_correction) / self.eeg_info['sfreq'])
+        keep = int(tim * self.eeg_info['sfreq']) if tim else samples
+        if keep:
+            onset = [x - (data.shape[1] - keep) / self.eeg_info['sfreq'] for x in onset]
+            data = data[:, -keep:]
+        if channels_indexes:
+            data = data[channels_indexes]
+        self.mne_raw = mne.io.RawArray(data, self.eeg_info, verbose=False)
+        if annotations:
+            self.mne_raw.set_annotations(mne.Annotations(onset, np.zeros(len(onset)), description), verbose=False)
+
+    def save(self, fname):
+        with self.lock:
+            self.mne_raw.save(fname=fname, verbose=False, overwrite=True, fmt="double")
+
+
+class SimulatedEEG:
+    """Drop-in replacement for `acquisition.EEG` that generates or replays data.
+
+    Parameters (each defaults to the environment variable in brackets):
+    - source: FIF file whose EEG channels are replayed in a loop; None generates data (SIM_SOURCE).
+    - speed: how many times faster than real time samples are produced; 0 means as fast as
+      possible (SIM_SPEED, 1).
+    - chunk_size: samples per block (SIM_CHUNK_SIZE, 10).
+    - seed: seed of the generated signal (SIM_SEED).
+    """
+
+    def __init__(self, mode="accumulate", source=None, speed=None, chunk_size=None, seed=None):
+        if mode != "accumulate":
+            raise ValueError("SimulatedEEG only supports the accumulate mode")
+        self.mode = mode
+        self.source = source or os.getenv('SIM_SOURCE') or None
+        self.speed = float(os.getenv('SIM_SPEED', '1') if speed is None else speed)
+        self.chunk_size = int(os.getenv('SIM_CHUNK_SIZE', '10') if chunk_size is None else chunk_size)
+        seed = os.getenv('SIM_SEED') if seed is None else seed
+        self._rng = np.random.default_rng(None if seed is None else int(seed))
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def setup(self, mgr, port=None, cap=None, zeros_at_start=0, bias=None, gain=8, sfreq=250, device_name=None):
+        """Connect to the simulated headset and create `info` for `cap` (index: name) at `sfreq` Hz."""
+        self.mgr = mgr
+        mgr.connect(port or device_name)
+        self.zeros_at_start = zeros_at_start
+        cap = cap or DEFAULT_CAP
+
+        self._replay = None
+        if self.source:
+            raw = mne.io.read_raw_fif(self.source, preload=True, verbose=False)
+            picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+            self._replay = raw.get_data(picks=picks)
+            sfreq = raw.info['sfreq']
+        self.sfreq = sfreq
+
+        ch_names = list(cap.values()) + ACCEL_CHANNELS + ['Sample']
+        ch_types = ['eeg'] * len(cap) + ['misc'] * len(ACCEL_CHANNELS) + ['syst']
+        self.info = mne.create_info(ch_names, ch_types=ch_types, sfreq=sfreq)
+        self.chans = len(ch_names)
+        # Blocks arrive in device order: sample counter, EEG channels, accelerometer
+        device_order = ['Sample'] + list(cap.values()) + ACCEL_CHANNELS
+        self.channels_indexes = {name: device_order.index(name) for name in ch_names}
+        self.n_eeg = len(cap)
+
+        self.lock = threading.Lock()
+        self.data = SimulatedEEGData(self.info, lock=self.lock, zeros_at_start=zeros_at_start)
+        self._n_samples = 0
+        self._phase = self._rng.uniform(0, 2 * np.pi, self.n_eeg)
+
+    def start_acquisition(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._acquire, daemon=True)
+        self._thread.start()
+
+    def stop_acquisition(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def annotate(self, msg):
+        self.mgr.annotate(msg)
+
+    def get_annotations(self):
+        self.data.annotations = self.mgr.get_annotations()
+        return self.data.annotations
+
+    def get_mne(self, tim=None, samples=None, annotations=True):
+        if annotations:
+            self.get_annotations()
+        self.data.convert_to_mne(tim=tim, samples=samples, annotations=annotations,
+                                 channels_indexes=list(self.channels_indexes.values()))
+        return self.data.mne_raw
+
+    def close(self):
+        self.stop_acquisition()
+
+    def _acquire(self):
+        started = time.perf_counter()
+        while not self._stop_event.is_set():
+            chunk = self._next_chunk()
+            # Like the device callback: append without the lock
+            self.data.data.append(chunk)
+            self.mgr.sample_number = self._n_samples - 1
+            if self.speed > 0:
+                delay = started + self._n_samples / (self.sfreq * self.speed) - time.perf_counter()
+                if delay > 0:
+                    self._stop_event.wait(delay)
+
+    def _next_chunk(self):
+        n = self.chunk_size
+        sample_numbers = self._n_samples + np.arange(n)
+        self._n_samples += n
+        if self._replay is not None:
+            columns = sample_numbers % self._replay.shape[1]
+            rows = np.arange(self.n_eeg) % self._replay.shape[0]
+            eeg = self._replay[rows][:, columns]
+        else:
+            # 10 Hz alpha of 10 uV and 5 uV of white noise, in volts like mne
+            t = sample_numbers / self.sfreq
+            alpha = 10e-6 * np.sin(2 * np.pi * 10 * t[np.newaxis, :] + self._phase[:, np.newaxis])
+            eeg = alpha + 5e-6 * self._rng.standard_normal((self.n_eeg, n))
+        accel = np.zeros((len(ACCEL_CHANNELS), n))
+        return np.vstack([sample_numbers[np.newaxis, :].astype(float), eeg, accel])
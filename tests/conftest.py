@@ -0,0 +1,15 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# The modules of this repository live in its root directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Caches and stores created when the modules are imported go to a temporary directory, not the working one
+_cache_dir = tempfile.mkdtemp(prefix='brainaccess-tests-')
+atexit.register(shutil.rmtree, _cache_dir, ignore_errors=True)
+os.environ.setdefault('BLOB_CACHE_DIR', os.path.join(_cache_dir, 'blob_cache'))
+os.environ.setdefault('AUDIO_CACHE_DIR', os.path.join(_cache_dir, 'decoded'))
+os.environ.setdefault('FEATURE_STORE_PATH', os.path.join(_cache_dir, 'features.sqlite3'))
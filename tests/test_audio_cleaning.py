@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from audio_cleaning import AudioCleaner
+from audio_io import Audio
+
+RATE = 16000
+
+
+def tone(seconds, amplitude=0.5, freq=150.0):
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (amplitude * np.sin(2 * np.pi * freq * t)).astype(np.float32)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * RATE), dtype=np.float32)
+
+
+@pytest.fixture
+def cleaner():
+    return AudioCleaner()
+
+
+def kept_seconds(cleaner, samples):
+    return cleaner.silence_mask(samples, RATE, 0.5).sum() / RATE
+
+
+def test_edge_silences_keep_padding_on_the_inner_side_only(cleaner):
+    samples = np.concatenate([silence(1.5), tone(1.0), silence(1.5)])
+    mask = cleaner.silence_mask(samples, RATE, 0.5)
+    assert mask.sum() / RATE == pytest.approx(1.2)
+    # The kept samples are the tone and 0.1 s of silence before and after it
+    np.testing.assert_array_equal(np.flatnonzero(mask)[[0, -1]], [int(1.4 * RATE), int(2.6 * RATE) - 1])
+
+
+def test_inner_silence_is_cut_to_padding_on_both_sides(cleaner):
+    samples = np.concatenate([tone(1.0), silence(2.0), tone(1.0)])
+    assert kept_seconds(cleaner, samples) == pytest.approx(2.2)
+
+
+def test_short_silences_are_kept(cleaner):
+    samples = np.concatenate([tone(1.0), silence(0.4), tone(1.0)])
+    assert kept_seconds(cleaner, samples) == pytest.approx(2.4)
+
+
+def test_clip_without_silence_is_kept(cleaner):
+    samples = tone(2.0)
+    assert cleaner.silence_mask(samples, RATE, 0.5).all()
+
+
+def test_samples_after_the_last_frame_follow_it(cleaner):
+    samples = np.concatenate([tone(1.0), silence(1.0), np.zeros(37, dtype=np.float32)])
+    mask = cleaner.silence_mask(samples, RATE, 0.5)
+    assert not mask[-37:].any()
+    assert mask.sum() / RATE == pytest.approx(1.1)
+
+
+@pytest.mark.parametrize('samples, peak', [(np.zeros(0, dtype=np.float32), 0.5), (silence(1.0), 0.0),
+                                           (np.zeros(50, dtype=np.float32), 0.5)])
+def test_nothing_is_removed_without_frames_or_peak(cleaner, samples, peak):
+    assert cleaner.silence_mask(samples, RATE, peak).all()
+
+
+def test_cleaning_an_empty_clip_returns_an_empty_clip(cleaner):
+    cleaned = cleaner.clean(Audio(np.zeros(0, dtype=np.float32), RATE))
+    assert len(cleaned.samples) == 0
+    assert cleaned.sample_rate == RATE
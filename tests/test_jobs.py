@@ -0,0 +1,134 @@
+import json
+import sqlite3
+import time
+
+from jobs import DONE, FAILED, PENDING, RUNNING, JobQueue
+
+
+def wait_for(queue, job_id, statuses=(DONE, FAILED), timeout=10):
+    # Retries are scheduled on timers, so shutdown() alone does not wait for them
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f'Job {job_id} is still {queue.get(job_id)["status"]}')
+
+
+def stored_payload(db_path, job_id):
+    with sqlite3.connect(db_path) as conn:
+        return json.loads(conn.execute('SELECT payload FROM jobs WHERE id = ?', (job_id,)).fetchone()[0])
+
+
+def test_retry_skips_finished_stages(tmp_path):
+    calls = {'first': 0, 'second': 0}
+
+    def first():
+        calls['first'] += 1
+        return 'url'
+
+    def second():
+        calls['second'] += 1
+        if calls['second'] == 1:
+            raise IOError('upload interrupted')
+        return 'ok'
+
+    def handler(job):
+        assert job.run_stage('first', first) == 'url'
+        job.run_stage('second', second)
+
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), {'recording': handler}, retry_delay=0.01)
+    job_id = queue.submit('recording', {})
+    job = wait_for(queue, job_id)
+    queue.shutdown()
+
+    assert job['status'] == DONE
+    assert job['attempts'] == 2
+    assert calls == {'first': 1, 'second': 2}
+    assert {name: stage['status'] for name, stage in job['stages'].items()} == {'first': DONE, 'second': DONE}
+
+
+def test_job_fails_after_max_attempts(tmp_path):
+    failures = []
+
+    def handler(job):
+        job.run_stage('upload', lambda: 1 / 0)
+
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), {'recording': handler}, max_attempts=3, retry_delay=0.01,
+                     failure_handlers={'recording': lambda job, error: failures.append((job.id, error))})
+    job_id = queue.submit('recording', {'store_path': 'recordings/u-1'})
+    job = wait_for(queue, job_id)
+    queue.shutdown()
+
+    assert job['status'] == FAILED
+    assert job['attempts'] == 3
+    assert job['stages']['upload']['status'] == FAILED
+    assert 'division by zero' in job['error']
+    assert len(failures) == 1
+    assert failures[0][0] == job_id
+    assert isinstance(failures[0][1], ZeroDivisionError)
+
+
+def test_secret_fields_are_removed_when_a_job_ends(tmp_path):
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    tokens = []
+
+    def handler(job):
+        tokens.append(job.payload['jwt_token'])
+        if job.payload['fail']:
+            raise RuntimeError('Spring is down')
+
+    queue = JobQueue(db_path, {'recording': handler}, max_attempts=2, retry_delay=0.01,
+                     secret_fields=('jwt_token',))
+    done_id = queue.submit('recording', {'user_id': 'u', 'jwt_token': 'secret', 'fail': False})
+    failed_id = queue.submit('recording', {'user_id': 'u', 'jwt_token': 'secret', 'fail': True})
+    wait_for(queue, done_id)
+    wait_for(queue, failed_id)
+    queue.shutdown()
+
+    # Every attempt, including the retry, still had the token
+    assert tokens == ['secret'] * 3
+    assert stored_payload(db_path, done_id) == {'user_id': 'u', 'fail': False}
+    assert stored_payload(db_path, failed_id) == {'user_id': 'u', 'fail': True}
+
+
+def test_secret_fields_of_old_jobs_are_removed_on_start(tmp_path):
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    queue = JobQueue(db_path, {'recording': lambda job: None})
+    job_id = queue.submit('recording', {'jwt_token': 'secret'})
+    queue.shutdown()
+    assert stored_payload(db_path, job_id) == {'jwt_token': 'secret'}
+
+    JobQueue(db_path, {'recording': lambda job: None}, secret_fields=('jwt_token',)).shutdown()
+    assert stored_payload(db_path, job_id) == {}
+
+
+def test_resume_reruns_interrupted_jobs_from_their_last_stage(tmp_path):
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    JobQueue(db_path, {}).shutdown()
+    # Jobs as a process that stopped in the middle of them left them
+    stages = {'upload_fif': {'status': DONE, 'started_at': 0, 'duration': 1.0, 'result': 'fif-url'},
+              'upload_plot': {'status': RUNNING, 'started_at': 0, 'duration': None, 'result': None}}
+    with sqlite3.connect(db_path) as conn:
+        for job_id, status, job_stages, created_at in (('running', RUNNING, stages, 1), ('pending', PENDING, {}, 2),
+                                                       ('finished', DONE, {}, 0)):
+            conn.execute('INSERT INTO jobs (id, kind, payload, status, stages, attempts, created_at, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?, 1, ?, ?)',
+                         (job_id, 'recording', '{}', status, json.dumps(job_stages), created_at, created_at))
+
+    ran = []
+
+    def handler(job):
+        fif_url = job.run_stage('upload_fif', lambda: ran.append((job.id, 'upload_fif')) or 'new-url')
+        job.run_stage('upload_plot', lambda: ran.append((job.id, 'upload_plot')) or fif_url)
+
+    queue = JobQueue(db_path, {'recording': handler}, max_workers=1)
+    assert queue.resume() == ['running', 'pending']
+    queue.shutdown()
+
+    assert ran == [('running', 'upload_plot'), ('pending', 'upload_fif'), ('pending', 'upload_plot')]
+    assert queue.get('running')['status'] == DONE
+    assert queue.get('running')['attempts'] == 2
+    assert queue.get('pending')['status'] == DONE
+    assert queue.get('finished')['attempts'] == 1
@@ -0,0 +1,75 @@
+import threading
+
+from live_stream import FrameBroadcaster, format_event
+from sessions import STOPPED, SessionManager
+
+
+class FakeDevice:
+    def setup(self, mgr, port, cap):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def read_in_thread(stream):
+    messages = []
+    thread = threading.Thread(target=lambda: messages.extend(stream), daemon=True)
+    thread.start()
+    return thread, messages
+
+
+def test_close_sends_pending_messages_and_end():
+    broadcaster = FrameBroadcaster(capacity=8)
+    broadcaster.set_header('channels', {'ch_names': ['F3']})
+    thread, messages = read_in_thread(broadcaster.subscribe(heartbeat=10))
+    broadcaster.publish('annotation', {'annotation': 'Q1', 'time': 1.0})
+    broadcaster.close()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert messages[0] == format_event('channels', {'ch_names': ['F3']})
+    assert format_event('annotation', {'annotation': 'Q1', 'time': 1.0}) in messages
+    assert messages[-1] == format_event('end', {})
+
+
+def test_subscribing_to_a_closed_broadcaster_ends_at_once():
+    broadcaster = FrameBroadcaster()
+    broadcaster.set_header('channels', {'ch_names': ['F3']})
+    broadcaster.close()
+    assert list(broadcaster.subscribe(heartbeat=10)) == [format_event('end', {})]
+
+
+def test_slow_viewer_is_told_how_many_messages_it_missed():
+    broadcaster = FrameBroadcaster(capacity=4)
+    broadcaster.set_header('channels', {'ch_names': ['F3']})
+    stream = broadcaster.subscribe(heartbeat=10)
+    assert next(stream) == format_event('channels', {'ch_names': ['F3']})
+    for i in range(11):
+        broadcaster.publish('frame', i)
+    broadcaster.close()
+    assert list(stream) == [format_event('dropped', {'count': 7})] + [format_event('frame', i) for i in range(7, 11)] \
+        + [format_event('end', {})]
+
+
+def test_replacing_a_stopped_session_ends_its_viewers(tmp_path):
+    device = FakeDevice()
+    sessions = SessionManager(recording_dir=str(tmp_path), device_factory=lambda: (device, device))
+    old = sessions.create('COM1', {0: 'F3'}, session_id='default')
+    thread, messages = read_in_thread(old.broadcaster.subscribe(heartbeat=10))
+    old.close()
+    thread.join(timeout=5)
+    assert messages == [format_event('end', {})]
+
+    old = sessions.create('COM1', {0: 'F3'}, session_id='default')
+    old.state = STOPPED
+    thread, messages = read_in_thread(old.broadcaster.subscribe(heartbeat=10))
+    new = sessions.create('COM1', {0: 'F3'}, session_id='default')
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert messages == [format_event('end', {})]
+    assert sessions.get('default') is new
@@ -0,0 +1,72 @@
+import re
+
+import pytest
+
+from jobs import DONE, JobQueue
+from metrics import MetricsRegistry
+
+LINE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+
+def parse_exposition(text):
+    """(name, [(label, value), ...], value) of every sample line."""
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = LINE.match(line)
+        assert match, f'Not a sample line: {line!r}'
+        labels = LABEL.findall(match['labels'] or '')
+        assert ','.join(f'{k}="{v}"' for k, v in labels) == (match['labels'] or ''), line
+        samples.append((match['name'], labels, float(match['value'])))
+    return samples
+
+
+def assert_unique_label_names(text):
+    for name, labels, _ in parse_exposition(text):
+        names = [label for label, _ in labels]
+        assert len(names) == len(set(names)), f'{name} repeats a label: {labels}'
+
+
+def test_render_prometheus_has_no_repeated_labels():
+    registry = MetricsRegistry()
+    with registry.span('upload', content_type='image/png') as span:
+        span.add_bytes(10)
+    with registry.span('drain'):
+        pass
+    text = registry.render_prometheus()
+    assert_unique_label_names(text)
+    samples = parse_exposition(text)
+    assert ('eeg_stage_bytes_total', [('stage', 'upload'), ('content_type', 'image/png')], 10.0) in samples
+    counts = {tuple(labels): value for name, labels, value in samples
+              if name == 'eeg_stage_seconds_bucket' and ('le', '+Inf') in labels}
+    assert counts[(('stage', 'drain'), ('le', '+Inf'))] == 1
+
+
+@pytest.mark.parametrize('label', ['stage', 'le'])
+def test_reserved_label_names_are_rejected(label):
+    with pytest.raises(ValueError):
+        MetricsRegistry().span('upload', **{label: 'x'})
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    with registry.span('upload', blob='a"b\\c\nd'):
+        pass
+    samples = parse_exposition(registry.render_prometheus())
+    assert ('blob', 'a\\"b\\\\c\\nd') in samples[0][1]
+
+
+def test_job_stages_export_valid_labels(tmp_path, monkeypatch):
+    import metrics
+
+    registry = MetricsRegistry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), {'recording': lambda job: job.run_stage('upload_fif', lambda: 1)})
+    job_id = queue.submit('recording', {})
+    queue.shutdown()
+    assert queue.get(job_id)['status'] == DONE
+    text = registry.render_prometheus()
+    assert_unique_label_names(text)
+    assert 'job_stage="upload_fif"' in text
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from plot_render import minmax_decimate, minmax_decimate_blocks
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 250, 999, 5000])
+def test_blocks_give_the_same_envelope_as_the_whole_array(block_size):
+    data = np.random.default_rng(0).standard_normal((3, 4321))
+    blocks = ((start, data[:, start:start + block_size]) for start in range(0, data.shape[-1], block_size))
+    positions, values = minmax_decimate_blocks(blocks, data.shape[-1], 100)
+    expected_positions, expected_values = minmax_decimate(data, 100)
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_array_equal(values, expected_values)
+
+
+def test_envelope_alternates_minimum_and_maximum_of_every_bin():
+    data = np.arange(20.0)[np.newaxis]
+    positions, values = minmax_decimate(data, 4)
+    np.testing.assert_array_equal(values[0], [0, 4, 5, 9, 10, 14, 15, 19])
+    np.testing.assert_array_equal(positions, [2, 2, 7, 7, 12, 12, 17, 17])
+
+
+def test_short_data_is_not_decimated():
+    data = np.arange(12.0).reshape(2, 6)
+    positions, values = minmax_decimate_blocks([(0, data[:, :4]), (4, data[:, 4:])], 6, 4)
+    np.testing.assert_array_equal(positions, np.arange(6))
+    np.testing.assert_array_equal(values, data)
@@ -0,0 +1,40 @@
+import os
+
+import mne
+import numpy as np
+import pytest
+
+from eeg_stream import EEGDiskStore
+from jobs import DONE, FAILED, Job
+from recording_pipeline import recording_failed
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    path = str(tmp_path / 'recordings' / 'u-1')
+    store = EEGDiskStore.create(path, mne.create_info(['F3', 'F4'], 250, 'eeg'))
+    store.append(np.zeros((2, 100)))
+    store.finalize()
+    return path
+
+
+def failed_job(store_path, upload_fif_status):
+    stages = {'upload_fif': {'status': upload_fif_status, 'started_at': 0, 'duration': 1.0, 'result': None}}
+    return Job(None, 'job', 'recording', {'user_id': 'u', 'store_path': store_path}, stages)
+
+
+def test_store_is_removed_when_the_fif_file_was_uploaded(store_path):
+    recording_failed(failed_job(store_path, DONE), RuntimeError('Spring is down'))
+    assert not os.path.exists(store_path + '.dat')
+    assert not os.path.exists(store_path + '.json')
+
+
+def test_store_is_kept_when_the_fif_file_was_not_uploaded(store_path, capsys):
+    recording_failed(failed_job(store_path, FAILED), IOError('upload interrupted'))
+    assert EEGDiskStore.open(store_path).n_samples == 100
+    assert store_path in capsys.readouterr().out
+
+
+def test_removed_store_is_ignored(store_path):
+    EEGDiskStore.open(store_path).remove()
+    recording_failed(failed_job(store_path, DONE), RuntimeError('Spring is down'))
@@ -0,0 +1,62 @@
+import mne
+import numpy as np
+import pytest
+
+from segmentation import QRSegmenter
+
+
+def annotations(*items):
+    """mne Annotations from (onset, description) pairs."""
+    onsets, descriptions = zip(*items) if items else ((), ())
+    return mne.Annotations(onsets, np.zeros(len(onsets)), descriptions)
+
+
+def test_pairs_follow_the_questions():
+    pairs = QRSegmenter().find_pairs(annotations((1, 'Q1'), (5, 'R1'), (8, 'Q2'), (12, 'R2')))
+    assert pairs == [('1', 1.0, 5.0), ('2', 8.0, 12.0)]
+
+
+def test_unanswered_questions_and_unasked_responses_are_left_out():
+    pairs = QRSegmenter().find_pairs(annotations((1, 'Q1'), (3, 'R0'), (8, 'Q2'), (12, 'R2'), (15, 'BAD')))
+    assert pairs == [('2', 8.0, 12.0)]
+
+
+def test_labels_are_matched_exactly():
+    pairs = QRSegmenter().find_pairs(annotations((1, 'Q1'), (2, 'Q10'), (3, 'R10'), (4, 'R1')))
+    assert pairs == [('1', 1.0, 4.0), ('10', 2.0, 3.0)]
+
+
+def test_first_match_takes_the_earliest_response():
+    items = annotations((1, 'R1'), (5, 'Q1'), (9, 'R1'), (12, 'Q1'))
+    assert QRSegmenter(match='first').find_pairs(items) == [('1', 5.0, 1.0), ('1', 12.0, 1.0)]
+
+
+def test_next_match_takes_the_first_response_after_the_question():
+    items = annotations((1, 'R1'), (5, 'Q1'), (9, 'R1'), (12, 'Q1'), (12, 'R1'), (20, 'Q2'), (18, 'R2'))
+    assert QRSegmenter(match='next').find_pairs(items) == [('1', 5.0, 9.0), ('1', 12.0, 12.0)]
+
+
+def test_custom_prefixes():
+    segmenter = QRSegmenter(question_prefix='question_', response_prefix='answer_')
+    pairs = segmenter.find_pairs(annotations((1, 'question_a'), (2, 'answer_a'), (3, 'Q1'), (4, 'R1')))
+    assert pairs == [('a', 1.0, 2.0)]
+
+
+@pytest.mark.parametrize('items', [(), ((1, 'Q1'), (2, 'Q2')), ((1, 'R1'),)])
+def test_no_pairs(items):
+    assert QRSegmenter().find_pairs(annotations(*items)) == []
+
+
+def test_unknown_match_is_rejected():
+    with pytest.raises(ValueError):
+        QRSegmenter(match='last')
+
+
+def test_segments_include_the_response_sample_like_crop():
+    data = np.arange(2 * 100, dtype=float).reshape(2, 100)
+    segments = QRSegmenter().segment(data, 10.0, [('1', 1.0, 2.0), ('2', 9.5, 12.0)])
+    assert (segments[0].start, segments[0].stop) == (10, 21)
+    assert np.shares_memory(segments[0].data, data)
+    np.testing.assert_array_equal(segments[0].data, data[:, 10:21])
+    # Clipped to the end of the data
+    assert (segments[1].start, segments[1].stop) == (95, 100)
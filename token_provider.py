@@ -0,0 +1,111 @@
+"""Cached OAuth client-credentials token for the analysis API.
+
+`TokenProvider` keeps the Keycloak access token in memory (and optionally in a
+file, so short-lived scripts can share it) and only asks the identity server for
+a new one shortly before the current one expires. One provider can be shared by
+all threads; concurrent callers wait for a single refresh instead of each
+running their own exchange.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+# Used when the token response has no expires_in
+DEFAULT_EXPIRES_IN = 60
+
+
+class TokenProvider:
+    """
+    Parameters:
+    - token_url: the OpenID Connect token endpoint.
+    - client_id, client_secret: client credentials.
+    - session: `requests.Session` used for the token request.
+    - refresh_margin: seconds before expiry at which the token is refreshed.
+    - cache_path: optional JSON file the token is also stored in.
+    """
+
+    def __init__(self, token_url, client_id, client_secret, session, refresh_margin=30, cache_path=None):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session
+        self.refresh_margin = refresh_margin
+        self.cache_path = cache_path
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        if cache_path:
+            self._load_cache()
+
+    @classmethod
+    def from_env(cls, session):
+        token_url = f"{os.getenv('KEYCLOAK_URL')}/realms/{os.getenv('REALM')}/protocol/openid-connect/token"
+        return cls(token_url, os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'), session,
+                   refresh_margin=float(os.getenv('TOKEN_REFRESH_MARGIN_SEC', '30')),
+                   cache_path=os.getenv('TOKEN_CACHE_PATH'))
+
+    def get_token(self):
+        """Return a valid access token, requesting a new one if the current one is about to expire."""
+        with self._lock:
+            if self._token is None or time.time() >= self._expires_at - self.refresh_margin:
+                self._refresh()
+            return self._token
+
+    async def get_token_async(self):
+        """`get_token` for asyncio code; a refresh runs in a worker thread instead of blocking the loop."""
+        if self._token is not None and time.time() < self._expires_at - self.refresh_margin:
+            return self._token
+        return await asyncio.to_thread(self.get_token)
+
+    def invalidate(self, token=None):
+        """Forget the current token, e.g. after the API rejected it with 401.
+
+        If `token` is given, only forget it if it is still the current one. Returns True if the
+        token was dropped.
+        """
+        with self._lock:
+            if self._token is None or (token is not None and token != self._token):
+                return False
+            self._token = None
+            self._expires_at = 0.0
+            return True
+
+    def _refresh(self):
+        data = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'client_credentials'
+        }
+        requested_at = time.time()
+        response = self.session.post(self.token_url, headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                     data=urlencode(data))
+        response.raise_for_status()
+        body = response.json()
+        self._token = body.get('access_token')
+        # Count the lifetime from before the request, so network time never makes the token look fresher
+        self._expires_at = requested_at + float(body.get('expires_in', DEFAULT_EXPIRES_IN))
+        if self.cache_path:
+            self._save_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        if cached.get('token_url') == self.token_url and cached.get('client_id') == self.client_id:
+            self._token = cached.get('access_token')
+            self._expires_at = float(cached.get('expires_at', 0.0))
+
+    def _save_cache(self):
+        cached = {'token_url': self.token_url, 'client_id': self.client_id,
+                  'access_token': self._token, 'expires_at': self._expires_at}
+        tmp_path = self.cache_path + '.tmp'
+        # The token is a credential, keep it readable by the owner only
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(cached, cache_file)
+        os.replace(tmp_path, self.cache_path)
@@ -1,30 +1,21 @@
-import os
 from dotenv import load_dotenv
-from google.cloud import storage
-from io import BytesIO
+
+from uploads import get_uploader
+
 
 def upload_to_firebase(file_path, file_name, content_type):
     # Load environment variables
     load_dotenv()
 
-    # Path to the credentials.json file
-    cred_path = 'credentials.json'
-
-    # Initialize Firebase Admin SDK with the credentials file
-    cred = storage.Client.from_service_account_json(cred_path)
-    bucket_name = os.getenv('FIREBASE_STORAGE_BUCKET')
-    bucket = cred.get_bucket(bucket_name)
-    blob = bucket.blob(file_name)
-
-    # Upload the file from the given file path
-    with open(file_path, 'rb') as file:
-        blob.upload_from_file(file, content_type=content_type)
+    # The uploader creates the storage client once and reuses it for every upload
+    uploader = get_uploader('credentials.json')
 
-    # Make the blob publicly readable
-    blob.make_public()
+    # Upload the file from the given file path and make it publicly readable
+    result = uploader.upload(file_name, file_path, content_type)
+    print(f'Uploaded {result.size} bytes in {result.duration:.2f} s')
 
     # The public URL can be used to directly access the uploaded file via HTTP
-    return blob.public_url
+    return result.url
 
 # Example usage
 file_path = 'test.fif' # Replace with the path to the file you want to upload
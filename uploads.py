@@ -0,0 +1,320 @@
+"""Streaming uploads to Firebase / Google Cloud Storage.
+
+`StorageUploader` is the shared entry point: it wraps one bucket (and so one
+storage client and its pooled HTTP connections) for the lifetime of the
+process, uploads large files in resumable chunks with retries, runs several
+uploads concurrently and records how long each one took.
+
+`upload_raw_fif` writes an mne Raw object as FIF in a background thread while
+the storage client reads the same file behind it, so the upload runs
+concurrently with the write and never holds more than one upload chunk in
+memory. The file is only a short-lived staging area that is deleted right after
+the upload, instead of being written completely and then read back.
+
+`LocalBucket` implements the part of the `google.cloud.storage` bucket/blob API
+used here on top of a local directory, for testing and benchmarking uploads
+without credentials.
+"""
+import io
+import os
+import shutil
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import span
+
+try:
+    from google.cloud.storage.retry import DEFAULT_RETRY
+except ImportError:  # only LocalBucket can be used
+    DEFAULT_RETRY = None
+
+# Resumable upload chunks must be a multiple of 256 KiB
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+DEFAULT_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024)))
+# Files up to this size are sent in a single request
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+
+UploadResult = namedtuple('UploadResult', ['name', 'url', 'size', 'duration'])
+
+
+class FollowingFileReader(io.RawIOBase):
+    """Read-only stream over a file that another thread is still writing.
+
+    Reads block until the requested number of bytes has been written or the writer is done, so
+    every read except the last returns a full chunk. Seeking back to already written data is
+    supported, which the resumable upload uses to resend a chunk after a failed request.
+
+    Parameters:
+    - path: the file being written.
+    - writer_done: `threading.Event` set once the writer closed the file.
+    - poll_interval: seconds between checks for new data.
+    """
+
+    def __init__(self, path, writer_done, poll_interval=0.01):
+        super().__init__()
+        self.path = path
+        self.writer_done = writer_done
+        self.poll_interval = poll_interval
+        self.writer_error = None
+        self._file = None
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            self._wait_for(None)
+            offset += self._written()
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer):
+        self._wait_for(len(buffer))
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        self._file.seek(self._pos)
+        n = self._file.readinto(buffer)
+        self._pos += n
+        return n
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super().close()
+
+    def _written(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def _wait_for(self, n_bytes):
+        # n_bytes=None waits for the writer to finish
+        while not self.writer_done.is_set():
+            if n_bytes is not None and self._written() - self._pos >= n_bytes:
+                return
+            time.sleep(self.poll_interval)
+        if self.writer_error is not None:
+            raise IOError(f'Writing {self.path} failed') from self.writer_error
+
+
+def upload_stream(blob, stream, content_type, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Upload a file-like object in resumable chunks of `chunk_size` bytes."""
+    blob.chunk_size = chunk_size - chunk_size % CHUNK_SIZE_MULTIPLE or CHUNK_SIZE_MULTIPLE
+    _upload_from_file(blob, stream, content_type)
+
+
+def _upload_from_file(blob, stream, content_type):
+    if DEFAULT_RETRY is None:
+        blob.upload_from_file(stream, content_type=content_type)
+    else:
+        # Also retry failed chunks of resumable uploads, not only idempotent requests
+        blob.upload_from_file(stream, content_type=content_type, retry=DEFAULT_RETRY)
+
+
+def upload_raw_fif(raw, file_name, blob, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Save `raw` to `file_name` and upload it to `blob` while it is being written.
+
+    The staging file is removed afterwards. Returns the number of bytes uploaded.
+    """
+    writer_done = threading.Event()
+    reader = FollowingFileReader(file_name, writer_done)
+
+    def write():
+        try:
+            with span('fif_save') as save_span:
+                raw.save(file_name, overwrite=True)
+                save_span.add_bytes(os.path.getsize(file_name))
+        except Exception as e:
+            reader.writer_error = e
+        finally:
+            writer_done.set()
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        upload_stream(blob, reader, 'application/octet-stream', chunk_size=chunk_size)
+        if reader.writer_error is not None:
+            raise IOError(f'Writing {file_name} failed') from reader.writer_error
+        return reader.tell()
+    finally:
+        writer_done.wait()
+        reader.close()
+        writer.join()
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+class StorageUploader:
+    """Uploads files to one bucket, reusing its client and connections.
+
+    Parameters:
+    - bucket: a `google.cloud.storage` bucket, e.g. `firebase_admin.storage.bucket()`, or a `LocalBucket`.
+    - max_workers: number of concurrent uploads in `upload_many` and `submit`.
+    - chunk_size: chunk size of resumable uploads.
+    - resumable_threshold: sources larger than this (or of unknown size) use resumable uploads.
+    - attempts: how often an upload from a seekable source is started before giving up.
+    - make_public: make every uploaded blob publicly readable.
+    """
+
+    def __init__(self, bucket, max_workers=4, chunk_size=DEFAULT_CHUNK_SIZE,
+                 resumable_threshold=RESUMABLE_THRESHOLD, attempts=3, make_public=True):
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        self.resumable_threshold = resumable_threshold
+        self.attempts = attempts
+        self.make_public = make_public
+        # Most recent uploads, newest last
+        self.timings = deque(maxlen=1000)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload')
+
+    @classmethod
+    def from_service_account_json(cls, cred_path, bucket_name, max_workers=4, **kwargs):
+        """Create the storage client once, with a connection pool sized for `max_workers` uploads."""
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import storage
+        from google.oauth2 import service_account
+        from requests.adapters import HTTPAdapter
+
+        credentials = service_account.Credentials.from_service_account_file(
+            cred_path, scopes=['https://www.googleapis.com/auth/devstorage.full_control'])
+        session = AuthorizedSession(credentials)
+        session.mount('https://', HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers))
+        client = storage.Client(project=credentials.project_id, credentials=credentials, _http=session)
+        # bucket() does not fetch the bucket metadata, unlike get_bucket()
+        return cls(client.bucket(bucket_name), max_workers=max_workers, **kwargs)
+
+    def upload(self, name, source, content_type):
+        """Upload `source` (a path, bytes or a binary file object) to blob `name`. Returns an `UploadResult`."""
+        if isinstance(source, (str, Path)):
+            with open(source, 'rb') as file_obj:
+                return self.upload(name, file_obj, content_type)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+
+        start = time.perf_counter()
+        start_pos = source.tell() if source.seekable() else None
+        with span('upload', content_type=content_type) as upload_span:
+            for attempt in range(1, self.attempts + 1):
+                blob = self._blob(name, source)
+                try:
+                    _upload_from_file(blob, source, content_type)
+                    break
+                except Exception as e:
+                    if start_pos is None or attempt == self.attempts:
+                        raise
+                    print(f'Upload of {name} failed ({e}), retrying')
+                    source.seek(start_pos)
+            size = source.tell() - start_pos if start_pos is not None else None
+            upload_span.add_bytes(size)
+            return self._finish(blob, name, size, start)
+
+    def upload_raw_fif(self, name, raw, file_name):
+        """Write `raw` as FIF and upload it while it is being written, see `upload_raw_fif`."""
+        start = time.perf_counter()
+        with span('upload', content_type='application/octet-stream') as upload_span:
+            blob = self.bucket.blob(name)
+            size = upload_raw_fif(raw, file_name, blob, chunk_size=self.chunk_size)
+            upload_span.add_bytes(size)
+            return self._finish(blob, name, size, start)
+
+    def upload_many(self, uploads):
+        """Upload several `(name, source, content_type)` tuples concurrently. Returns results in the same order."""
+        futures = [self._executor.submit(self.upload, *upload) for upload in uploads]
+        return [future.result() for future in futures]
+
+    def submit(self, func, *args, **kwargs):
+        """Run `func` on the upload pool and return its future."""
+        return self._executor.submit(func, *args, **kwargs)
+
+    def _blob(self, name, source):
+        blob = self.bucket.blob(name)
+        size = _remaining_size(source)
+        if size is None or size > self.resumable_threshold:
+            blob.chunk_size = self.chunk_size - self.chunk_size % CHUNK_SIZE_MULTIPLE or CHUNK_SIZE_MULTIPLE
+        return blob
+
+    def _finish(self, blob, name, size, start):
+        if self.make_public:
+            blob.make_public()
+        result = UploadResult(name, blob.public_url, size, time.perf_counter() - start)
+        self.timings.append(result)
+        return result
+
+
+def _remaining_size(file_obj):
+    try:
+        pos = file_obj.tell()
+        end = file_obj.seek(0, io.SEEK_END)
+        file_obj.seek(pos)
+        return end - pos
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+_default_uploader = None
+_default_uploader_lock = threading.Lock()
+
+
+def get_uploader(cred_path='credentials.json', bucket_name=None):
+    """Return the process wide uploader for the Firebase bucket, creating it on first use."""
+    global _default_uploader
+    with _default_uploader_lock:
+        if _default_uploader is None:
+            bucket_name = bucket_name or os.getenv('FIREBASE_STORAGE_BUCKET')
+            _default_uploader = StorageUploader.from_service_account_json(cred_path, bucket_name)
+    return _default_uploader
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+        self.content_type = None
+
+    @property
+    def path(self):
+        return self.bucket.directory / self.name
+
+    @property
+    def public_url(self):
+        return self.path.resolve().as_uri()
+
+    def upload_from_file(self, file_obj, content_type=None, size=None, **kwargs):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.content_type = content_type
+        with open(self.path, 'wb') as out:
+            # Copy in upload-sized chunks like the resumable upload does
+            shutil.copyfileobj(file_obj, out, self.chunk_size or DEFAULT_CHUNK_SIZE)
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        with open(filename, 'rb') as file_obj:
+            self.upload_from_file(file_obj, content_type=content_type)
+
+    def make_public(self):
+        pass
+
+
+class LocalBucket:
+    """Directory standing in for a storage bucket."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
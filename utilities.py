@@ -1,21 +1,16 @@
+from collections import namedtuple
+
 import matplotlib.pyplot as plt
 import numpy as np
 import parselmouth
 
+import preprocessing
+from metrics import span
 
-def preprocess_raw_data(raw):
-    # Drop unwanted channels
-    raw.drop_channels(['Accel_x', 'Accel_y', 'Accel_z', 'Digital', 'Sample'])
-
-    # Define a function to remove the mean (baseline)
-    def remove_mean(x):
-        return x - np.mean(x)
 
-    # Apply the function to remove the mean
-    raw.apply_function(remove_mean, picks='eeg')
-    # Filter the data
-    raw.filter(0.5, 30)
-    return raw
+def preprocess_raw_data(raw, float32=False):
+    # Drop the unwanted channels, remove the mean (baseline) and filter the data, see preprocessing.Preprocessor
+    return preprocessing.preprocess_raw_data(raw, float32=float32)
 
 
 def print_channel_values_at_timestamp(raw, timestamp):
@@ -79,7 +74,58 @@ def add_plot_title(title, fig):
 # Sound analysis #######################################################################################################
 # Sound analysis #######################################################################################################
 
-def trim_silence(sound, threshold=40, min_silence_duration=0.5):
+def silence_bounds_batch(times, intensities, xmin, xmax, threshold=40, min_silence_duration=0.5):
+    """
+    Vectorized `silence_bounds` of many sounds at once.
+
+    Parameters:
+    - times, intensities: (n_sounds, n_frames) arrays; shorter contours are padded with NaN.
+    - xmin, xmax: (n_sounds,) start and end times of the sounds.
+    - threshold, min_silence_duration: see `silence_bounds`.
+
+    Returns:
+    - (start_times, end_times), NaN for sounds without a frame above the threshold.
+    """
+    times = np.asarray(times, dtype=float)
+    xmin = np.asarray(xmin, dtype=float)
+    xmax = np.asarray(xmax, dtype=float)
+    with np.errstate(invalid='ignore'):
+        loud = np.asarray(intensities, dtype=float) > threshold
+    found = loud.any(axis=1)
+    rows = np.arange(len(loud))
+    # First loud frame, and the last one from the end of the (padded) rows
+    start_times = times[rows, loud.argmax(axis=1)]
+    end_times = times[rows, loud.shape[1] - 1 - loud[:, ::-1].argmax(axis=1)]
+    start_times = np.where(start_times - xmin < min_silence_duration, xmin, start_times)
+    end_times = np.where(xmax - end_times < min_silence_duration, xmax, end_times)
+    return np.where(found, start_times, np.nan), np.where(found, end_times, np.nan)
+
+
+def silence_bounds(times, intensities, xmin, xmax, threshold=40, min_silence_duration=0.5):
+    """
+    Find the part of a sound to keep after trimming silence from its beginning and end.
+
+    Parameters:
+    - times: times of the intensity frames, in seconds.
+    - intensities: intensity of every frame, in dB.
+    - xmin, xmax: start and end time of the sound.
+    - threshold: intensity threshold (in dB) below which sound is considered silent.
+    - min_silence_duration: minimum duration (in seconds) of silence to be considered for trimming;
+      shorter silence at the beginning or end is kept.
+
+    Returns:
+    - (start_time, end_time), or None if no frame is above the threshold.
+    """
+    if len(times) == 0:
+        return None
+    start_times, end_times = silence_bounds_batch([times], [intensities], [xmin], [xmax], threshold,
+                                                  min_silence_duration)
+    if np.isnan(start_times[0]):
+        return None
+    return float(start_times[0]), float(end_times[0])
+
+
+def trim_silence(sound, threshold=40, min_silence_duration=0.5, verbose=True):
     """
     Trim silence from the beginning and end of the sound.
 
@@ -87,42 +133,106 @@ def trim_silence(sound, threshold=40, min_silence_duration=0.5):
     - sound: a parselmouth.Sound object.
     - threshold: intensity threshold (in dB) below which sound is considered silent.
     - min_silence_duration: minimum duration (in seconds) of silence to be considered for trimming.
+    - verbose: print how much was trimmed.
 
     Returns:
     - Trimmed parselmouth.Sound object.
     """
 
     intensity = sound.to_intensity(minimum_pitch=75.0)
-    times = intensity.xs()
-    intensities = intensity.values[0]
-
-    # Find start time of sound
-    start_time = None
-    for time, intensity in zip(times, intensities):
-        if intensity > threshold:
-            start_time = time
-            break
-
-    # Find end time of sound
-    end_time = None
-    for time, intensity in reversed(list(zip(times, intensities))):
-        if intensity > threshold:
-            end_time = time
-            break
-
-    # If no start or end time found, return original sound
-    if start_time is None or end_time is None:
-        return sound
+    bounds = silence_bounds(intensity.xs(), intensity.values[0], sound.xmin, sound.xmax,
+                            threshold=threshold, min_silence_duration=min_silence_duration)
 
-    trimmed_from_start = (start_time - sound.xmin) * 1000  # Convert seconds to milliseconds
-    trimmed_from_end = (sound.xmax - end_time) * 1000  # Convert seconds to milliseconds
+    # If no sound is found, or no silence is long enough, return original sound
+    if bounds is None or bounds == (sound.xmin, sound.xmax):
+        return sound
+    start_time, end_time = bounds
 
-    print(f"Trimmed {trimmed_from_start:.2f} ms from the start and {trimmed_from_end:.2f} ms from the end.")
+    if verbose:
+        trimmed_from_start = (start_time - sound.xmin) * 1000  # Convert seconds to milliseconds
+        trimmed_from_end = (sound.xmax - end_time) * 1000  # Convert seconds to milliseconds
+        print(f"Trimmed {trimmed_from_start:.2f} ms from the start and {trimmed_from_end:.2f} ms from the end.")
 
     # Extract part of the sound between start_time and end_time
     return sound.extract_part(start_time, end_time, preserve_times=False)
 
 
+def trim_silence_batch(sounds, threshold=40, min_silence_duration=0.5, verbose=False):
+    """
+    Trim silence from the beginning and end of every sound in a list, see `trim_silence`.
+
+    The intensity contour of every sound is computed by Praat; the bounds of all sounds are then found
+    in one vectorized pass over the padded contours (`silence_bounds_batch`).
+
+    Parameters:
+    - verbose: print how many sounds were trimmed.
+
+    Returns:
+    - List of trimmed parselmouth.Sound objects, in the same order.
+    """
+    if not sounds:
+        return []
+    intensities = [sound.to_intensity(minimum_pitch=75.0) for sound in sounds]
+    n_frames = max(intensity.values.shape[1] for intensity in intensities)
+    times = np.full((len(sounds), n_frames), np.nan)
+    values = np.full((len(sounds), n_frames), np.nan)
+    for i, intensity in enumerate(intensities):
+        frames = intensity.values.shape[1]
+        times[i, :frames] = intensity.xs()
+        values[i, :frames] = intensity.values[0]
+    xmin = np.array([sound.xmin for sound in sounds])
+    xmax = np.array([sound.xmax for sound in sounds])
+    start_times, end_times = silence_bounds_batch(times, values, xmin, xmax, threshold, min_silence_duration)
+
+    # Sounds without loud frames, or without silence long enough to trim, are returned as they are
+    trim = ~np.isnan(start_times) & ((start_times != xmin) | (end_times != xmax))
+    trimmed = [sound.extract_part(start, end, preserve_times=False) if keep else sound
+               for sound, keep, start, end in zip(sounds, trim, start_times, end_times)]
+    if verbose:
+        print(f"Trimmed silence from {int(trim.sum())} of {len(sounds)} sounds.")
+    return trimmed
+
+
+# Acoustic features of one sound; pitch in Hz, intensity in dB, HNR in dB
+AcousticFeatures = namedtuple('AcousticFeatures', [
+    'jitter', 'shimmer', 'hnr', 'mean_pitch', 'stddev_pitch', 'min_pitch', 'max_pitch',
+    'mean_intensity', 'stddev_intensity'])
+
+
+@span('acoustic_features')
+def extract_acoustic_features(sound):
+    """
+    Compute all acoustic features of a sound, creating every Praat object only once.
+
+    Parameters:
+    - sound: a parselmouth.Sound object.
+
+    Returns:
+    - AcousticFeatures record.
+    """
+    pitch = sound.to_pitch()
+    intensity = sound.to_intensity()
+    point_process = parselmouth.praat.call(pitch, "To PointProcess")
+    point_process_voiced = parselmouth.praat.call(sound, "To PointProcess (periodic, cc)", 75, 500)
+    harmonicity = parselmouth.praat.call(sound, "To Harmonicity (cc)", 0.01, 75, 0.1, 1.0)
+
+    return AcousticFeatures(
+        jitter=parselmouth.praat.call(point_process, "Get jitter (local)", 0.0, 0.0, 0.001, 0.03, 1.3),
+        shimmer=parselmouth.praat.call([sound, point_process_voiced], "Get shimmer (local)", 0.0, 0.0, 0.001, 0.03,
+                                       1.3, 1.6),
+        hnr=parselmouth.praat.call(harmonicity, "Get mean", 0.0, 0.0),
+        mean_pitch=parselmouth.praat.call(pitch, "Get mean", 0.0, 0.0, "Hertz"),
+        stddev_pitch=parselmouth.praat.call(pitch, "Get standard deviation", 0.0, 0.0, "Hertz"),
+        min_pitch=parselmouth.praat.call(pitch, "Get minimum", 0.0, 0.0, "Hertz", "None"),
+        max_pitch=parselmouth.praat.call(pitch, "Get maximum", 0.0, 0.0, "Hertz", "None"),
+        mean_intensity=parselmouth.praat.call(intensity, "Get mean", 0.0, 0.0, "energy"),
+        stddev_intensity=parselmouth.praat.call(intensity, "Get standard deviation", 0.0, 0.0),
+    )
+
+
+# The single features below each compute their own Praat objects; use extract_acoustic_features for several of them
+
+@span('acoustic_feature', feature='jitter')
 def calculate_jitter(sound):
     pitch = sound.to_pitch()
     pointProcess = parselmouth.praat.call(pitch, "To PointProcess")
@@ -130,6 +240,7 @@ def calculate_jitter(sound):
     return jitter
 
 
+@span('acoustic_feature', feature='shimmer')
 def calculate_shimmer(sound):
     pointProcess_voiced = parselmouth.praat.call(sound, "To PointProcess (periodic, cc)", 75, 500)
     shimmer = parselmouth.praat.call([sound, pointProcess_voiced], "Get shimmer (local)", 0.0, 0.0, 0.001, 0.03, 1.3,
@@ -137,52 +248,53 @@ def calculate_shimmer(sound):
     return shimmer
 
 
+@span('acoustic_feature', feature='hnr')
 def calculate_hnr(sound):
     hnr = parselmouth.praat.call(sound, "To Harmonicity (cc)", 0.01, 75, 0.1, 1.0)
     hnr_value = parselmouth.praat.call(hnr, "Get mean", 0.0, 0.0)
     return hnr_value
 
 
+@span('acoustic_feature', feature='mean_pitch')
 def calculate_mean_pitch(sound):
     pitch = sound.to_pitch()
     return parselmouth.praat.call(pitch, "Get mean", 0.0, 0.0, "Hertz")
 
 
+@span('acoustic_feature', feature='stddev_pitch')
 def calculate_stddev_pitch(sound):
     pitch = sound.to_pitch()
     return parselmouth.praat.call(pitch, "Get standard deviation", 0.0, 0.0, "Hertz")
 
 
+@span('acoustic_feature', feature='mean_intensity')
 def calculate_mean_intensity(sound):
     intensity = sound.to_intensity()
     return parselmouth.praat.call(intensity, "Get mean", 0.0, 0.0, "energy")
 
 
+@span('acoustic_feature', feature='stddev_intensity')
 def calculate_stddev_intensity(sound):
     intensity = sound.to_intensity()
     return parselmouth.praat.call(intensity, "Get standard deviation", 0.0, 0.0)
 
 
-def plot_acoustic_features(sound_list):
-    # Lists to store feature values
-    jitter_vals = []
-    shimmer_vals = []
-    hnr_vals = []
-    mean_pitch_vals = []
-    stddev_pitch_vals = []
-    mean_intensity_vals = []
-    stddev_intensity_vals = []
+def plot_acoustic_features(sound_list=(), features=None):
+    # Features of every sound, each Praat object is computed once per sound; or features that were
+    # computed before, as AcousticFeatures or rows of the feature store
+    if features is None:
+        features = [extract_acoustic_features(sound) for sound in sound_list]
+    features = [f if isinstance(f, AcousticFeatures) else
+                AcousticFeatures(**{field: f[field] for field in AcousticFeatures._fields}) for f in features]
+    jitter_vals = [f.jitter for f in features]
+    shimmer_vals = [f.shimmer for f in features]
+    hnr_vals = [f.hnr for f in features]
+    mean_pitch_vals = [f.mean_pitch for f in features]
+    stddev_pitch_vals = [f.stddev_pitch for f in features]
+    mean_intensity_vals = [f.mean_intensity for f in features]
+    stddev_intensity_vals = [f.stddev_intensity for f in features]
 
-    for sound in sound_list:
-        jitter_vals.append(calculate_jitter(sound))
-        shimmer_vals.append(calculate_shimmer(sound))
-        hnr_vals.append(calculate_hnr(sound))
-        mean_pitch_vals.append(calculate_mean_pitch(sound))
-        stddev_pitch_vals.append(calculate_stddev_pitch(sound))
-        mean_intensity_vals.append(calculate_mean_intensity(sound))
-        stddev_intensity_vals.append(calculate_stddev_intensity(sound))
-
-    x = range(len(sound_list))
+    x = range(len(features))
 
     plt.figure(figsize=(15, 10))
 
@@ -215,6 +327,10 @@ def plot_acoustic_features(sound_list):
     plt.bar(x, stddev_intensity_vals)
     plt.title("Std Dev Intensity")
 
+    plt.subplot(3, 3, 8)
+    plt.bar(x, [f.max_pitch - f.min_pitch for f in features], bottom=[f.min_pitch for f in features])
+    plt.title("Pitch Range")
+
     plt.tight_layout()
     plt.show()
 